@@ -0,0 +1,80 @@
+"""
+Measures WebVTT parsing throughput in lines/sec on a synthetic Teams
+transcript with multi-line cues and speaker voice spans, for the raw
+streaming parser and for the full VideoTranscript(source="TEAMS") pipeline.
+
+Run from the project root:
+    python benchmarks/bench_vtt.py [--cues 200000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from preprocess import VideoTranscript  # noqa: E402
+from vtt_parser import iter_cues  # noqa: E402
+
+SPEAKERS = ['Jane Smith', 'Phil Ormondsey', 'Dean Rich', 'Jillian Clarke']
+WORDS = ['the', 'supplier', 'digital', 'platform', 'we', 'should', 'think', 'about', 'data',
+         'services', 'is', 'are', 'team', 'question', 'market', 'engagement', 'so', 'um', 'and']
+
+
+def format_time(seconds: float) -> str:
+    hours, remainder = divmod(seconds, 3600)
+    minutes, secs = divmod(remainder, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{secs:06.3f}"
+
+
+def make_vtt(path: str, cues: int, seed: int = 42) -> int:
+    """
+    Writes a Teams-style WebVTT file and returns its number of lines.
+    """
+    rng = random.Random(seed)
+    start = 0.0
+    lines = 2
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("WEBVTT\n\n")
+        for index in range(cues):
+            end = start + rng.uniform(1.0, 6.0)
+            text_lines = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 10)))
+                          for _ in range(rng.randint(1, 3))]
+            f.write(f"{uuid.UUID(int=rng.getrandbits(128))}/{index}-0\n")
+            f.write(f"{format_time(start)} --> {format_time(end)}\n")
+            f.write(f"<v {rng.choice(SPEAKERS)}>" + '\n'.join(text_lines) + "</v>\n\n")
+            lines += 3 + len(text_lines)
+            start = end
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cues', type=int, default=200_000, help='number of cues to generate')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'transcript.vtt')
+        lines = make_vtt(path, args.cues)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+
+        started = time.perf_counter()
+        parsed = sum(1 for _ in iter_cues(path))
+        parser_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        transcript = VideoTranscript(path, chunksize=10, source="TEAMS")
+        pipeline_seconds = time.perf_counter() - started
+
+    assert parsed == args.cues
+    print(f"{lines:,} lines, {args.cues:,} cues, {size_mb:.1f} MB -> {len(transcript.get_data_frame()):,} chunks")
+    print(f"  iter_cues:                    {parser_seconds:7.3f}s  {lines / parser_seconds:12,.0f} lines/sec")
+    print(f"  VideoTranscript(TEAMS) total: {pipeline_seconds:7.3f}s  {lines / pipeline_seconds:12,.0f} lines/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import streamlit as st
 import pandas as pd
 import altair as alt
 import numpy as np
+import openai
 import seaborn as sns
 import matplotlib.pyplot as plt
 from wordcloud import WordCloud
@@ -16,9 +17,143 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # Now you can import modules from the src directory
 import src.utils.common as utils
 
+# the pipeline modules import each other by their bare names, so src itself needs to be on the path too
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import analytics  # noqa: E402
+import downsample  # noqa: E402
+import embeddings  # noqa: E402
+from vector_index import VectorIndex  # noqa: E402
+
 YOUTUBE_URL = "https://www.youtube.com/watch?v=Ir3TIRmaSL8"
 TEXT_FILE_PATH = "data/final/v4output.json"
-ANALYTICS_COLUMNS = ['sentiment', 'urgency', 'descriptive_normative', 'questioning']
+INDEX_DIR = "data/final/index"
+ANALYTICS_COLUMNS = analytics.ANALYTICS_COLUMNS
+
+
+def output_modified(file_path: str) -> float:
+    """
+    Returns the latest modification time of an output file and its Parquet copy, used as a cache
+    key so that the dashboard reloads the data when the pipeline rewrites it.
+    """
+    paths = [file_path, utils.columnar_path(file_path)]
+    return max((os.path.getmtime(path) for path in paths if os.path.exists(path)), default=0.0)
+
+
+@st.cache_resource
+def load_output_frame(file_path: str, modified: float) -> pd.DataFrame:
+    """
+    Loads the transcript output once for every rerun and session, rather than on each interaction.
+    The frame is shared between sessions, so it must not be modified in place.
+    """
+    return utils.load_output_frame(file_path)
+
+
+@st.cache_resource
+def load_analytics_bundle(file_path: str, modified: float) -> dict[str, np.ndarray]:
+    """
+    Loads the analytics precomputed by the pipeline, or an empty dict if they are missing or out of date.
+    """
+    return analytics.load_bundle(file_path, rows=len(load_output_frame(file_path, modified)))
+
+
+@st.cache_resource
+def load_rolling_frame(file_path: str, modified: float, rolling_window: int) -> pd.DataFrame:
+    """
+    Returns the transcript output with the analytics columns as rolling averages, from the
+    analytics bundle if it has this window size, otherwise computed once and cached.
+    """
+    data_frame = load_output_frame(file_path, modified)
+    bundle = load_analytics_bundle(file_path, modified)
+    if f'rolling_{rolling_window}' not in bundle:
+        return analytics.rolling_frame(data_frame, rolling_window)
+    rolling = pd.DataFrame(bundle[f'rolling_{rolling_window}'], columns=bundle['columns'], index=data_frame.index)
+    return data_frame.assign(**{column: rolling[column] for column in ANALYTICS_COLUMNS})
+
+
+@st.cache_resource
+def load_correlation_matrix(file_path: str, modified: float, rolling_window: int | None = None) -> pd.DataFrame:
+    """
+    Returns the correlation matrix of the transcript output, or of its rolling averages if
+    `rolling_window` is given, from the analytics bundle if it has it.
+    """
+    bundle = load_analytics_bundle(file_path, modified)
+    name = 'corr' if rolling_window is None else f'corr_rolling_{rolling_window}'
+    if name in bundle:
+        return pd.DataFrame(bundle[name], index=bundle['corr_columns'], columns=bundle['corr_columns'])
+    if rolling_window is None:
+        return analytics.correlation_matrix(load_output_frame(file_path, modified))
+    return analytics.correlation_matrix(load_rolling_frame(file_path, modified, rolling_window))
+
+
+@st.cache_resource
+def load_term_index(file_path: str, modified: float) -> analytics.TermIndex:
+    """
+    Returns the index from each chunk to its tags and topic, from the analytics bundle if it has it.
+    """
+    bundle = load_analytics_bundle(file_path, modified)
+    if 'chunk_terms' in bundle:
+        return analytics.TermIndex.from_bundle(bundle)
+    return analytics.TermIndex.from_frame(load_output_frame(file_path, modified))
+
+
+@st.cache_data(max_entries=64)
+def render_wordcloud(file_path: str, modified: float, ranges: tuple) -> np.ndarray | None:
+    """
+    Renders the wordcloud of the tags and topics of the chunks within the slider ranges, once per
+    combination of ranges.
+    Args:
+        ranges (tuple): a (column, low, high) tuple for each analytics column
+    Returns:
+        np.ndarray: the image, or None if there are no words to show
+    """
+    mask = analytics.filter_mask(load_output_frame(file_path, modified),
+                                 {column: (low, high) for column, low, high in ranges})
+    frequencies = load_term_index(file_path, modified).frequencies(mask)
+    if frequencies.empty:
+        return None
+    try:
+        wordcloud = WordCloud(width=1200, height=600, background_color='black').generate_from_frequencies(
+            frequencies.to_dict())
+    except ValueError:
+        return None
+    return wordcloud.to_array()
+
+
+@st.cache_data(max_entries=64)
+def load_timeline(file_path: str, modified: float, rolling_window: int | None, columns: tuple,
+                  start: int, end: int, max_points: int = downsample.DEFAULT_MAX_POINTS) -> tuple:
+    """
+    Returns the line chart's data for rows `start` to `end` inclusive, downsampled to `max_points`
+    per line, so that zooming in to a shorter range shows it in more detail.
+    Args:
+        rolling_window (int): the rolling window to plot, or None for the original data
+        columns (tuple): the columns to plot
+    Returns:
+        tuple: the lines and hover rows from `downsample.downsample_timeline`
+    """
+    if rolling_window is None:
+        data_frame = load_output_frame(file_path, modified)
+    else:
+        data_frame = load_rolling_frame(file_path, modified, rolling_window)
+    return downsample.downsample_timeline(data_frame.iloc[start:end + 1], list(columns), max_points)
+
+
+@st.cache_resource
+def load_vector_index(index_dir: str, modified: float) -> VectorIndex:
+    """
+    Loads the vector index once rather than on every rerun. `modified` is the index's
+    modification time, so that a rebuilt index is reloaded.
+    """
+    return VectorIndex.load(index_dir)
+
+
+@st.cache_data(max_entries=256)
+def embed_query(query: str) -> np.ndarray:
+    """
+    Embeds a search query, once per distinct query. Queries are one-off, so unlike transcript
+    chunks they are not added to the on-disk embedding cache.
+    """
+    return embeddings.request_embeddings(openai.Client(), [query])[0]
 
 
 class YouTubeDashboard:
@@ -26,27 +161,24 @@ class YouTubeDashboard:
     Class to create a dashboard for the HMRC DALAS Transcript project.
     """
 
-    def __init__(self, file_path: str, youtube_url: str, rolling_window: int = 5):
+    def __init__(self, file_path: str, youtube_url: str, rolling_window: int = 5, index_dir: str = INDEX_DIR):
         """
         Args:
             file_path (str): the path to the json file containing the transcript data
             youtube_url (str): the url of the youtube video
             rolling_window (int): the rolling window for the rolling average
+            index_dir (str): the directory of the vector index used for semantic search
         """
         self.analytics_columns = ANALYTICS_COLUMNS
         self.input_file_path = file_path
-        self.primary_data_frame = pd.read_json(file_path, orient='records', lines=True)
-        self.primary_data_frame['timecode_text'] = self.primary_data_frame['timestamp'].apply(
-            lambda x: utils.time_code_from_seconds(x))
-
-        # create a copy of the dataframe to use for the wordcloud which doesn't update when
-        # the original dataframe is updated
-        self.wordcloud_data_frame = self.primary_data_frame.copy()
-        self.rolling_data_frame = self.primary_data_frame.copy()
+        # loading is cached across reruns, so only the first page load reads the file
+        self.modified = output_modified(file_path)
+        self.primary_data_frame = load_output_frame(file_path, self.modified)
         self._set_rolling_window(rolling_window)
 
         self.youtube_url = youtube_url
         self.input_file_path = file_path
+        self.index_dir = index_dir
 
     def _set_rolling_window(self, rolling_window: int):
         """
@@ -54,9 +186,8 @@ class YouTubeDashboard:
         Args:
             rolling_window (int): the rolling window
         """
-        self.rolling_data_frame = utils.rolling_average(
-            self.rolling_data_frame, self.analytics_columns,
-            rolling_window)
+        self.rolling_window = rolling_window
+        self.rolling_data_frame = load_rolling_frame(self.input_file_path, self.modified, rolling_window)
 
     def load_youtube_video(self):
         """
@@ -110,62 +241,48 @@ class YouTubeDashboard:
         st.title("Wordcloud")
         st.write("This is a wordcloud of the transcript.")
 
-        df = self.primary_data_frame.copy()
+        df = self.primary_data_frame
 
         # create four rows
         columns = st.columns(len(self.analytics_columns))
 
         # create sliders to allow the user to filter the data based on the analytics columns
+        ranges = []
         for analytical_column, column in zip(self.analytics_columns, columns):
 
-            # create a slider for the column
+            # create a slider for the column, spanning the range of its values
+            low, high = float(df[analytical_column].min()), float(df[analytical_column].max())
+            high = max(high, low + 0.01)
             with column:
                 slider_value = st.slider(
                     f"{analytical_column} range",
-                    value=(0.0, 1.0),
+                    min_value=low,
+                    max_value=high,
+                    value=(low, high),
                     step=0.01)
+            ranges.append((analytical_column, *slider_value))
 
-                # filter the dataframe based on the slider value
-                df = df[(df[analytical_column] >= slider_value[0]) & (df[analytical_column] <= slider_value[1])]
-
-        # create a single string of all the tags and topics, minus the HMRC and Supplier tags
-        stoptags = ['hmrc', 'supllier', 's']
-        all_tags = [tag.lower() for tag in df['tags'] for tag in tag]
-        all_tags = [tag for tag in all_tags if tag not in stoptags]
-        text = ' '.join(all_tags)
-        text = text + ' '.join([topic for topic in df['topic']])
-        text = text.lower()
-
-        # Check if text is empty
-        if not text.strip():
-            st.write("No words to display in wordcloud! Try broadening your filters.")
-            return
-
-        # Create and generate a word cloud image:
-        try:
-            wordcloud = WordCloud(width=1200, height=600, background_color='black').generate(text)
-        except ValueError:
+        # the tags and topics of the filtered chunks, minus the HMRC and Supplier tags, are counted
+        # from the term index, and each combination of filters is only rendered once
+        image = render_wordcloud(self.input_file_path, self.modified, tuple(ranges))
+        if image is None:
             st.write("No words to display in wordcloud! Try broadening your filters.")
             return
 
         # Display the generated image:
         plt.figure(figsize=(10, 5))
-        plt.imshow(wordcloud, interpolation='bilinear')
+        plt.imshow(image, interpolation='bilinear')
         plt.axis("off")
         st.pyplot(plt)
 
     def altair_plot_line_chart(self):
         """
-        Plots a line chart of the transcript.
-        Args:
-            data_frame (pd.DataFrame): the dataframe to process
+        Plots a line chart of the transcript. Long transcripts are downsampled to about one point
+        per pixel, and narrowing the time range resamples it in more detail.
         """
 
         # allow the user to plot the rolling average or the original data
-        if st.checkbox('Use Rolling Averages', value=True):
-            data_frame = self.rolling_data_frame
-        else:
-            data_frame = self.primary_data_frame
+        rolling_window = self.rolling_window if st.checkbox('Use Rolling Averages', value=True) else None
 
         # create a line chart plotting the analytical columns from the rolling_df
         # dataframe and add a selector to choose which columns to plot
@@ -174,44 +291,56 @@ class YouTubeDashboard:
             self.analytics_columns,
             default=self.analytics_columns
         )
+        if not selected_columns:
+            st.write("Select at least one column to plot.")
+            return
+
+        # zoom in by narrowing the time range. The slider only needs its two ends, rather than a
+        # label for every row, and the chosen seconds are mapped back to rows.
+        timestamps = self.primary_data_frame['timestamp'].to_numpy()
+        first, last = int(timestamps[0]), int(timestamps[-1])
+        if first < last:
+            low, high = st.slider('Time range (seconds)', min_value=first, max_value=last, value=(first, last))
+        else:
+            low, high = first, last
+        st.caption(f"{utils.time_code_from_seconds(low)} to {utils.time_code_from_seconds(high)}")
+        start = int(np.searchsorted(timestamps, low, side='left'))
+        end = int(np.searchsorted(timestamps, high, side='right')) - 1
+        if end < start:
+            st.write("No segments start in this time range.")
+            return
+        lines, hover_rows = load_timeline(self.input_file_path, self.modified, rolling_window,
+                                          tuple(selected_columns), start, end)
+
+        # a numeric time axis, labelled as HH:MM:SS
+        x_axis = alt.X('timestamp:Q', title='Timecode',
+                       scale=alt.Scale(domain=[low, high]),
+                       axis=alt.Axis(labelExpr="utcFormat(datum.value * 1000, '%H:%M:%S')"))
 
-        # create a base chart
-        base_chart = alt.Chart(data_frame).mark_line().encode(
-            x=alt.X('timecode_text:O', title='Timecode'),
+        # create a chart with separate lines for each selected column
+        chart = alt.Chart(lines).mark_line().encode(
+            x=x_axis,
             y=alt.Y('value:Q', title='Value'),
             color=alt.Color('column:N', scale=alt.Scale(
                 domain=selected_columns
-            ), legend=alt.Legend(title="Column Name")),
-            tooltip=[alt.Tooltip(c) for c in data_frame.columns]
-        )
-
-        # create a chart with separate lines for each selected column
-        chart = base_chart.transform_fold(
-            selected_columns,
-            as_=['column', 'value']
-        ).transform_filter(
-            alt.FieldOneOfPredicate(field='column', oneOf=selected_columns)
+            ), legend=alt.Legend(title="Column Name"))
         )
 
-        # add a vertical hover line and display tooltip
-        hover_line = alt.Chart(data_frame).mark_rule(color='gray', strokeWidth=0).encode(
-            x=alt.X('timecode_text:O', title='Timecode'),
-            opacity=alt.condition(
-                alt.datum.timecode_text,
-                alt.value(0.5),
-                alt.value(0)
-            ),
-            tooltip=[alt.Tooltip(c) for c in data_frame.columns]
-        ).add_selection(
-            alt.selection_single(on='mouseover', nearest=True, empty='none')
-        )
+        # add a vertical hover line and display tooltip. The tooltips leave out the long text
+        # columns, which would otherwise be sent to the browser for every row.
+        hover = alt.selection_point(on='mouseover', nearest=True, fields=['timestamp'], empty=False)
+        hover_line = alt.Chart(hover_rows).mark_rule(color='gray').encode(
+            x=x_axis,
+            opacity=alt.condition(hover, alt.value(0.5), alt.value(0)),
+            tooltip=[alt.Tooltip(c) for c in hover_rows.columns if c != 'timestamp']
+        ).add_params(hover)
 
         # combine the chart and hover line
         combined_chart = alt.layer(chart, hover_line).resolve_scale(
             color='independent'
         ).properties(
             height=500,
-            width=700
+            width=downsample.DEFAULT_MAX_POINTS
         ).configure_legend(
             orient='top',
             titleFontSize=14,
@@ -227,17 +356,10 @@ class YouTubeDashboard:
         """
 
         # allow the user to plot the rolling average or the original data
-        if st.checkbox('Use Rolling Averages for Heatmap', value=False):
-            data_frame = self.rolling_data_frame
-        else:
-            data_frame = self.primary_data_frame
-
-        # create a sample data frame
-        df = data_frame.drop(columns=['timestamp'])
-
-        # create the correlation matrix using seaborn
+        rolling_window = self.rolling_window if st.checkbox('Use Rolling Averages for Heatmap', value=False) else None
 
-        corr_matrix = df = df.select_dtypes(include=[np.number]).corr()
+        # the correlation matrices are precomputed by the pipeline
+        corr_matrix = load_correlation_matrix(self.input_file_path, self.modified, rolling_window)
 
         # plot the correlation matrix using matplotlib
         fig, ax = plt.subplots()
@@ -280,6 +402,36 @@ class YouTubeDashboard:
 
         return grid_response
 
+    def semantic_search(self):
+        """
+        Shows a search box which finds the segments most similar in meaning to the query,
+        in this transcript or across every transcript in the vector index.
+        """
+        if not os.path.exists(os.path.join(self.index_dir, 'vectors.npy')):
+            st.write(f"No search index found. Build one with \
+                     `python src/vector_index.py {self.input_file_path} {self.index_dir}`.")
+            return
+
+        query = st.text_input("Search for segments about...", placeholder="supplier accreditation")
+        search_all = st.checkbox("Search all indexed transcripts", value=False)
+        top_k = st.slider("Number of results", min_value=1, max_value=50, value=10)
+        if not query:
+            return
+
+        index = load_vector_index(self.index_dir, os.path.getmtime(os.path.join(self.index_dir, 'vectors.npy')))
+        query_vector = embed_query(query)
+        source = os.path.basename(self.input_file_path)
+        # over-fetch when filtering to this transcript, so there are still enough results afterwards
+        results = index.search(query_vector, k=top_k if search_all else top_k * 10)
+        rows = [{'score': round(score, 3), 'source': item['source'],
+                 'timecode_text': utils.time_code_from_seconds(item['timestamp']), 'text': item['text']}
+                for score, item in results if search_all or item['source'] == source][:top_k]
+
+        if not rows:
+            st.write("No matching segments found.")
+            return
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
     def on_page_load(self):
         """
         Runs when the page is loaded.
@@ -318,13 +470,15 @@ class YouTubeDashboard:
                      filter based on the metrics. Click on a row to select it which \
                      will load the YouTube video to the timecode.")
             self.load_youtube_video()
-            tab1_1, tab1_2, tab1_3 = st.tabs(["Line Chart", "Wordcloud", "Correlation Matrix"])
+            tab1_1, tab1_2, tab1_3, tab1_4 = st.tabs(["Line Chart", "Wordcloud", "Correlation Matrix", "Search"])
             with tab1_1:
                 self.altair_plot_line_chart()
             with tab1_2:
                 self.plot_wordcloud()
             with tab1_3:
                 self.plot_correlation_heatmap()
+            with tab1_4:
+                self.semantic_search()
 
         with tab2:
             self.plot_table()
@@ -0,0 +1,222 @@
+"""
+Precomputed analytics for the dashboard charts, so that a render only reads
+arrays rather than recomputing rolling means, correlations and tag counts from
+the whole transcript. The pipeline writes a bundle next to each output file,
+e.g. output.analytics.npz for output.json, holding:
+
+    rolling_{w}           the analytics columns as rolling means, for each window size w
+    corr                  the correlation matrix of the numeric columns
+    corr_rolling_{w}      the correlation matrix of the rolling means
+    terms, term_counts    how often each tag and topic occurs, most frequent first
+    chunk_terms_indptr,   the `TermIndex` from each chunk to the positions in `terms` of
+    chunk_terms           its tags and topic
+
+A bundle is only used while it is at least as new as its output file and has
+the same number of rows; the dashboard computes anything missing itself.
+
+Run from the project root to write the bundle for an existing output file:
+    python src/analytics.py data/final/v4output.json
+"""
+
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from utils.common import atomic_write, save_columnar
+
+ANALYTICS_COLUMNS = ['sentiment', 'urgency', 'descriptive_normative', 'questioning']
+DEFAULT_WINDOWS = (3, 5, 10, 20)
+# tags too common or too garbled to be worth showing, e.g. the organisation's own name
+STOP_TAGS = ('hmrc', 'supllier', 's')
+
+
+def bundle_path(json_path: str) -> str:
+    """
+    Returns the path of the analytics bundle for an output file.
+    """
+    return os.path.splitext(json_path)[0] + '.analytics.npz'
+
+
+def rolling_frame(data_frame: pd.DataFrame, window: int, columns: list[str] = ANALYTICS_COLUMNS) -> pd.DataFrame:
+    """
+    Returns a copy of the frame with `columns` replaced by their rolling means.
+    """
+    return data_frame.assign(**{column: data_frame[column].rolling(window).mean() for column in columns})
+
+
+def correlation_matrix(data_frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the correlation matrix of the frame's numeric columns, other than the timestamp.
+    """
+    return data_frame.drop(columns=['timestamp'], errors='ignore').select_dtypes(include=[np.number]).corr()
+
+
+def chunk_terms(tags, topic) -> list[str]:
+    """
+    Returns the lower-cased tags and topic of one chunk, without the stop tags.
+    """
+    terms = [str(tag).lower() for tag in (tags if tags is not None else [])]
+    if isinstance(topic, str) and topic:
+        terms.append(topic.lower())
+    return [term for term in terms if term not in STOP_TAGS]
+
+
+def term_frequencies(data_frame: pd.DataFrame) -> pd.Series:
+    """
+    Counts the tags and topics over the frame's chunks.
+    Returns:
+        pd.Series: the count of each term, most frequent first
+    """
+    return TermIndex.from_frame(data_frame).frequencies()
+
+
+def filter_mask(data_frame: pd.DataFrame, ranges: dict[str, tuple[float, float]]) -> np.ndarray:
+    """
+    Returns which rows have every column in `ranges` within its (low, high) range, inclusive.
+    """
+    if not ranges:
+        return np.ones(len(data_frame), dtype=bool)
+    values = data_frame[list(ranges)].to_numpy(dtype=np.float64)
+    lows, highs = np.array(list(ranges.values()), dtype=np.float64).T
+    return ((values >= lows) & (values <= highs)).all(axis=1)
+
+
+class TermIndex:
+    """
+    The tags and topic of each chunk, as term ids in compressed sparse row layout: the terms of
+    chunk i are `terms[term_ids[indptr[i]:indptr[i + 1]]]`. Counting the terms of any subset of
+    chunks is then a single `np.bincount`.
+    """
+
+    def __init__(self, terms: np.ndarray, indptr: np.ndarray, term_ids: np.ndarray):
+        """
+        Args:
+            terms (np.ndarray): the vocabulary, most frequent first
+            indptr (np.ndarray): where each chunk's entries start in `term_ids`, plus the end
+            term_ids (np.ndarray): the position in `terms` of each chunk's tags and topic
+        """
+        self.terms = np.asarray(terms, dtype=str)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.term_ids = np.asarray(term_ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_frame(cls, data_frame: pd.DataFrame) -> 'TermIndex':
+        """
+        Builds the index from an output frame's 'tags' and 'topic' columns.
+        """
+        per_chunk = [chunk_terms(tags, topic) for tags, topic in zip(data_frame['tags'], data_frame['topic'])]
+        counts = Counter(term for chunk in per_chunk for term in chunk)
+        terms = [term for term, _ in counts.most_common()]
+        ids = {term: position for position, term in enumerate(terms)}
+        indptr = np.cumsum([0] + [len(chunk) for chunk in per_chunk])
+        term_ids = [ids[term] for chunk in per_chunk for term in chunk]
+        return cls(terms, indptr, term_ids)
+
+    @classmethod
+    def from_bundle(cls, bundle: dict[str, np.ndarray]) -> 'TermIndex':
+        """
+        Loads the index saved in an analytics bundle.
+        """
+        return cls(bundle['terms'], bundle['chunk_terms_indptr'], bundle['chunk_terms'])
+
+    def frequencies(self, mask: np.ndarray | None = None) -> pd.Series:
+        """
+        Counts the terms of the chunks selected by `mask`, or of every chunk.
+        Args:
+            mask (np.ndarray): a boolean per chunk, e.g. from `filter_mask`
+        Returns:
+            pd.Series: the count of each term that occurs, most frequent first
+        """
+        term_ids = self.term_ids if mask is None else self.term_ids[np.repeat(mask, np.diff(self.indptr))]
+        counts = np.bincount(term_ids, minlength=len(self.terms))
+        # a stable sort keeps ties in vocabulary order, i.e. by overall frequency
+        order = np.argsort(-counts, kind='stable')
+        order = order[counts[order] > 0]
+        return pd.Series(counts[order], index=self.terms[order], dtype='int64')
+
+
+def build_bundle(data_frame: pd.DataFrame, windows: tuple[int] = DEFAULT_WINDOWS) -> dict[str, np.ndarray]:
+    """
+    Computes the analytics bundle for an output frame.
+    Args:
+        data_frame (pd.DataFrame): the output, with the analytics columns, 'tags' and 'topic'
+        windows (tuple[int]): the rolling window sizes to precompute
+    Returns:
+        dict[str, np.ndarray]: the bundle's arrays, as described in the module docstring
+    """
+    correlation = correlation_matrix(data_frame)
+    term_index = TermIndex.from_frame(data_frame)
+    frequencies = term_index.frequencies()
+    bundle = {
+        'rows': np.array(len(data_frame)),
+        'columns': np.array(ANALYTICS_COLUMNS),
+        'windows': np.array(windows),
+        'corr_columns': np.array(correlation.columns, dtype=str),
+        'corr': correlation.to_numpy(),
+        'terms': term_index.terms,
+        'term_counts': frequencies.reindex(term_index.terms).to_numpy(),
+        'chunk_terms_indptr': term_index.indptr,
+        'chunk_terms': term_index.term_ids,
+    }
+    for window in windows:
+        rolling = rolling_frame(data_frame, window)
+        bundle[f'rolling_{window}'] = rolling[ANALYTICS_COLUMNS].to_numpy(dtype=np.float64)
+        bundle[f'corr_rolling_{window}'] = correlation_matrix(rolling).to_numpy()
+    return bundle
+
+
+def save_bundle(data_frame: pd.DataFrame, json_path: str, windows: tuple[int] = DEFAULT_WINDOWS) -> str:
+    """
+    Writes the analytics bundle for an output file next to it.
+    Args:
+        data_frame (pd.DataFrame): the output, as written to `json_path`
+        json_path (str): the JSON lines file the output was written to
+        windows (tuple[int]): the rolling window sizes to precompute
+    Returns:
+        str: the path of the bundle
+    """
+    path = bundle_path(json_path)
+    with atomic_write(path) as f:
+        np.savez(f, **build_bundle(data_frame.reset_index(drop=True), windows))
+    return path
+
+
+def load_bundle(json_path: str, rows: int | None = None) -> dict[str, np.ndarray]:
+    """
+    Loads the analytics bundle for an output file.
+    Args:
+        json_path (str): the JSON lines output file
+        rows (int): the number of rows in the output, to check the bundle against
+    Returns:
+        dict[str, np.ndarray]: the bundle's arrays, or an empty dict if there is no up to date bundle
+    """
+    path = bundle_path(json_path)
+    if not os.path.exists(path) or (os.path.exists(json_path)
+                                    and os.path.getmtime(path) < os.path.getmtime(json_path)):
+        return {}
+    with np.load(path) as data:
+        bundle = {name: data[name] for name in data.files}
+    if rows is not None and int(bundle['rows']) != rows:
+        return {}
+    return bundle
+
+
+def save_dashboard_files(data_frame: pd.DataFrame, json_path: str):
+    """
+    Writes everything the dashboard reads alongside an output file: its Parquet copy and its
+    analytics bundle.
+    """
+    save_columnar(data_frame, json_path)
+    save_bundle(data_frame, json_path)
+
+
+if __name__ == "__main__":
+    for file_path in sys.argv[1:]:
+        save_dashboard_files(pd.read_json(file_path, orient='records', lines=True), file_path)
+        print(f"Wrote the dashboard files for {file_path}")
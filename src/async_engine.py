@@ -0,0 +1,375 @@
+"""
+Asyncio helpers to run many OpenAI requests at once. Rather than a fixed
+number of threads, the number of requests in flight is controlled by an
+additive-increase/multiplicative-decrease (AIMD) limiter: it grows while the
+API keeps up, and halves whenever a 429 comes back or the rate-limit headers
+say the quota is nearly spent.
+"""
+
+import asyncio
+import threading
+import time
+
+from tqdm import tqdm
+
+import telemetry
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Returns True if the exception is a 429 from either the current or the legacy OpenAI client.
+    Args:
+        error (Exception): the exception raised by the request
+    """
+    status = getattr(error, 'status_code', None) or getattr(error, 'http_status', None)
+    return status == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def parse_reset_duration(value) -> float | None:
+    """
+    Converts a rate-limit duration header to seconds. OpenAI uses values such as
+    "20ms", "1s", "6m0s" and "1h2m3.5s"; `retry-after` is a plain number of seconds.
+    Args:
+        value (str): the header value
+    Returns:
+        float: the number of seconds, or None if the value can't be parsed
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    seconds, number = 0.0, ''
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char.isdigit() or char == '.':
+            number += char
+            i += 1
+            continue
+        unit = 'ms' if value.startswith('ms', i) else char
+        if unit not in units or not number:
+            return None
+        seconds += float(number) * units[unit]
+        number = ''
+        i += len(unit)
+    return seconds if not number else None
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    """
+    Returns how long the API asked us to wait before retrying, if it said.
+    Args:
+        error (Exception): the rate limit exception
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+    for header in ('retry-after', 'x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        seconds = parse_reset_duration(headers.get(header))
+        if seconds is not None:
+            return seconds
+    return None
+
+
+def _header_int(headers, name: str) -> int | None:
+    """
+    Returns an integer header value, or None if it is missing or malformed.
+    """
+    if not headers:
+        return None
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds the number of requests in flight, adjusting the bound AIMD-style.
+    Each success adds `increase / limit` to the limit (roughly +increase per
+    full window of requests); each rate limit multiplies it by
+    `decrease_factor` and pauses new requests until the API's reset time.
+    The limiter can be reused across event loops, so the level learned in
+    one run carries over to the next.
+    """
+
+    def __init__(self, initial_limit: int = 16, min_limit: int = 1, max_limit: int = 256,
+                 increase: float = 1.0, decrease_factor: float = 0.5, default_backoff: float = 1.0):
+        """
+        Args:
+            initial_limit (int): the number of concurrent requests to start with
+            min_limit (int): the limit never drops below this
+            max_limit (int): the limit never grows above this
+            increase (float): how much the limit grows per window of successful requests
+            decrease_factor (float): the multiplier applied to the limit on a rate limit
+            default_backoff (float): seconds to pause if a 429 doesn't say how long to wait
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.default_backoff = default_backoff
+        self.in_flight = 0
+        self.rate_limited_count = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        """
+        Returns a condition bound to the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        return self._condition
+
+    async def acquire(self):
+        """
+        Waits for a free slot, and for any rate-limit pause to end.
+        """
+        condition = self._get_condition()
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            async with condition:
+                if self.in_flight < max(self.min_limit, int(self.limit)):
+                    self.in_flight += 1
+                    return
+                await condition.wait()
+
+    async def release(self):
+        """
+        Frees a slot and wakes any waiting requests.
+        """
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def on_success(self, headers=None):
+        """
+        Grows the limit after a successful request, unless the rate-limit headers show
+        that there isn't enough quota left in the current window to support more.
+        Args:
+            headers (Mapping): the response headers, if available
+        """
+        remaining_requests = _header_int(headers, 'x-ratelimit-remaining-requests')
+        if remaining_requests is not None and remaining_requests <= self.limit:
+            # nearly out of requests for this window: shrink to what's left rather than waiting for a 429
+            self.limit = max(float(self.min_limit), min(self.limit, float(remaining_requests)))
+            return
+        self.limit = min(float(self.max_limit), self.limit + self.increase / self.limit)
+
+    def on_rate_limit(self, retry_after: float | None = None):
+        """
+        Cuts the limit and pauses new requests after a 429. Several requests usually hit
+        the same limit at once, so the limit is only cut once per backoff period.
+        Args:
+            retry_after (float): seconds the API asked us to wait, if given
+        """
+        now = time.monotonic()
+        backoff = retry_after if retry_after is not None else self.default_backoff
+        self.rate_limited_count += 1
+        if now - self._last_decrease > backoff:
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+            self._last_decrease = now
+        self._paused_until = max(self._paused_until, now + backoff)
+
+
+_limiters = {}
+
+
+def get_limiter(model: str) -> AdaptiveConcurrencyLimiter:
+    """
+    Returns the shared limiter for a model, creating it on first use. Models have
+    separate quotas, so each one gets its own limit.
+    Args:
+        model (str): the model name
+    """
+    if model not in _limiters:
+        _limiters[model] = AdaptiveConcurrencyLimiter()
+    return _limiters[model]
+
+
+async def request_with_retries(item, request_fn, limiter: AdaptiveConcurrencyLimiter, max_retries: int = 6):
+    """
+    Runs `request_fn` on one item inside a limiter slot, retrying if it is rate limited.
+    Args:
+        item: the item to process
+        request_fn (coroutine function): takes an item and returns a tuple of
+        (result, response headers). Headers may be None.
+        limiter (AdaptiveConcurrencyLimiter): the limiter controlling concurrency
+        max_retries (int): how many times to retry a rate-limited request
+    Returns:
+        the result from `request_fn`
+    """
+    for attempt in range(max_retries + 1):
+        wait_started = time.monotonic()
+        await limiter.acquire()
+        # picked up by the telemetry records of the calls request_fn makes
+        telemetry.attempt_var.set(attempt)
+        telemetry.slot_wait_var.set(time.monotonic() - wait_started)
+        try:
+            result, headers = await request_fn(item)
+        except Exception as error:
+            if not is_rate_limit_error(error) or attempt == max_retries:
+                raise
+            limiter.on_rate_limit(retry_after_seconds(error))
+        else:
+            limiter.on_success(headers)
+            return result
+        finally:
+            await limiter.release()
+
+
+async def iter_fetch_results(fetch_list, request_fn, limiter: AdaptiveConcurrencyLimiter,
+                             max_retries: int = 6, max_pending: int | None = None):
+    """
+    Runs `request_fn` on every item, at most `limiter.limit` at a time, and yields
+    `(index, result)` pairs in completion order, where `index` is the item's position
+    in `fetch_list`. Outstanding requests are cancelled if the consumer stops early.
+
+    `fetch_list` can be any iterable, including a generator which is still parsing
+    its input: items are pulled only as fast as they can be queued, and each request
+    starts as soon as its item arrives, so the first results don't wait for the whole
+    input to be read.
+    Args:
+        fetch_list (iterable): the items to process
+        request_fn (coroutine function): takes an item and returns (result, headers)
+        limiter (AdaptiveConcurrencyLimiter): the limiter controlling concurrency
+        max_retries (int): how many times to retry a rate-limited request
+        max_pending (int): the most items to have queued or in flight at once.
+        Defaults to twice the limiter's maximum.
+    """
+    max_pending = max_pending or 2 * limiter.max_limit
+
+    async def run_item(index, item):
+        return index, await request_with_retries(item, request_fn, limiter, max_retries)
+
+    items = iter(fetch_list)
+    exhausted = False
+    next_index = 0
+    pending = set()
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(run_item(next_index, item)))
+                next_index += 1
+                # let the new request start before reading the next item
+                await asyncio.sleep(0)
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def collect_in_order(indexed_results, total: int | None = None, on_result=None) -> list:
+    """
+    Reassembles `(index, result)` pairs, which may arrive in any order, into a list
+    ordered by index. Raises if any index is missing or repeated, so results can't
+    silently be attached to the wrong rows.
+    Args:
+        indexed_results (async iterable): the pairs, e.g. from `iter_fetch_results`
+        total (int): the expected number of results, or None if it isn't known up front
+        on_result (callable): called with (index, result) as each pair arrives
+    """
+    results = {}
+    with tqdm(total=total) as progress:
+        async for index, result in indexed_results:
+            if index in results:
+                raise RuntimeError(f"Received more than one result for index {index}")
+            results[index] = result
+            progress.update(1)
+            if on_result is not None:
+                on_result(index, result)
+
+    expected = total if total is not None else max(results, default=-1) + 1
+    if len(results) != expected:
+        missing = [index for index in range(expected) if index not in results]
+        raise RuntimeError(f"Missing results for indexes {missing[:10]}")
+    return [results[index] for index in range(expected)]
+
+
+async def fetch_all(fetch_list, request_fn, limiter: AdaptiveConcurrencyLimiter,
+                    max_retries: int = 6, on_result=None):
+    """
+    Runs `request_fn` on every item, at most `limiter.limit` at a time, retrying
+    rate-limited requests. Returns the results in the same order as `fetch_list`,
+    whatever order the requests complete in.
+    Args:
+        fetch_list (iterable): the items to process. A generator is consumed lazily.
+        request_fn (coroutine function): takes an item and returns a tuple of
+        (result, response headers). Headers may be None.
+        limiter (AdaptiveConcurrencyLimiter): the limiter controlling concurrency
+        max_retries (int): how many times to retry a rate-limited request
+        on_result (callable): called with (index, result) as each item completes,
+        e.g. to checkpoint results before the whole list has finished
+    """
+    total = len(fetch_list) if hasattr(fetch_list, '__len__') else None
+    indexed_results = iter_fetch_results(fetch_list, request_fn, limiter, max_retries=max_retries)
+    try:
+        return await collect_in_order(indexed_results, total, on_result=on_result)
+    finally:
+        await indexed_results.aclose()
+
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code. Jupyter already runs an
+    event loop, so in that case the coroutine is run on a fresh loop in a thread.
+    Args:
+        coroutine (coroutine): the coroutine to run
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = asyncio.run(coroutine)
+        except BaseException as error:  # re-raised in the calling thread
+            outcome['error'] = error
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def run_fetch_list(fetch_list, request_fn, limiter: AdaptiveConcurrencyLimiter, max_retries: int = 6,
+                   on_result=None):
+    """
+    Synchronous wrapper around `fetch_all`.
+    Args:
+        fetch_list (iterable): the items to process. A generator is consumed lazily.
+        request_fn (coroutine function): takes an item and returns (result, headers)
+        limiter (AdaptiveConcurrencyLimiter): the limiter controlling concurrency
+        max_retries (int): how many times to retry a rate-limited request
+        on_result (callable): called with (index, result) as each item completes
+    """
+    return run_sync(fetch_all(fetch_list, request_fn, limiter, max_retries=max_retries, on_result=on_result))
@@ -0,0 +1,208 @@
+"""
+Command line entry point to process many transcripts in one run. Files are
+preprocessed across a process pool, then every chunk from every file goes
+through one shared request scheduler, so the API quota stays busy until the
+last chunk is done rather than idling at the end of each small file. Each
+transcript is written to its own output file as soon as its last chunk
+completes, and a throughput and cost summary is printed and saved.
+
+Example, from the project root:
+    python src/batch_cli.py "data/raw/*.vtt" "data/raw/*.txt" --out-dir data/final/batch
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import analytics
+import async_engine
+import openai_prompt_engine_func
+import telemetry
+from preprocess import stream_transcript_chunks
+
+TEAMS_EXTENSIONS = ('.vtt', '.srt')
+
+
+def detect_source(file_path: str) -> str:
+    """
+    Returns the transcript source for a file from its extension: WebVTT/SRT files are
+    treated as Teams exports and everything else as YouTube transcripts.
+    """
+    return "TEAMS" if file_path.lower().endswith(TEAMS_EXTENSIONS) else "YT"
+
+
+def preprocess_file(file_path: str, source: str, chunksize: int, chunk_tokens: int | None) -> list[dict]:
+    """
+    Reads and chunks one transcript. Runs in a worker process.
+    """
+    return list(stream_transcript_chunks(file_path, chunksize=chunksize, source=source,
+                                         chunk_tokens=chunk_tokens))
+
+
+def expand_patterns(patterns: list[str]) -> list[str]:
+    """
+    Returns the sorted, de-duplicated files matching any of the glob patterns.
+    """
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern, recursive=True)
+                    if os.path.isfile(path)})
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    duplicates = sorted({stem for stem in stems if stems.count(stem) > 1})
+    if duplicates:
+        raise ValueError(f"Transcripts would overwrite each other's output: {duplicates}")
+    return paths
+
+
+def run_batch(paths: list[str], out_dir: str, source: str | None = None, chunksize: int = 10,
+              chunk_tokens: int | None = None, workers: int | None = None,
+              temperature: float = 0.0, engine: str = "gpt-4-turbo-preview") -> dict:
+    """
+    Preprocesses and prompts a list of transcripts, writing one output file per transcript and
+    adding each to a partitioned Parquet store in `out_dir`/store as it finishes.
+    Args:
+        paths (list[str]): the transcript files
+        out_dir (str): the directory for the output files, store and summary
+        source (str): "YT" or "TEAMS", or None to detect it from each file's extension
+        chunksize (int): number of rows to roll up into one chunk
+        chunk_tokens (int): if set, chunk to this many tokens instead of `chunksize` rows
+        workers (int): the number of preprocessing processes, defaulting to the CPU count
+        temperature (float): the temperature to use for the chat api
+        engine (str): the engine to use for the chat api
+    Returns:
+        dict: the run summary
+    """
+    # imported here rather than with the other modules, as the output store needs pyarrow
+    import output_store
+
+    os.makedirs(out_dir, exist_ok=True)
+    store = output_store.OutputStore(os.path.join(out_dir, 'store'))
+    started = time.monotonic()
+
+    sources = [source or detect_source(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunk_lists = list(pool.map(preprocess_file, paths, sources,
+                                    itertools.repeat(chunksize), itertools.repeat(chunk_tokens)))
+    preprocess_seconds = time.monotonic() - started
+    transcripts = dict(zip(paths, chunk_lists))
+
+    items = [(path, index, chunk) for path, chunks in transcripts.items() for index, chunk in enumerate(chunks)]
+    outputs = {path: [None] * len(chunks) for path, chunks in transcripts.items()}
+    stats = {path: {'chunks': len(chunks), 'remaining': len(chunks), 'cached': 0, 'prompt_tokens': 0,
+                    'completion_tokens': 0, 'cost_usd': 0.0, 'seconds': None}
+             for path, chunks in transcripts.items()}
+
+    async def process_item(item):
+        _, _, chunk = item
+        # collect the telemetry of every call for the item, so a retry after an invalid output is paid for too
+        calls = []
+        telemetry.task_records_var.set(calls)
+        output, _, headers = await openai_prompt_engine_func.async_get_validated_output(
+            chunk['text'], openai_prompt_engine_func.metric_custom_functions, temperature, engine)
+        return (output, calls), headers
+
+    def write_transcript(path):
+        df = pd.DataFrame(transcripts[path])
+        df['output'] = outputs[path]
+        df_output = openai_prompt_engine_func.outputs_to_frame(df)
+        out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '.json')
+        df_output.to_json(out_path, orient='records', lines=True)
+        analytics.save_dashboard_files(df_output, out_path)
+        # each transcript is added to the store as soon as it finishes
+        store.replace(df_output, transcript=os.path.splitext(os.path.basename(path))[0])
+
+    def on_result(position, result):
+        path, index, _ = items[position]
+        output, calls = result
+        outputs[path][index] = output
+        transcript_stats = stats[path]
+        # cached responses cost nothing
+        if all(call['cached'] for call in calls):
+            transcript_stats['cached'] += 1
+        for call in calls:
+            transcript_stats['prompt_tokens'] += call['prompt_tokens']
+            transcript_stats['completion_tokens'] += call['completion_tokens']
+            transcript_stats['cost_usd'] += call['cost_usd']
+        transcript_stats['remaining'] -= 1
+        if transcript_stats['remaining'] == 0:
+            transcript_stats['seconds'] = time.monotonic() - started
+            write_transcript(path)
+
+    telemetry_mark = telemetry.get_telemetry().mark()
+    async_engine.run_fetch_list(items, process_item, limiter=async_engine.get_limiter(engine), on_result=on_result)
+
+    # transcripts with no chunks never get a result, so write them here
+    for path, transcript_stats in stats.items():
+        if transcript_stats['chunks'] == 0:
+            print(f"{path} has no text to process; writing an empty output")
+            transcript_stats['seconds'] = 0.0
+            write_transcript(path)
+
+    total_seconds = time.monotonic() - started
+    for transcript_stats in stats.values():
+        del transcript_stats['remaining']
+    summary = {
+        'engine': engine,
+        'transcripts': len(paths),
+        'chunks': len(items),
+        'preprocess_seconds': preprocess_seconds,
+        'total_seconds': total_seconds,
+        'chunks_per_second': len(items) / total_seconds if total_seconds else 0.0,
+        'prompt_tokens': sum(s['prompt_tokens'] for s in stats.values()),
+        'completion_tokens': sum(s['completion_tokens'] for s in stats.values()),
+        'cost_usd': sum(s['cost_usd'] for s in stats.values()),
+        'per_transcript': stats,
+        'telemetry': telemetry.get_telemetry().summary(since=telemetry_mark, transcripts=len(paths)),
+    }
+    with open(os.path.join(out_dir, 'summary.json'), 'w', encoding='UTF-8') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def print_summary(summary: dict):
+    """
+    Prints a per-transcript and overall throughput and cost table.
+    """
+    print(f"\n{'transcript':40} {'chunks':>7} {'cached':>7} {'seconds':>9} {'tokens':>10} {'cost $':>9}")
+    for path, stats in summary['per_transcript'].items():
+        tokens = stats['prompt_tokens'] + stats['completion_tokens']
+        print(f"{os.path.basename(path)[:40]:40} {stats['chunks']:7d} {stats['cached']:7d} "
+              f"{stats['seconds']:9.1f} {tokens:10d} {stats['cost_usd']:9.3f}")
+    print(f"\n{summary['transcripts']} transcripts, {summary['chunks']} chunks in {summary['total_seconds']:.1f}s "
+          f"({summary['chunks_per_second']:.2f} chunks/s, preprocessing {summary['preprocess_seconds']:.1f}s), "
+          f"estimated cost ${summary['cost_usd']:.2f}")
+    latency = summary['telemetry']
+    if latency['calls']:
+        print(f"API latency p50 {latency['latency_p50'] or 0:.2f}s p95 {latency['latency_p95'] or 0:.2f}s "
+              f"p99 {latency['latency_p99'] or 0:.2f}s, {latency['retries']} retries, {latency['errors']} errors, "
+              f"${latency['cost_usd_per_transcript']:.3f}/transcript")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('patterns', nargs='+', help='glob patterns of transcripts to process (quote them)')
+    parser.add_argument('--out-dir', default='data/final/batch', help='directory for the output files')
+    parser.add_argument('--source', choices=['YT', 'TEAMS'], help='transcript source (default: from extension)')
+    parser.add_argument('--chunksize', type=int, default=10, help='rows to roll up into one chunk')
+    parser.add_argument('--chunk-tokens', type=int, help='chunk to this many tokens instead of --chunksize rows')
+    parser.add_argument('--workers', type=int, help='preprocessing processes (default: CPU count)')
+    parser.add_argument('--temperature', type=float, default=0.0, help='temperature for the chat api')
+    parser.add_argument('--engine', default='gpt-4-turbo-preview', help='model for the chat api')
+    args = parser.parse_args()
+
+    paths = expand_patterns(args.patterns)
+    if not paths:
+        parser.error('no files match the given patterns')
+
+    summary = run_batch(paths, args.out_dir, source=args.source, chunksize=args.chunksize,
+                        chunk_tokens=args.chunk_tokens, workers=args.workers,
+                        temperature=args.temperature, engine=args.engine)
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
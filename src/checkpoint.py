@@ -0,0 +1,135 @@
+"""
+Append-only JSONL checkpoints for long prompt runs. Each finished chunk's
+result is written (and fsynced) as soon as it completes, keyed by the row
+index of the input DataFrame, so a crashed or rate-limited run can be
+restarted and only the remaining rows are sent.
+
+Each result is stored with a hash of the request that produced it (the
+response cache key), and is only reused for a row whose request still has
+that hash, so editing a chunk's text re-sends it. The first line records the
+run settings, including the function schema; resuming with different settings
+raises, rather than silently mixing outputs from two configurations. The log
+is removed once every row has completed.
+"""
+
+import json
+import os
+
+
+class CheckpointLog:
+    """
+    A JSONL log of `{"index": ..., "key": ..., "result": ...}` lines, preceded by a `{"meta": ...}` line.
+    """
+
+    def __init__(self, path: str, meta: dict | None = None):
+        """
+        Args:
+            path (str): the checkpoint file, created if it doesn't exist
+            meta (dict): the run settings (e.g. engine, temperature and function schema) that a resumed
+            run must match
+        """
+        self.path = path
+        self.meta = meta or {}
+        self._file = None
+
+    def load(self) -> dict:
+        """
+        Returns the results completed so far, keyed by the string form of the row index, as
+        `{"key": request hash, "result": ...}` dicts. A partially written last line, left by a
+        crash mid-write, is ignored.
+        """
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                if 'meta' in record:
+                    if record['meta'] != self.meta:
+                        raise ValueError(
+                            f"Checkpoint {self.path} was written with {record['meta']}, not {self.meta}. "
+                            "Delete it to start a fresh run.")
+                    continue
+                done[str(record['index'])] = {'key': record.get('key'), 'result': record['result']}
+        return done
+
+    def append(self, index, key: str | None, result):
+        """
+        Writes one completed result and flushes it to disk.
+        Args:
+            index: the row index of the result
+            key (str): the hash of the request the result is for
+            result: the JSON-serialisable result
+        """
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, 'a', encoding='UTF-8')
+            if is_new:
+                self._file.write(json.dumps({'meta': self.meta}) + '\n')
+        self._file.write(json.dumps({'index': str(index), 'key': key, 'result': result}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Closes the checkpoint file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def complete(self):
+        """
+        Removes the checkpoint once a run has finished, so that a later run with the same path
+        starts afresh rather than resuming from it. Re-runs are still cheap through the response cache.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch_with_checkpoint(index: list, items: list, fetch_fn, checkpoint: CheckpointLog | None,
+                          keys: list[str] | None = None) -> list:
+    """
+    Returns a result for every item, taking those already in the checkpoint from it and
+    fetching only the remainder. Each newly fetched result is appended to the checkpoint
+    as soon as it completes, and the checkpoint is removed once every item has a result.
+    Args:
+        index (list): the row index of each item, used as the checkpoint key
+        items (list): the items to process
+        fetch_fn (callable): takes (items, on_result) and returns the results in order, calling
+        on_result(position, result) as each one completes, e.g. a wrapped `parallel_fetch_list`
+        checkpoint (CheckpointLog): the checkpoint to resume from, or None to fetch everything
+        keys (list[str]): the hash of each item's request, e.g. `response_cache.request_cache_key`. A
+        checkpointed result is only reused if it was stored with the same hash.
+    Returns:
+        list: the results, in the same order as `items`
+    """
+    if checkpoint is None:
+        return fetch_fn(items, None)
+    if keys is None:
+        keys = [None] * len(items)
+
+    key_by_row = {str(row): key for row, key in zip(index, keys)}
+    done = {row: record['result'] for row, record in checkpoint.load().items()
+            if row in key_by_row and record['key'] == key_by_row[row]}
+    pending = [position for position, row in enumerate(index) if str(row) not in done]
+    if done:
+        print(f"Resuming from checkpoint: {len(done)} rows done, {len(pending)} to run")
+
+    def save(position, result):
+        checkpoint.append(index[pending[position]], keys[pending[position]], result)
+
+    try:
+        results = fetch_fn([items[position] for position in pending], save)
+    finally:
+        checkpoint.close()
+
+    for position, result in zip(pending, results):
+        done[str(index[position])] = result
+    checkpoint.complete()
+    return [done[str(row)] for row in index]
@@ -0,0 +1,128 @@
+"""
+Token-aware chunking of transcript captions. Rather than rolling up a fixed
+number of caption lines, captions are packed into chunks up to a token
+budget, so that every request carries a similar amount of text: short
+chunks don't waste per-request overhead and long ones don't hit the reply's
+max_tokens and get truncated.
+"""
+
+from utils.tokens import count_tokens
+
+SENTENCE_ENDINGS = ('.', '?', '!')
+BOUNDARIES = (None, "sentence", "speaker")
+
+
+def speaker_text(text: str, speaker: str | None) -> str:
+    """
+    Returns a caption's text prefixed with its speaker, e.g. "Jane Smith: So I think...", so that
+    the model can tell who said what. Captions without a speaker are returned as they are.
+    """
+    return text if speaker is None else f"{speaker}: {text}"
+
+
+def _is_boundary(buffer: list, position: int, boundary: str | None) -> bool:
+    """
+    Returns True if a chunk may end after `buffer[position]` under the given boundary rule.
+    """
+    row = buffer[position][0]
+    if boundary == "sentence":
+        return row['text'].rstrip().endswith(SENTENCE_ENDINGS)
+    if boundary == "speaker":
+        return position + 1 < len(buffer) and buffer[position + 1][0].get('speaker') != row.get('speaker')
+    return False
+
+
+def _find_cut(buffer: list, boundary: str | None, max_tokens: int, min_fill: float) -> int:
+    """
+    Returns how many rows of the buffer to emit as the next chunk: the longest prefix that
+    ends on a boundary and holds at least `min_fill` of the budget, or the whole buffer if
+    there isn't one.
+    """
+    if boundary is None:
+        return len(buffer)
+    prefix_tokens = [0]
+    for _, tokens, _ in buffer:
+        prefix_tokens.append(prefix_tokens[-1] + tokens)
+    for position in range(len(buffer) - 2, -1, -1):
+        if prefix_tokens[position + 1] < min_fill * max_tokens:
+            break
+        has_new_rows = any(not context for _, _, context in buffer[:position + 1])
+        if has_new_rows and _is_boundary(buffer, position, boundary):
+            return position + 1
+    return len(buffer)
+
+
+def _overlap(emitted: list, overlap_tokens: int) -> list:
+    """
+    Returns the trailing rows of an emitted chunk that fit in `overlap_tokens`, marked as context.
+    """
+    overlap = []
+    total = 0
+    for row, tokens, _ in reversed(emitted):
+        if total + tokens > overlap_tokens:
+            break
+        overlap.insert(0, (row, tokens, True))
+        total += tokens
+    return overlap
+
+
+def _make_chunk(buffer: list) -> dict:
+    """
+    Joins the rows of a chunk. The timestamp is that of the first row not carried over as overlap.
+    If the rows have speakers, each row's text is labelled with its speaker and the chunk lists them.
+    """
+    first_new_row = next(row for row, _, context in buffer if not context)
+    text = ' '.join(speaker_text(row['text'], row.get('speaker')) for row, _, _ in buffer)
+    chunk = {'timestamp': first_new_row['timestamp'], 'text': text}
+    if 'speaker' in first_new_row:
+        # the distinct speakers in the chunk, in order of first appearance
+        speakers = (row.get('speaker') for row, _, _ in buffer)
+        chunk['speakers'] = list(dict.fromkeys(speaker for speaker in speakers if speaker is not None))
+    return chunk
+
+
+def chunk_by_tokens(rows, max_tokens: int = 400, overlap_tokens: int = 0, boundary: str | None = None,
+                    min_fill: float = 0.5, model: str = "gpt-4-turbo-preview"):
+    """
+    Lazily packs caption rows into chunks of at most `max_tokens` tokens, including any overlap
+    context. A single row longer than the budget becomes a chunk on its own; rows are never split.
+    Args:
+        rows (iterable): dicts with 'timestamp' and 'text', and 'speaker' for speaker boundaries
+        max_tokens (int): the token budget per chunk
+        overlap_tokens (int): up to this many tokens of trailing rows from each chunk are repeated
+        at the start of the next one as context. The next chunk's timestamp is still its first new row.
+        Context rows are dropped, oldest first, where they would take the chunk over `max_tokens`.
+        boundary (str): None to fill every chunk up to the budget, "sentence" to prefer ending chunks
+        after a caption ending in . ? or !, or "speaker" to prefer ending chunks where the speaker changes
+        min_fill (float): the fraction of the budget a chunk must reach before it is cut at a boundary
+        model (str): the model whose tokenizer to use
+    Yields:
+        dict: the chunk's timestamp and text, and its speakers if the rows have them, in which case
+        each row's text is prefixed with "Speaker: "
+    """
+    if max_tokens < 1:
+        raise ValueError('max_tokens must be greater than 0')
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError('overlap_tokens must be at least 0 and less than max_tokens')
+    if boundary not in BOUNDARIES:
+        raise ValueError(f"boundary must be one of {BOUNDARIES}")
+
+    # each entry is (row, tokens, is_overlap_context)
+    buffer = []
+    for row in rows:
+        # +1 for the space the row is joined with
+        tokens = count_tokens(speaker_text(row['text'], row.get('speaker')), model) + 1
+        while True:
+            # overlap context gives way to new rows, so that it never takes a chunk over the budget
+            while buffer and buffer[0][2] and sum(entry[1] for entry in buffer) + tokens > max_tokens:
+                buffer.pop(0)
+            if not (buffer and sum(entry[1] for entry in buffer) + tokens > max_tokens
+                    and any(not context for _, _, context in buffer)):
+                break
+            cut = _find_cut(buffer, boundary, max_tokens, min_fill)
+            yield _make_chunk(buffer[:cut])
+            buffer = _overlap(buffer[:cut], overlap_tokens) + buffer[cut:]
+        buffer.append((row, tokens, False))
+
+    if any(not context for _, _, context in buffer):
+        yield _make_chunk(buffer)
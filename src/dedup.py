@@ -0,0 +1,143 @@
+"""
+Near-duplicate detection for transcript chunks, so that repeated text (greetings,
+"can you hear me", recaps, boilerplate shared across a recurring meeting series)
+is only sent to the LLM once. Chunks are first compared with MinHash signatures
+over word shingles, bucketed with locality-sensitive hashing so that only likely
+pairs are checked. Optionally, the remaining representatives are then compared by
+embedding cosine similarity to catch paraphrases.
+
+Each chunk is mapped to a representative: the first chunk of its cluster. Every
+member of a cluster is similar to its representative, not just to some other member.
+"""
+
+import zlib
+from collections import defaultdict
+
+import numpy as np
+import regex as re
+
+# a Mersenne prime, small enough that a * x + b never overflows uint64 for 32-bit hashes
+MERSENNE_PRIME = (1 << 31) - 1
+WORD_PATTERN = re.compile(r"[\p{L}\p{N}']+")
+
+
+def shingles(text: str, size: int = 3) -> set[int]:
+    """
+    Returns the hashed word shingles of a text, ignoring case and punctuation. Texts shorter
+    than `size` words are a single shingle.
+    Args:
+        text (str): the text to shingle
+        size (int): the number of words per shingle
+    Returns:
+        set[int]: the crc32 hashes of the shingles
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))}
+    return {zlib.crc32(' '.join(words[i:i + size]).encode('utf-8')) for i in range(len(words) - size + 1)}
+
+
+def minhash_signatures(texts: list[str], num_perm: int = 128, shingle_size: int = 3,
+                       seed: int = 42) -> np.ndarray:
+    """
+    Returns a MinHash signature per text. The fraction of positions on which two signatures
+    agree estimates the Jaccard similarity of the texts' shingle sets.
+    Args:
+        texts (list[str]): the texts
+        num_perm (int): the number of hash permutations, i.e. the signature length
+        shingle_size (int): the number of words per shingle
+        seed (int): the seed for the permutations
+    Returns:
+        np.ndarray: a (len(texts), num_perm) uint64 array
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for row, text in enumerate(texts):
+        hashes = np.fromiter(shingles(text, shingle_size), dtype=np.uint64) % MERSENNE_PRIME
+        signatures[row] = ((np.outer(hashes, a) + b) % MERSENNE_PRIME).min(axis=0)
+    return signatures
+
+
+def _candidate_pairs(signatures: np.ndarray, bands: int) -> dict[int, set[int]]:
+    """
+    Returns, for each row, the later rows that share at least one LSH band with it.
+    """
+    rows_per_band = signatures.shape[1] // bands
+    candidates = defaultdict(set)
+    for band in range(bands):
+        buckets = defaultdict(list)
+        band_values = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        for row, values in enumerate(band_values):
+            buckets[values.tobytes()].append(row)
+        for members in buckets.values():
+            for position, row in enumerate(members):
+                candidates[row].update(members[position + 1:])
+    return candidates
+
+
+def _leader_clusters(num_items: int, neighbours) -> np.ndarray:
+    """
+    Assigns each item to the first earlier unassigned item it is similar to, in order.
+    `neighbours(i)` returns the later items similar to item i.
+    """
+    representative = np.full(num_items, -1, dtype=np.int64)
+    for leader in range(num_items):
+        if representative[leader] != -1:
+            continue
+        representative[leader] = leader
+        for member in neighbours(leader):
+            if representative[member] == -1:
+                representative[member] = leader
+    return representative
+
+
+def find_near_duplicates(texts: list[str], threshold: float = 0.8, num_perm: int = 128, bands: int = 32,
+                         shingle_size: int = 3, embed_fn=None, embedding_threshold: float = 0.95) -> np.ndarray:
+    """
+    Clusters near-duplicate texts and returns the position of each text's representative.
+    Args:
+        texts (list[str]): the texts to deduplicate
+        threshold (float): the estimated Jaccard similarity of word shingles at which texts are duplicates
+        num_perm (int): the MinHash signature length
+        bands (int): the number of LSH bands; more bands find more candidate pairs at lower similarity
+        shingle_size (int): the number of words per shingle
+        embed_fn (callable): if given, a function from a list of texts to an embedding matrix, used to
+        merge the representatives left after the MinHash stage whose cosine similarity is at least
+        `embedding_threshold`
+        embedding_threshold (float): the cosine similarity at which embedded texts are duplicates
+    Returns:
+        np.ndarray: for each text, the position of the text whose result it can reuse (itself if unique)
+    """
+    if not texts:
+        return np.empty(0, dtype=np.int64)
+    if num_perm % bands:
+        raise ValueError('num_perm must be a multiple of bands')
+
+    signatures = minhash_signatures(texts, num_perm=num_perm, shingle_size=shingle_size)
+    candidates = _candidate_pairs(signatures, bands)
+
+    def minhash_neighbours(row):
+        later = sorted(candidates.get(row, ()))
+        if not later:
+            return []
+        similarity = (signatures[later] == signatures[row]).mean(axis=1)
+        return [other for other, value in zip(later, similarity) if value >= threshold]
+
+    representative = _leader_clusters(len(texts), minhash_neighbours)
+
+    if embed_fn is not None:
+        leaders = np.flatnonzero(representative == np.arange(len(texts)))
+        embeddings = np.asarray(embed_fn([texts[i] for i in leaders]), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+        similarity = embeddings @ embeddings.T
+
+        def embedding_neighbours(position):
+            later = np.flatnonzero(similarity[position, position + 1:] >= embedding_threshold)
+            return list(later + position + 1)
+
+        leader_representative = leaders[_leader_clusters(len(leaders), embedding_neighbours)]
+        representative = leader_representative[np.searchsorted(leaders, representative)]
+
+    return representative
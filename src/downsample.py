@@ -0,0 +1,81 @@
+"""
+Level-of-detail downsampling for the dashboard's timeline chart. A chart can't
+show more points than it has pixels across, so long transcripts are reduced to
+about one point per pixel with Largest-Triangle-Three-Buckets (LTTB), which
+keeps the peaks and troughs a plain stride would skip. The dashboard resamples
+whenever the visible time range changes, so zooming in brings back the detail.
+
+See Steinarsson, "Downsampling Time Series for Visual Representation" (2013).
+"""
+
+import numpy as np
+import pandas as pd
+
+# about one point per pixel across the dashboard's chart
+DEFAULT_MAX_POINTS = 700
+# the short columns worth showing on hover; the full text is in the table
+TOOLTIP_COLUMNS = ['timecode_text', 'topic']
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Chooses the points of a series to keep with Largest-Triangle-Three-Buckets.
+    Args:
+        x (np.ndarray): the increasing x values
+        y (np.ndarray): the y values, without NaNs
+        threshold (int): the number of points to keep
+    Returns:
+        np.ndarray: the positions of the points to keep, in order, always including the first and last
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # the points between the first and last are split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_x = x[end:edges[bucket + 2]].mean()
+            next_y = y[end:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        # keep the point making the largest triangle with the previous kept point and the next bucket's mean
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_timeline(data_frame: pd.DataFrame, columns: list[str],
+                        max_points: int = DEFAULT_MAX_POINTS) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Reduces the rows of a transcript output to what the timeline chart can show.
+    Args:
+        data_frame (pd.DataFrame): the rows in the visible time range, with 'timestamp' and `columns`
+        columns (list[str]): the columns to plot
+        max_points (int): the number of points to keep per line
+    Returns:
+        tuple: the lines in long format ('timestamp', 'column', 'value'), each downsampled on its own
+        values, and up to `max_points` evenly spaced rows for the hover tooltips, with only the
+        timestamp, `TOOLTIP_COLUMNS` and `columns`
+    """
+    x = data_frame['timestamp'].to_numpy(dtype=np.float64)
+    lines = []
+    for column in columns:
+        y = data_frame[column].to_numpy(dtype=np.float64)
+        # rolling averages start with NaNs, which LTTB can't compare
+        valid = np.flatnonzero(~np.isnan(y))
+        keep = valid[lttb_indices(x[valid], y[valid], max_points)]
+        lines.append(pd.DataFrame({'timestamp': x[keep], 'column': column, 'value': y[keep]}))
+    lines = pd.concat(lines, ignore_index=True) if lines else pd.DataFrame(columns=['timestamp', 'column', 'value'])
+
+    hover_rows = np.unique(np.linspace(0, len(data_frame) - 1, min(max_points, len(data_frame))).astype(np.int64))
+    tooltip_columns = ['timestamp'] + [c for c in TOOLTIP_COLUMNS if c in data_frame.columns] + list(columns)
+    hover = data_frame.iloc[hover_rows][tooltip_columns].round(2).reset_index(drop=True)
+    return lines, hover
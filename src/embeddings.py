@@ -0,0 +1,279 @@
+"""
+Batched, cached text embeddings. Texts are sent in as few requests as the API
+allows (up to MAX_BATCH_INPUTS inputs and MAX_BATCH_TOKENS tokens per call),
+and every vector is cached on disk by a hash of its text, so re-running over a
+transcript only embeds new chunks.
+
+The cache is a raw file of float32 rows, which is memory-mapped when read,
+plus a text file of the sha256 hashes of its rows, one per line, and a JSON
+file recording the vectors' dimensions. New vectors are appended to the end
+of both files, so adding to the cache costs the same however large it grows.
+
+Run from the project root to embed the processed transcript:
+    python src/embeddings.py
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import openai
+import pandas as pd
+from dotenv import load_dotenv
+
+import rate_limiter
+import telemetry
+from utils.common import atomic_write
+from utils.tokens import count_tokens
+
+load_dotenv()
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# the maximum for text-embedding-ada-002 is 8191
+MAX_TOKENS = 8000
+# the API's limits on the inputs and total tokens in one embeddings request
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 300_000
+DEFAULT_STORE_DIR = "data/cache/embeddings"
+
+
+def text_hash(text: str) -> str:
+    """
+    Returns the cache key for a text.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    An append-only on-disk cache of embedding vectors keyed by text hash, one per model.
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIR, model: str = EMBEDDING_MODEL):
+        """
+        Args:
+            directory (str): the directory holding the cache files
+            model (str): the embedding model, which names the cache files
+        """
+        self.vectors_path = os.path.join(directory, f"{model}.f32")
+        self.keys_path = os.path.join(directory, f"{model}.keys.txt")
+        self.meta_path = os.path.join(directory, f"{model}.meta.json")
+        self.keys = {}
+        self.matrix = None
+        self.dimensions = None
+        legacy_path = os.path.join(directory, f"{model}.npy")
+        if os.path.exists(legacy_path) and not os.path.exists(self.meta_path):
+            self._migrate(legacy_path)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='UTF-8') as f:
+                self.dimensions = json.load(f)['dimensions']
+            self._load()
+
+    def _load(self):
+        """
+        Maps the rows saved so far. Both files are only ever appended to, so if an add was
+        interrupted between writing them, their common prefix is still consistent; anything past
+        it is cut off, so that the next add lines up again.
+        """
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'r', encoding='UTF-8') as f:
+                # a last line without a newline was cut off mid-write
+                keys = f.read().split('\n')[:-1]
+        row_bytes = self.dimensions * np.dtype(np.float32).itemsize
+        vector_bytes = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        rows = min(len(keys), vector_bytes // row_bytes)
+        if vector_bytes != rows * row_bytes:
+            os.truncate(self.vectors_path, rows * row_bytes)
+        key_bytes = sum(len(key) + 1 for key in keys[:rows])
+        if os.path.exists(self.keys_path) and os.path.getsize(self.keys_path) != key_bytes:
+            os.truncate(self.keys_path, key_bytes)
+        self.keys = {key: row for row, key in enumerate(keys[:rows])}
+        # an empty file can't be memory-mapped
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                shape=(rows, self.dimensions)) if rows else None
+
+    def _migrate(self, legacy_path: str):
+        """
+        Converts a cache saved as a .npy matrix by earlier versions to the appendable format.
+        """
+        matrix = np.load(legacy_path, mmap_mode='r')
+        with open(self.keys_path, 'r', encoding='UTF-8') as f:
+            keys = [line.strip() for line in f if line.strip()]
+        rows = min(len(keys), len(matrix))
+        with open(self.vectors_path, 'wb') as f:
+            f.write(np.ascontiguousarray(matrix[:rows], dtype=np.float32).tobytes())
+        with open(self.keys_path, 'w', encoding='UTF-8') as f:
+            f.writelines(f"{key}\n" for key in keys[:rows])
+        self._save_meta(matrix.shape[1])
+        os.remove(legacy_path)
+
+    def _save_meta(self, dimensions: int):
+        """
+        Records the vectors' dimensions, which the raw vectors file doesn't.
+        """
+        self.dimensions = dimensions
+        with atomic_write(self.meta_path, 'w', encoding='UTF-8') as f:
+            json.dump({'dimensions': dimensions}, f)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key: str) -> np.ndarray | None:
+        """
+        Returns the cached vector for a text hash, or None.
+        """
+        row = self.keys.get(key)
+        return None if row is None else self.matrix[row]
+
+    def add(self, keys: list[str], vectors: np.ndarray):
+        """
+        Appends vectors to the cache files. Keys already in the cache are skipped.
+        Args:
+            keys (list[str]): the text hashes
+            vectors (np.ndarray): the vectors, one row per key
+        """
+        seen = set()
+        new_rows = []
+        for row, key in enumerate(keys):
+            if key not in self.keys and key not in seen:
+                seen.add(key)
+                new_rows.append(row)
+        if not new_rows:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)[new_rows]
+        if self.dimensions is None:
+            os.makedirs(os.path.dirname(self.meta_path) or '.', exist_ok=True)
+            self._save_meta(vectors.shape[1])
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Expected vectors of {self.dimensions} dimensions, got {vectors.shape[1]}")
+
+        # the vectors go first, so a key is never saved without its vector
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.keys_path, 'a', encoding='UTF-8') as f:
+            f.writelines(f"{keys[row]}\n" for row in new_rows)
+
+        for row in new_rows:
+            self.keys[keys[row]] = len(self.keys)
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                shape=(len(self.keys), self.dimensions))
+
+
+_stores = {}
+
+
+def get_embedding_store(model: str = EMBEDDING_MODEL) -> EmbeddingStore:
+    """
+    Returns the shared embedding cache for a model.
+    """
+    if model not in _stores:
+        _stores[model] = EmbeddingStore(os.getenv("OPENAI_EMBEDDING_CACHE_DIR", DEFAULT_STORE_DIR), model)
+    return _stores[model]
+
+
+def iter_batches(token_counts: list[int], max_inputs: int = MAX_BATCH_INPUTS,
+                 max_tokens: int = MAX_BATCH_TOKENS):
+    """
+    Yields lists of positions of texts that fit together in one embeddings request.
+    """
+    batch = []
+    batch_tokens = 0
+    for position, tokens in enumerate(token_counts):
+        if batch and (len(batch) == max_inputs or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(position)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def request_embeddings(client, texts: list[str], model: str = EMBEDDING_MODEL,
+                       token_counts: list[int] | None = None) -> np.ndarray:
+    """
+    Embeds texts with as few API calls as possible, respecting the shared rate limiter.
+    Args:
+        client (openai.Client): the OpenAI client
+        texts (list[str]): the texts, each within the model's token limit
+        model (str): the embedding model
+        token_counts (list[int]): the token count of each text, if already known
+    Returns:
+        np.ndarray: a (len(texts), dimensions) float32 matrix
+    """
+    if token_counts is None:
+        token_counts = [count_tokens(text, model) for text in texts]
+    limiter = rate_limiter.get_rate_limiter()
+    vectors = [None] * len(texts)
+    for batch in iter_batches(token_counts):
+        reserved_tokens = sum(token_counts[i] for i in batch)
+        wait_started = time.monotonic()
+        limiter.acquire(model, reserved_tokens)
+        try:
+            with telemetry.get_telemetry().track(model, "embeddings", time.monotonic() - wait_started) as call:
+                response = client.embeddings.create(model=model, input=[texts[i] for i in batch])
+                call.update(usage=response.usage, inputs=len(batch))
+        except Exception:
+            limiter.release(model, reserved_tokens)
+            raise
+        limiter.reconcile(model, reserved_tokens, response.usage.total_tokens)
+        for item in response.data:
+            vectors[batch[item.index]] = item.embedding
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def embed_texts(texts: list[str], model: str = EMBEDDING_MODEL, store: EmbeddingStore | None = None,
+                max_tokens: int = MAX_TOKENS) -> np.ndarray:
+    """
+    Returns an embedding per text, using cached vectors where possible. Texts over `max_tokens`
+    are skipped and get a zero vector, which has no similarity to anything.
+    Args:
+        texts (list[str]): the texts to embed
+        model (str): the embedding model
+        store (EmbeddingStore): the cache to use, defaulting to the shared one for the model
+        max_tokens (int): texts with more tokens than this are not embedded
+    Returns:
+        np.ndarray: a (len(texts), dimensions) float32 matrix
+    """
+    store = store if store is not None else get_embedding_store(model)
+    keys = [text_hash(text) for text in texts]
+
+    missing = {}
+    skipped = 0
+    for position, (text, key) in enumerate(zip(texts, keys)):
+        if store.get(key) is not None or key in missing:
+            continue
+        tokens = count_tokens(text, model)
+        if tokens > max_tokens:
+            skipped += 1
+            continue
+        missing[key] = (position, tokens)
+    if skipped:
+        print(f"Skipped {skipped} texts over {max_tokens} tokens")
+
+    if missing:
+        positions = [position for position, _ in missing.values()]
+        vectors = request_embeddings(openai.Client(), [texts[i] for i in positions], model,
+                                     [tokens for _, tokens in missing.values()])
+        store.add(list(missing), vectors)
+
+    if len(store) == 0:
+        # nothing could be embedded, so the dimension is unknown
+        return np.zeros((len(texts), 0), dtype=np.float32)
+    matrix = np.zeros((len(texts), store.matrix.shape[1]), dtype=np.float32)
+    for position, key in enumerate(keys):
+        vector = store.get(key)
+        if vector is not None:
+            matrix[position] = vector
+    return matrix
+
+
+if __name__ == "__main__":
+    datafile_path = "data/intermediate/processed.json"
+    df = pd.read_json(datafile_path, orient="records", lines=True)
+    matrix = embed_texts(list(df.text))
+    # rows of the matrix line up with the rows of the processed file
+    np.save("data/intermediate/processed_embeddings.npy", matrix)
+    print(f"Saved {matrix.shape} embeddings to data/intermediate/processed_embeddings.npy")
@@ -0,0 +1,146 @@
+"""
+Incremental parsing of a JSON object as it streams in, so that each top-level
+field can be used as soon as its value is complete rather than when the whole
+object is. Function call arguments arrive this way when a chat completion is
+streamed, and short fields like `topic` and `sentiment` finish well before the
+long `parsed` text.
+
+    parser = IncrementalObjectParser()
+    for delta in deltas:
+        for name, value in parser.feed(delta):
+            ...
+"""
+
+import json
+
+WHITESPACE = ' \t\r\n'
+SCALAR_END = ',}' + WHITESPACE
+
+
+class IncrementalObjectParser:
+    """
+    Yields the top-level fields of a streamed JSON object as each one completes. Nested values are
+    returned whole once they close. If the text stops being valid JSON, no further fields are
+    returned; the complete text should still be validated once it has all arrived.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.stage = 'start'
+        self.key = None
+        # the state of the scan for the end of the current key or value, which may span feeds
+        self.scan = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    @property
+    def done(self) -> bool:
+        """
+        True once the closing brace of the object has been read.
+        """
+        return self.stage == 'done'
+
+    def feed(self, delta: str) -> list[tuple[str, object]]:
+        """
+        Adds the next piece of text and returns the (name, value) fields it completed, in order.
+        """
+        self.buffer += delta
+        fields = []
+        while self.stage not in ('done', 'invalid'):
+            self._skip_whitespace()
+            if self.position >= len(self.buffer):
+                break
+            char = self.buffer[self.position]
+            if self.stage == 'start':
+                self._expect(char == '{', 'key')
+            elif self.stage == 'key':
+                if char == '}':
+                    self._expect(True, 'done')
+                    continue
+                end = self._token_end() if char == '"' else self._fail()
+                if end is None:
+                    break
+                self.key = json.loads(self.buffer[self.position:end])
+                self.position = end
+                self.stage = 'colon'
+            elif self.stage == 'colon':
+                self._expect(char == ':', 'value')
+            elif self.stage == 'value':
+                end = self._token_end()
+                if end is None:
+                    break
+                try:
+                    value = json.loads(self.buffer[self.position:end], strict=False)
+                except json.decoder.JSONDecodeError:
+                    self._fail()
+                    break
+                fields.append((self.key, value))
+                self.position = end
+                self.stage = 'next'
+            elif self.stage == 'next':
+                if char == ',':
+                    self._expect(True, 'key')
+                else:
+                    self._expect(char == '}', 'done')
+        return fields
+
+    def _skip_whitespace(self):
+        while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+            self.position += 1
+
+    def _expect(self, matched: bool, next_stage: str):
+        if matched:
+            self.position += 1
+            self.stage = next_stage
+        else:
+            self._fail()
+
+    def _fail(self):
+        self.stage = 'invalid'
+        return None
+
+    def _token_end(self) -> int | None:
+        """
+        Returns the index just past the string, nested value or scalar at the current position, or
+        None if it isn't complete yet. How far the scan got, and whether it is inside a string or
+        after a backslash, is kept between feeds, so a long value is only scanned once in total.
+        """
+        if self.scan is None:
+            self.scan = self.position
+            self.depth = 0
+            self.in_string = False
+            self.escaped = False
+        is_scalar = self.buffer[self.position] not in '"{['
+        position = self.scan
+        while position < len(self.buffer):
+            char = self.buffer[position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 0:
+                        return self._end_scan(position + 1)
+            elif is_scalar:
+                # numbers, true, false and null end at the next delimiter, which may not have arrived yet
+                if char in SCALAR_END:
+                    return self._end_scan(position)
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    return self._end_scan(position + 1)
+            position += 1
+        self.scan = position
+        return None
+
+    def _end_scan(self, end: int) -> int:
+        self.scan = None
+        return end
@@ -4,9 +4,15 @@ on a text file. Import TextFile class from src/refactor.py to read the text
 file and return a dataframe with timestamp and text.
 """
 
+import argparse
+import datetime
+
 import pandas as pd
+import analytics
 import openai_prompt_engine_func
-from preprocess import VideoTranscript
+from preprocess import VideoTranscript, stream_transcript_chunks
+
+TRANSCRIPT_NAME = 'HMRC DALAS Transcript'
 
 
 def run_text_processing_HMRC():
@@ -18,20 +24,65 @@ def run_text_processing_HMRC():
     text_file.save_data_frame('data/intermediate/processed.json')
 
 
-def run_transcript_processing_HMRC():
+def run_transcript_processing_HMRC(export_excel: bool = False):
     """
     Main function to run NLP analysis on a text file.
+    Args:
+        export_excel (bool): also export the results to data/final/output.xlsx
     """
     df = pd.read_json('data/intermediate/processed.json', orient='records', lines=True)
+    # results are checkpointed as they complete, so re-running after a failure resumes where it stopped
     df = openai_prompt_engine_func.run_prompts_transcript(
-        df, temperature=0.0, downsample=1.0)  # run with no downsample 
+        df, temperature=0.0, downsample=1.0,  # run with no downsample
+        checkpoint_path='data/intermediate/output.checkpoint.jsonl')
     df.to_json('data/final/output.json',
                orient='records', lines=True)
-    df.to_excel('data/final/output.xlsx',
-                sheet_name='Output', index=False)
+    # the dashboard loads these rather than parsing the JSON and recomputing its charts
+    analytics.save_dashboard_files(df, 'data/final/output.json')
+    save_outputs(df, export_excel)
+
+
+def run_streaming_HMRC(export_excel: bool = False):
+    """
+    Preprocesses and prompts in one pass: chunks are sent to the API as they are read
+    from the raw transcript, without the intermediate processed.json file.
+    Args:
+        export_excel (bool): also export the results to data/final/output.xlsx
+    """
+    file_path = 'data/raw/HMRC DALAS Transcript Raw.txt'
+    chunks = stream_transcript_chunks(file_path, chunksize=10)
+    df = openai_prompt_engine_func.run_prompts_stream(
+        chunks, temperature=0.0, checkpoint_path='data/intermediate/output_stream.checkpoint.jsonl')
+    df.to_json('data/final/output.json',
+               orient='records', lines=True)
+    # the dashboard loads these rather than parsing the JSON and recomputing its charts
+    analytics.save_dashboard_files(df, 'data/final/output.json')
+    save_outputs(df, export_excel)
+
+
+def save_outputs(df: pd.DataFrame, export_excel: bool = False):
+    """
+    Stores the results in the partitioned Parquet output store, and optionally exports them to Excel,
+    which is slow for big corpora so is no longer done on every run.
+    """
+    import output_store
 
+    store = output_store.get_output_store()
+    date = datetime.date.today().isoformat()
+    store.replace(df, transcript=TRANSCRIPT_NAME, date=date)
+    if export_excel:
+        store.export_excel('data/final/output.xlsx', transcript=TRANSCRIPT_NAME, date=date)
 
 
 if __name__ == "__main__":
-    run_text_processing_HMRC()
-    run_transcript_processing_HMRC()
+    # the two-stage flow is the default, as embeddings.py and the engines' own entry points
+    # read the data/intermediate/processed.json it writes
+    parser = argparse.ArgumentParser(description="Run NLP analysis on the HMRC DALAS transcript.")
+    parser.add_argument('--stream', action='store_true',
+                        help="preprocess and prompt in one pass, without writing processed.json")
+    args = parser.parse_args()
+    if args.stream:
+        run_streaming_HMRC()
+    else:
+        run_text_processing_HMRC()
+        run_transcript_processing_HMRC()
@@ -0,0 +1,140 @@
+"""
+Submits chat completion requests through the OpenAI Batch API, which is half
+the price of the interactive endpoint and has separate, much higher quotas,
+in exchange for results arriving within 24 hours. Suited to overnight runs.
+
+The batch id is saved in the batch directory as soon as it is submitted, so
+if the process is stopped while waiting, running it again picks the same
+batch back up instead of paying for a new one.
+"""
+
+import json
+import os
+import time
+
+from openai.types.chat import ChatCompletion
+
+import telemetry
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def write_batch_file(requests: dict, path: str):
+    """
+    Writes requests to a batch input JSONL file.
+    Args:
+        requests (dict): custom_id -> keyword arguments for `chat.completions.create`
+        path (str): the file to write
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='UTF-8') as f:
+        for custom_id, body in requests.items():
+            f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + '\n')
+
+
+def submit_batch(client, path: str, metadata: dict | None = None):
+    """
+    Uploads a batch input file and starts the batch.
+    Args:
+        client (openai.Client): the client to use
+        path (str): the batch input JSONL file
+        metadata (dict): optional metadata to attach to the batch
+    Returns:
+        Batch: the created batch
+    """
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                 completion_window="24h", metadata=metadata)
+
+
+def wait_for_batch(client, batch_id: str, poll_interval: float = 60.0, timeout: float | None = None):
+    """
+    Polls a batch until it finishes.
+    Args:
+        client (openai.Client): the client to use
+        batch_id (str): the batch to wait for
+        poll_interval (float): seconds between status checks
+        timeout (float): seconds to wait before giving up, or None to wait indefinitely
+    Returns:
+        Batch: the finished batch
+    """
+    started = time.monotonic()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in FINAL_STATUSES:
+            return batch
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError(f"Batch {batch_id} still {batch.status} after {timeout} seconds")
+        counts = batch.request_counts
+        if counts is not None:
+            print(f"Batch {batch_id} {batch.status}: {counts.completed}/{counts.total} done, {counts.failed} failed")
+        time.sleep(poll_interval)
+
+
+def read_batch_results(client, batch, requests: dict | None = None) -> dict:
+    """
+    Downloads the output of a finished batch, recording each response's usage in the telemetry.
+    Args:
+        client (openai.Client): the client to use
+        batch (Batch): the finished batch
+        requests (dict): custom_id -> the request sent, whose model is used to price the response,
+        rather than the dated model version the response names
+    Returns:
+        dict: custom_id -> ChatCompletion, for the requests that succeeded
+    """
+    responses = {}
+    if batch.output_file_id is None:
+        return responses
+    content = client.files.content(batch.output_file_id).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        request = (requests or {}).get(record["custom_id"]) or {}
+        telemetry.get_telemetry().record(request.get("model") or body.get("model", "unknown"), "batch",
+                                         status=response.get("status_code") or "error",
+                                         usage=body.get("usage"), batch_id=batch.id)
+        if record.get("error") is None and response.get("status_code") == 200:
+            responses[record["custom_id"]] = ChatCompletion.model_validate(response["body"])
+    return responses
+
+
+def run_batch(client, requests: dict, batch_dir: str, poll_interval: float = 60.0,
+              timeout: float | None = None) -> dict:
+    """
+    Submits requests as a batch, waits for it to finish and returns the responses.
+    Args:
+        client (openai.Client): the client to use
+        requests (dict): custom_id -> keyword arguments for `chat.completions.create`
+        batch_dir (str): a directory for the batch input file and the saved batch id
+        poll_interval (float): seconds between status checks
+        timeout (float): seconds to wait before giving up, or None to wait indefinitely
+    Returns:
+        dict: custom_id -> ChatCompletion. Requests that failed are missing.
+    """
+    input_path = os.path.join(batch_dir, "batch_input.jsonl")
+    state_path = os.path.join(batch_dir, "batch_state.json")
+
+    batch_id = None
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='UTF-8') as f:
+            state = json.load(f)
+        if state["custom_ids"] == sorted(requests):
+            batch_id = state["batch_id"]
+            print(f"Resuming batch {batch_id}")
+
+    if batch_id is None:
+        write_batch_file(requests, input_path)
+        batch_id = submit_batch(client, input_path).id
+        with open(state_path, 'w', encoding='UTF-8') as f:
+            json.dump({"batch_id": batch_id, "custom_ids": sorted(requests)}, f)
+        print(f"Submitted batch {batch_id} with {len(requests)} requests")
+
+    batch = wait_for_batch(client, batch_id, poll_interval=poll_interval, timeout=timeout)
+    responses = read_batch_results(client, batch, requests)
+    os.remove(state_path)
+    return responses
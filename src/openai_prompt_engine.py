@@ -1,15 +1,46 @@
-from concurrent.futures import as_completed
 import os
 import json
+import time
 import openai
+from openai.types.chat import ChatCompletion
 import pandas as pd
 from jinja2 import Environment, FileSystemLoader
 from dotenv import load_dotenv
 
+import analytics
+import async_engine
+import checkpoint
+import output_validation
+import rate_limiter
+import response_cache
+import telemetry
+
 load_dotenv()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# retries are handled by async_engine so that 429s can feed back into the concurrency limit
+async_client = openai.AsyncOpenAI(max_retries=0)
+
+# the JSON structure the prompt templates ask for, in the function schema format that
+# output_validation checks against. The templates ask for scores from 0 to 1 or 0 to 5, so the
+# ratings are numbers rather than the function engine's integers.
+output_schema = {
+    'name': 'getMetrics',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'parsed': {'type': 'string'},
+            'topic': {'type': 'string'},
+            'tags': {'type': 'string'},
+            'sentiment': {'type': 'number'},
+            'urgency': {'type': 'number'},
+            'descriptive_normative': {'type': 'number'},
+            'questioning': {'type': 'number'},
+        },
+    },
+}
+
 
 def make_prompt_jinja(text: str, template_path: str):
     """
@@ -29,9 +60,56 @@ def make_prompt_jinja(text: str, template_path: str):
     return prompt
 
 
-def get_dict_from_prompt(prompt: str, temperature: float, engine: str):
+async def create_chat_completion(messages: list[dict], temperature: float, engine: str):
+    """
+    Sends a chat request once it fits in the engine's RPM/TPM budget, and returns the response and
+    its headers, so that the rate-limit headers can be used to tune concurrency. Responses are
+    served from, and saved to, the shared response cache; headers are None for cached responses.
+    Args:
+        messages (list[dict]): the chat messages
+        temperature (float): the temperature to use for the chat api
+        engine (str): the engine to use for the chat api
+    """
+    request = dict(
+        model=engine,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=400,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+    cache = response_cache.get_response_cache()
+    cache_key = response_cache.request_cache_key(request)
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        telemetry.get_telemetry().record(engine, "chat", cached=True)
+        return ChatCompletion.model_validate(cached), None
+
+    limiter = rate_limiter.get_rate_limiter()
+    reserved_tokens = rate_limiter.estimate_request_tokens(request)
+    wait_started = time.monotonic()
+    await limiter.acquire_async(engine, reserved_tokens)
+
+    try:
+        with telemetry.get_telemetry().track(engine, "chat", time.monotonic() - wait_started) as call:
+            raw_response = await async_client.chat.completions.with_raw_response.create(**request)
+            response = raw_response.parse()
+            call.update(status=raw_response.status_code, usage=response.usage)
+    except Exception:
+        # a failed request uses no tokens, so give back its reservation before it is retried
+        limiter.release(engine, reserved_tokens)
+        raise
+    if response.usage is not None:
+        limiter.reconcile(engine, reserved_tokens, response.usage.total_tokens)
+    if cache is not None:
+        cache.put(cache_key, response.model_dump(mode='json'), model=engine)
+    return response, raw_response.headers
+
+
+async def get_dict_from_prompt(prompt: str, temperature: float, engine: str):
     """
-    Returns a json string from a prompt for the chat api.
+    Returns a dictionary from a prompt for the chat api, and the last response's headers.
     Args:
         prompt (str): the prompt to use
         temperature (float): the temperature to use for the chat api
@@ -41,105 +119,89 @@ def get_dict_from_prompt(prompt: str, temperature: float, engine: str):
         {"role": "system", "content": "You are an AI language model that parses and extracts information from text."},
         {"role": "user", "content": prompt}
     ]
+    response, headers = await create_chat_completion(messages, temperature, engine)
+    output_text = response.choices[0].message.content
     try:
-        response = openai.ChatCompletion.create(
-            model=engine,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=400,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        output_dict = parse_output_text(response['choices'][0]['message']['content'])
-        return output_dict
-    except json.decoder.JSONDecodeError:
-        try:
-            print("Retrying prompt...")
-            messages[-1]['content'] = "Try this again, but please ensure that you return valid JSON. No markdown markup!"
-            response = openai.ChatCompletion.create(
-                model=engine,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=400,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0
-            )
-            output_dict = parse_output_text(response['choices'][0]['message']['content'])
-            return output_dict
-        except json.decoder.JSONDecodeError:
-            print(json.decoder.JSONDecodeError)
-            print("Unsuccessful, skipping...")
-            backup_output_dict = {
-                "parsed": "OpenAI failed to parse the text. Please check the text and try again.",
-                "topic": "Failed to parse text",
-                "tags": "NA",
-                "sentiment": None,
-                "urgency": None,
-                "descriptive_normative": None,
-                "questioning": None,
-            }
-
-            return backup_output_dict
+        return parse_output_text(output_text), headers
+    except ValueError as error:
+        problems = str(error)
+
+    # keep the original prompt and show the model its reply, so the retry can answer the same question
+    print(f"Retrying prompt with the original text ({problems})...")
+    messages += [
+        {"role": "assistant", "content": output_text},
+        {"role": "user", "content": f"That reply could not be used ({problems}). Reply again to the same "
+                                    "request with only the JSON object, following the structure asked for, "
+                                    "and no markdown markup."}
+    ]
+    response, headers = await create_chat_completion(messages, temperature, engine)
+    try:
+        return parse_output_text(response.choices[0].message.content), headers
+    except ValueError as error:
+        print(error)
+        print("Unsuccessful, skipping...")
+        backup_output_dict = {
+            "parsed": "OpenAI failed to parse the text. Please check the text and try again.",
+            "topic": "Failed to parse text",
+            "tags": "NA",
+            "sentiment": None,
+            "urgency": None,
+            "descriptive_normative": None,
+            "questioning": None,
+        }
+
+        return backup_output_dict, headers
 
 
 def parse_output_text(output_text: str):
     """
-    Returns a dictionary from the output text from the autocomplete api.
+    Returns a dictionary from the output text from the autocomplete api, checked against
+    `output_schema`. Code fences, surrounding prose and trailing commas are tolerated, and fields
+    are coerced to the schema's types where possible (see output_validation.repair_output).
     Args:
         output_text (str): the text to parse
+    Raises:
+        ValueError: if the text isn't JSON, or doesn't follow the schema even after repair
     """
     # Remove arbitrary indentation from the text
     json_text = ""
     for line in output_text.split("\n"):
         json_text += line.strip()
-    # Parse the JSON data using the loads() function
+    # Repair near misses locally, so that they don't need another request
+    repaired = output_validation.repair_output(json_text, output_schema)
+    if repaired is None:
+        data = output_validation.lenient_json_loads(json_text)
+        raise ValueError('; '.join(output_validation.validate_output(json.dumps(data), output_schema)))
 
-    data = json.loads(json_text)
+    return json.loads(repaired)
 
-    return data
 
-
-def parallel_fetch_list(fetch_list: list, temperature: float, engine: str):
+def parallel_fetch_list(fetch_list: list, temperature: float, engine: str, on_result=None):
     """
-    Returns a series with the output from the autocomplete api added as columns.
+    Returns a list with the output from the autocomplete api for each item, in the same order as `fetch_list`.
+    Requests run concurrently on the async client, with the number in flight adapted to the
+    model's rate limits (see async_engine.AdaptiveConcurrencyLimiter).
     Args:
-        series (pd.Series): the series to process
+        fetch_list (list): the prompts to process
         temperature (float): the temperature to use for the autocomplete api
         engine (str): the engine to use for the autocomplete api
+        on_result (callable): called with (index, result) as each item completes
     """
 
-    import concurrent.futures
-    from tqdm import tqdm
-
     # wrap the function to be executed with a single argument
-    def process_item(item):
-        return get_dict_from_prompt(item, temperature, engine)
-
-    # Define the maximum number of concurrent threads to use
-    max_threads = 30 # note, 60 hit a rate limit
-
-    # Use the ThreadPoolExecutor to execute the function on each item in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-        # Submit the function to the executor for each item in the series
-        futures = [executor.submit(process_item, item) for item in fetch_list]
-
-        # Use tqdm to display a progress bar for the parallel execution
-        for _ in tqdm(concurrent.futures.as_completed(futures), total=len(fetch_list)):
-            pass
-
-        # Collect the results from the futures as they complete
-        results = [future.result() for future in as_completed(futures)]
+    async def process_item(item):
+        return await get_dict_from_prompt(item, temperature, engine)
 
-    return results
+    return async_engine.run_fetch_list(fetch_list, process_item, limiter=async_engine.get_limiter(engine),
+                                       on_result=on_result)
 
 
 def run_prompts_transcript(df: pd.DataFrame,
                            prompt_template_path: str,
                            downsample: float = 1.0,
                            temperature: float = 0.2,
-                           engine: str = "gpt-4-turbo-preview"
+                           engine: str = "gpt-4-turbo-preview",
+                           checkpoint_path: str | None = None
                            ):
     """
     Returns a dataframe with the output from the autocomplete api added as columns.
@@ -150,6 +212,9 @@ def run_prompts_transcript(df: pd.DataFrame,
         This is useful for testing, and should be set to 1.0 for production.
         temperature (float): the temperature to use for the autocomplete api
         engine (str): the engine to use for the autocomplete api
+        checkpoint_path (str): a JSONL file to record each result in as it completes. If the file
+        already exists, rows it contains with an unchanged request are not sent again, so an interrupted
+        run can be resumed. It is removed once every row has completed.
     """
 
     # apply downsample to the dataframe if it's not 1.0
@@ -160,7 +225,20 @@ def run_prompts_transcript(df: pd.DataFrame,
     df['prompt'] = df['text'].apply(lambda x: make_prompt_jinja(text=x, template_path=prompt_template_path))
 
     # run the prompts in parallel
-    df['output'] = parallel_fetch_list(df['prompt'].values, temperature=temperature, engine=engine)
+    telemetry_mark = telemetry.get_telemetry().mark()
+    log = None
+    if checkpoint_path is not None:
+        log = checkpoint.CheckpointLog(checkpoint_path, meta={'engine': engine, 'temperature': temperature,
+                                                                  'prompt_template_path': prompt_template_path})
+    # a checkpointed result is only reused while its row's prompt is unchanged
+    keys = [response_cache.request_cache_key({'model': engine, 'temperature': temperature, 'prompt': prompt})
+            for prompt in df['prompt'].values]
+    df['output'] = checkpoint.fetch_with_checkpoint(
+        list(df.index), list(df['prompt'].values),
+        lambda items, on_result: parallel_fetch_list(items, temperature=temperature, engine=engine,
+                                                     on_result=on_result),
+        log, keys=keys)
+    telemetry.get_telemetry().print_summary(since=telemetry_mark)
 
     # Parsing and extracting data from the output dictionary
     # df = df.join(pd.json_normalize(df['output']))
@@ -188,13 +266,14 @@ if __name__ == "__main__":
     """
     Main function to run NLP analysis on a text file. This assumes that the text
     file is in the data/intermediate folder, and creates a downsampled_output.json
-    and downsampled_output.xlsx file in the data/final folder. This is used
-    for testing and development purposes.
+    file in the data/final folder, and adds the results to the output store. This
+    is used for testing and development purposes.
     """
     # set the openai api key
     df = pd.read_json('data/intermediate/processed.json', orient='records', lines=True)
     df = run_prompts_transcript(df, prompt_template_path='prompt_v2.j2', downsample=0.1)
     df.to_json('data/final/downsampled_output.json',
                orient='records', lines=True)
-    df.to_excel('data/final/downsampled_output.xlsx',
-                sheet_name='Output', index=False)
+    analytics.save_dashboard_files(df, 'data/final/downsampled_output.json')
+    import output_store
+    output_store.get_output_store().replace(df, transcript='downsampled_output')
@@ -1,16 +1,35 @@
-from concurrent.futures import as_completed
+import functools
 import os
 import json
+import time
+from collections import Counter
+import numpy as np
 import openai
+from openai.types.chat import ChatCompletion
 import pandas as pd
-from jinja2 import Environment, FileSystemLoader
 from dotenv import load_dotenv
 
+import analytics
+import async_engine
+import checkpoint
+import dedup
+import embeddings
+import incremental_json
+import openai_batch
+import output_validation
+import rate_limiter
+import response_cache
+import telemetry
+import topic_clustering
+from utils.tokens import count_tokens
+
 load_dotenv()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 client = openai.Client()
+# retries are handled by async_engine so that 429s can feed back into the concurrency limit
+async_client = openai.AsyncOpenAI(max_retries=0)
 
 
 metric_custom_functions = [
@@ -53,20 +72,98 @@ metric_custom_functions = [
     }
 ]
 
-def get_reseponse_from_function_prompt(text: str, functions: list[dict], temperature: float, engine: str = "gpt-4-turbo-preview"):
+# the metrics without topic and tags, for when topics are assigned by clustering (see topic_clustering.py)
+metric_untopiced_functions = [
+    {
+        **metric_custom_functions[0],
+        'parameters': {
+            'type': 'object',
+            'properties': {name: value for name, value in metric_custom_functions[0]['parameters']['properties'].items()
+                           if name not in ('topic', 'tags')}
+        }
+    }
+]
+
+
+# the same metrics with the long parsed text last, since the model generates fields in schema order.
+# When streaming, the short fields then complete seconds before the whole output does.
+metric_streaming_functions = [
+    {
+        **metric_custom_functions[0],
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                **{name: value for name, value in metric_custom_functions[0]['parameters']['properties'].items()
+                   if name != 'parsed'},
+                'parsed': metric_custom_functions[0]['parameters']['properties']['parsed']
+            }
+        }
+    }
+]
+
+
+def make_packed_functions(functions: list[dict]) -> list[dict]:
     """
-    This function uses the OpenAI API to generate a response from a chat model.
+    Returns a function schema requesting the fields of `functions[0]` for several chunks in one call.
+    Each chunk is labelled "[chunk N]" in the prompt and its fields are returned with the matching chunk_id.
+    Args:
+        functions (list[dict]): the single-chunk function schemas
+    """
+    return [
+        {
+            'name': functions[0]['name'] + 'ForChunks',
+            'description': 'Get metrics and other fields for each of the labelled chunks of input text',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'chunks': {
+                        'type': 'array',
+                        'description': 'One entry for every chunk in the input, in the same order',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'chunk_id': {
+                                    'type': 'integer',
+                                    'description': 'The number N from the "[chunk N]" label of the chunk'
+                                },
+                                **functions[0]['parameters']['properties']
+                            },
+                            'required': ['chunk_id']
+                        }
+                    }
+                },
+                'required': ['chunks']
+            }
+        }
+    ]
+
+
+# the same metrics, requested for several chunks in one call
+metric_packed_functions = make_packed_functions(metric_custom_functions)
+
+# tokens of labelling and separators added per chunk in a packed prompt
+PACKED_CHUNK_OVERHEAD_TOKENS = 8
+
+# the cheaper model tried first by routed_fetch_list
+DEFAULT_FAST_ENGINE = "gpt-4o-mini"
+
+
+def build_function_request(text: str, functions: list[dict], temperature: float, engine: str = "gpt-4-turbo-preview",
+                           feedback: list[dict] | None = None):
+    """
+    Returns the keyword arguments for a function-calling chat completion request.
 
     Parameters:
     text (str): The user's input.
-    functions (list[dict]): Custom functions to be used by the chat model.
+    functions (list[dict]): Custom functions to be used by the chat model. The first one is forced.
     temperature (float): Controls the randomness of the model's output.
     engine (str): Specifies the model to be used, defaulting to "gpt-4-turbo-preview".
+    feedback (list[dict]): Messages appended after the user's input, e.g. from `make_retry_feedback`.
 
     Returns:
-    response: The response from the API.
+    dict: The request arguments.
     """
-    response = client.chat.completions.create(
+    return dict(
         model = engine,
         temperature=temperature,
         # max_tokens=400,
@@ -75,14 +172,180 @@ def get_reseponse_from_function_prompt(text: str, functions: list[dict], tempera
         # presence_penalty=0
         messages = [
             {"role": "system", "content": "You are an AI language model that parses and extracts information from text, using the provided function."},
-            {'role': 'user', 'content': text}
+            {'role': 'user', 'content': text},
+            *(feedback or [])
         ],
-        functions = metric_custom_functions,
-        function_call = {"name": "getMetrics"}
+        functions = functions,
+        function_call = {"name": functions[0]['name']}
     )
+
+
+def get_reseponse_from_function_prompt(text: str, functions: list[dict], temperature: float, engine: str = "gpt-4-turbo-preview"):
+    """
+    This function uses the OpenAI API to generate a response from a chat model.
+
+    Parameters:
+    text (str): The user's input.
+    functions (list[dict]): Custom functions to be used by the chat model.
+    temperature (float): Controls the randomness of the model's output.
+    engine (str): Specifies the model to be used, defaulting to "gpt-4-turbo-preview".
+
+    Returns:
+    response: The response from the API.
+    """
+    request = build_function_request(text, functions, temperature, engine)
+    cache = response_cache.get_response_cache()
+    cache_key = response_cache.request_cache_key(request)
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        telemetry.get_telemetry().record(engine, "chat", cached=True)
+        return ChatCompletion.model_validate(cached)
+
+    limiter = rate_limiter.get_rate_limiter()
+    reserved_tokens = rate_limiter.estimate_request_tokens(request)
+    wait_started = time.monotonic()
+    limiter.acquire(engine, reserved_tokens)
+
+    try:
+        with telemetry.get_telemetry().track(engine, "chat", time.monotonic() - wait_started) as call:
+            response = client.chat.completions.create(**request)
+            call['usage'] = response.usage
+    except Exception:
+        limiter.release(engine, reserved_tokens)
+        raise
+    if response.usage is not None:
+        limiter.reconcile(engine, reserved_tokens, response.usage.total_tokens)
+    if cache is not None:
+        cache.put(cache_key, response.model_dump(mode='json'), model=engine)
     return response
 
 
+async def async_get_response_from_function_prompt(text: str, functions: list[dict], temperature: float,
+                                                  engine: str = "gpt-4-turbo-preview",
+                                                  feedback: list[dict] | None = None):
+    """
+    Async version of `get_reseponse_from_function_prompt` which also returns the response
+    headers, so that the rate-limit headers can be used to tune concurrency.
+
+    Parameters:
+    text (str): The user's input.
+    functions (list[dict]): Custom functions to be used by the chat model.
+    temperature (float): Controls the randomness of the model's output.
+    engine (str): Specifies the model to be used, defaulting to "gpt-4-turbo-preview".
+    feedback (list[dict]): Messages appended after the user's input, e.g. from `make_retry_feedback`.
+
+    Returns:
+    tuple: The response from the API and its headers. Headers are None for cached responses.
+    """
+    request = build_function_request(text, functions, temperature, engine, feedback)
+    cache = response_cache.get_response_cache()
+    cache_key = response_cache.request_cache_key(request)
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        telemetry.get_telemetry().record(engine, "chat", cached=True)
+        return ChatCompletion.model_validate(cached), None
+
+    limiter = rate_limiter.get_rate_limiter()
+    reserved_tokens = rate_limiter.estimate_request_tokens(request)
+    wait_started = time.monotonic()
+    await limiter.acquire_async(engine, reserved_tokens)
+
+    try:
+        with telemetry.get_telemetry().track(engine, "chat", time.monotonic() - wait_started) as call:
+            raw_response = await async_client.chat.completions.with_raw_response.create(**request)
+            response = raw_response.parse()
+            call.update(status=raw_response.status_code, usage=response.usage)
+    except Exception:
+        limiter.release(engine, reserved_tokens)
+        raise
+    if response.usage is not None:
+        limiter.reconcile(engine, reserved_tokens, response.usage.total_tokens)
+    if cache is not None:
+        cache.put(cache_key, response.model_dump(mode='json'), model=engine)
+    return response, raw_response.headers
+
+
+async def async_stream_function_prompt(text: str, functions: list[dict], temperature: float,
+                                      engine: str = "gpt-4-turbo-preview", on_field=None):
+    """
+    Streaming version of `async_get_response_from_function_prompt`. The function call arguments are
+    parsed as they arrive, and each top-level field is passed to `on_field` as soon as its value is
+    complete, so short fields like topic and sentiment can be shown before the long parsed text ends.
+
+    Parameters:
+    text (str): The user's input.
+    functions (list[dict]): Custom functions to be used by the chat model. The first one is forced.
+    temperature (float): Controls the randomness of the model's output.
+    engine (str): Specifies the model to be used, defaulting to "gpt-4-turbo-preview".
+    on_field (callable): Called with (name, value, seconds since the request was sent) for each field.
+
+    Returns:
+    tuple: The assembled response, its headers (None for cached responses), and the seconds at which
+    each field completed.
+    """
+    request = build_function_request(text, functions, temperature, engine)
+    cache = response_cache.get_response_cache()
+    cache_key = response_cache.request_cache_key(request)
+    cached = cache.get(cache_key) if cache is not None else None
+    parser = incremental_json.IncrementalObjectParser()
+    field_seconds = {}
+
+    def emit(fields, seconds):
+        for name, value in fields:
+            field_seconds[name] = seconds
+            if on_field is not None:
+                on_field(name, value, seconds)
+
+    if cached is not None:
+        telemetry.get_telemetry().record(engine, "chat", cached=True)
+        response = ChatCompletion.model_validate(cached)
+        emit(parser.feed(parse_output(response)), 0.0)
+        return response, None, field_seconds
+
+    limiter = rate_limiter.get_rate_limiter()
+    reserved_tokens = rate_limiter.estimate_request_tokens(request)
+    wait_started = time.monotonic()
+    await limiter.acquire_async(engine, reserved_tokens)
+
+    started = time.monotonic()
+    arguments = []
+    message = {'role': 'assistant', 'content': None,
+               'function_call': {'name': functions[0]['name'], 'arguments': ''}}
+    completion = {'object': 'chat.completion', 'usage': None,
+                  'choices': [{'index': 0, 'finish_reason': None, 'message': message}]}
+    try:
+        with telemetry.get_telemetry().track(engine, "chat", started - wait_started) as call:
+            raw_response = await async_client.chat.completions.with_raw_response.create(
+                **request, stream=True, stream_options={"include_usage": True})
+            call['status'] = raw_response.status_code
+            async for chunk in await raw_response.parse():
+                completion.update(id=chunk.id, created=chunk.created, model=chunk.model)
+                if chunk.usage is not None:
+                    completion['usage'] = chunk.usage.model_dump(mode='json')
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason is not None:
+                    completion['choices'][0]['finish_reason'] = choice.finish_reason
+                if choice.delta.function_call is not None and choice.delta.function_call.arguments:
+                    if not arguments:
+                        call['first_token_seconds'] = time.monotonic() - started
+                    arguments.append(choice.delta.function_call.arguments)
+                    emit(parser.feed(choice.delta.function_call.arguments), time.monotonic() - started)
+            call['usage'] = completion['usage']
+    except Exception:
+        limiter.release(engine, reserved_tokens)
+        raise
+    message['function_call']['arguments'] = ''.join(arguments)
+
+    response = ChatCompletion.model_validate(completion)
+    if response.usage is not None:
+        limiter.reconcile(engine, reserved_tokens, response.usage.total_tokens)
+    if cache is not None:
+        cache.put(cache_key, response.model_dump(mode='json'), model=engine)
+    return response, raw_response.headers, field_seconds
+
+
 def parse_output(response: openai.ChatCompletion):
     """
     Returns a dictionary from the chatcompletion response.
@@ -90,49 +353,397 @@ def parse_output(response: openai.ChatCompletion):
         response (openai.ChatCompletion): the response to unpack
     """
     # unpack the response
-    data = response.choices[0].message.function_call.arguments
+    message = response.choices[0].message
+    # the function call is forced, but fall back to the content in case the model ignored that
+    data = message.function_call.arguments if message.function_call is not None else message.content
 
     return data
 
 
-def parallel_fetch_list(fetch_list: list, temperature: float, engine: str):
+def make_retry_feedback(output: str, problems: list[str], functions: list[dict]) -> list[dict]:
+    """
+    Returns messages to append to a request when re-sending it after an unrepairable output:
+    the rejected function call, and what was wrong with it. The original text stays in the
+    request, so the model can answer properly rather than guessing.
+    Args:
+        output (str): the rejected function call arguments
+        problems (list[str]): the problems found by `output_validation.validate_output`
+        functions (list[dict]): the function schemas requested
+    """
+    name = functions[0]['name']
+    return [
+        {'role': 'assistant', 'content': None, 'function_call': {'name': name, 'arguments': output}},
+        {'role': 'user', 'content': f"Those arguments were invalid ({'; '.join(problems)}). Call {name} "
+                                    "again for the same text, with every field following the schema."}
+    ]
+
+
+async def async_get_validated_output(text: str, functions: list[dict], temperature: float,
+                                     engine: str = "gpt-4-turbo-preview", on_field=None):
+    """
+    Returns the function call arguments for a text, checked against the schema. Invalid outputs are
+    repaired locally where possible; only unrepairable ones are re-sent, once, with the original text
+    and the rejected output. If the retry can't be used either, its invalid fields are emptied.
+
+    Parameters:
+    text (str): The user's input.
+    functions (list[dict]): Custom functions to be used by the chat model. The first one is forced.
+    temperature (float): Controls the randomness of the model's output.
+    engine (str): Specifies the model to be used, defaulting to "gpt-4-turbo-preview".
+    on_field (callable): If given, the first request is streamed, and this is called with
+    (name, value, seconds) as each field of its output completes (see `async_stream_function_prompt`).
+
+    Returns:
+    tuple: The arguments, and the last response from the API and its headers.
+    """
+    if on_field is not None:
+        response, headers, _ = await async_stream_function_prompt(text, functions, temperature, engine, on_field)
+    else:
+        response, headers = await async_get_response_from_function_prompt(text, functions, temperature, engine)
+    output = parse_output(response)
+    problems = output_validation.validate_output(output, functions[0])
+    if not problems:
+        return output, response, headers
+    repaired = output_validation.repair_output(output, functions[0])
+    if repaired is not None:
+        return repaired, response, headers
+
+    print(f"Retrying prompt with the original text ({'; '.join(problems)})...")
+    response, headers = await async_get_response_from_function_prompt(
+        text, functions, temperature, engine, feedback=make_retry_feedback(output, problems, functions))
+    output = parse_output(response)
+    if not output_validation.validate_output(output, functions[0]):
+        return output, response, headers
+    repaired = output_validation.repair_output(output, functions[0])
+    if repaired is not None:
+        return repaired, response, headers
+    print("Retry was also invalid, keeping only its valid fields")
+    return output_validation.fallback_output(output, functions[0]), response, headers
+
+
+def parallel_fetch_list(fetch_list: list, temperature: float, engine: str, on_result=None,
+                        functions: list[dict] = metric_custom_functions):
     """
-    Returns a series with the output from the autocomplete api added as columns.
+    Returns a list with the output from the chat api for each item, in the same order as `fetch_list`.
+    Requests run concurrently on the async client, with the number in flight adapted to the
+    model's rate limits (see async_engine.AdaptiveConcurrencyLimiter).
     Args:
         fetch_list (list): the series of values to process
         temperature (float): the temperature to use for the autocomplete api
         engine (str): the engine to use for the autocomplete api
+        on_result (callable): called with (index, result) as each item completes
+        functions (list[dict]): the function schemas to request, the first of which is called
     """
 
-    import concurrent.futures
-    from tqdm import tqdm
-
     # wrap the function to be executed with a single argument
-    def process_item(item):
-        return parse_output(get_reseponse_from_function_prompt(item, metric_custom_functions, temperature, engine))
+    async def process_item(item):
+        output, _, headers = await async_get_validated_output(item, functions, temperature, engine)
+        return output, headers
 
-    # Define the maximum number of concurrent threads to use
-    max_threads = 60
+    return async_engine.run_fetch_list(fetch_list, process_item, limiter=async_engine.get_limiter(engine),
+                                       on_result=on_result)
 
-    # Use the ThreadPoolExecutor to execute the function on each item in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-        # Submit the function to the executor for each item in the series
-        futures = [executor.submit(process_item, item) for item in fetch_list]
 
-        # Use tqdm to display a progress bar for the parallel execution
-        for _ in tqdm(concurrent.futures.as_completed(futures), total=len(fetch_list)):
-            pass
+def batch_fetch_list(fetch_list: list, temperature: float, engine: str, on_result=None,
+                     batch_dir: str = "data/intermediate/batch", poll_interval: float = 60.0,
+                     functions: list[dict] = metric_custom_functions):
+    """
+    Returns a list with the output from the chat api for each item, in the same order as `fetch_list`,
+    using the Batch API instead of interactive requests. Each request's custom_id is its cache key, so
+    identical chunks are only sent once and results are merged back by custom_id. Cached responses are
+    not resubmitted, and any requests the batch fails on are retried through `parallel_fetch_list`.
+    Args:
+        fetch_list (list): the series of values to process
+        temperature (float): the temperature to use for the chat api
+        engine (str): the engine to use for the chat api
+        on_result (callable): called with (index, result) for each item once the batch has finished
+        batch_dir (str): the directory for the batch input file and the id of the running batch
+        poll_interval (float): seconds between batch status checks
+        functions (list[dict]): the function schemas to request, the first of which is called
+    """
+    cache = response_cache.get_response_cache()
+    custom_ids = []
+    requests = {}
+    responses = {}
+    for text in fetch_list:
+        request = build_function_request(text, functions, temperature, engine)
+        custom_id = response_cache.request_cache_key(request)
+        custom_ids.append(custom_id)
+        cached = cache.get(custom_id) if cache is not None else None
+        if cached is not None:
+            telemetry.get_telemetry().record(engine, "batch", cached=True)
+            responses[custom_id] = ChatCompletion.model_validate(cached)
+        else:
+            requests[custom_id] = request
 
-        # Collect the results from the futures as they complete
-        results = [future.result() for future in as_completed(futures)]
+    if requests:
+        batch_responses = openai_batch.run_batch(client, requests, batch_dir, poll_interval=poll_interval)
+        if cache is not None:
+            for custom_id, response in batch_responses.items():
+                cache.put(custom_id, response.model_dump(mode='json'), model=engine)
+        responses.update(batch_responses)
+
+    results = [None] * len(fetch_list)
+    failed = []
+    for index, custom_id in enumerate(custom_ids):
+        output = parse_output(responses[custom_id]) if custom_id in responses else None
+        if output is not None and output_validation.validate_output(output, functions[0]):
+            output = output_validation.repair_output(output, functions[0])
+        if output is not None:
+            results[index] = output
+            if on_result is not None:
+                on_result(index, output)
+        else:
+            # failed or unrepairable requests are retried interactively, with validation
+            failed.append(index)
+
+    if failed:
+        print(f"{len(failed)} batch requests failed, retrying them interactively")
+
+        def on_retried(position, result):
+            if on_result is not None:
+                on_result(failed[position], result)
+
+        retried = parallel_fetch_list([fetch_list[index] for index in failed], temperature, engine,
+                                      on_result=on_retried, functions=functions)
+        for index, result in zip(failed, retried):
+            results[index] = result
 
     return results
 
 
+def pack_chunks(fetch_list: list, token_budget: int, engine: str) -> list[list[int]]:
+    """
+    Greedily groups consecutive chunks so that each group's text fits in `token_budget`
+    tokens. A chunk larger than the budget gets a group of its own.
+    Args:
+        fetch_list (list): the chunk texts
+        token_budget (int): the maximum number of chunk tokens per group. The reply repeats
+        each chunk as the `parsed` field, so keep this well below the model's output limit.
+        engine (str): the model whose tokenizer to use
+    Returns:
+        list[list[int]]: the indexes of the chunks in each group
+    """
+    packs = []
+    current, current_tokens = [], 0
+    for index, text in enumerate(fetch_list):
+        tokens = count_tokens(text, engine) + PACKED_CHUNK_OVERHEAD_TOKENS
+        if current and current_tokens + tokens > token_budget:
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def make_packed_prompt(texts: list[str]) -> str:
+    """
+    Returns the user message for a packed request, labelling each chunk with its position.
+    Args:
+        texts (list[str]): the chunk texts
+    """
+    return "\n\n".join(f"[chunk {chunk_id}]\n{text}" for chunk_id, text in enumerate(texts))
+
+
+def unpack_output(output: str, pack_size: int, function: dict | None = None) -> dict:
+    """
+    Splits the arguments of a packed reply into per-chunk outputs in the same format as
+    `parse_output`. Chunks that are missing, duplicated or unreadable are left out.
+    Args:
+        output (str): the function call arguments of the packed reply
+        pack_size (int): the number of chunks in the request
+        function (dict): if given, the single-chunk schema; chunks that fail it and can't be
+        repaired are left out too
+    Returns:
+        dict: chunk_id -> JSON string of that chunk's metrics
+    """
+    try:
+        chunks = output_validation.lenient_json_loads(output)['chunks']
+    except (json.decoder.JSONDecodeError, KeyError, TypeError):
+        return {}
+
+    unpacked = {}
+    for chunk in chunks:
+        if not isinstance(chunk, dict):
+            continue
+        chunk_id = chunk.pop('chunk_id', None)
+        if isinstance(chunk_id, int) and 0 <= chunk_id < pack_size and chunk_id not in unpacked:
+            chunk_output = json.dumps(chunk)
+            if function is not None and output_validation.validate_output(chunk_output, function):
+                chunk_output = output_validation.repair_output(chunk_output, function)
+            if chunk_output is not None:
+                unpacked[chunk_id] = chunk_output
+    return unpacked
+
+
+def packed_fetch_list(fetch_list: list, temperature: float, engine: str, on_result=None,
+                      pack_token_budget: int = 2000, functions: list[dict] = metric_custom_functions):
+    """
+    Returns a list with the output from the chat api for each item, in the same order as `fetch_list`,
+    sending several chunks per request so the system message and function schema are paid for once per
+    pack rather than once per chunk. Chunks missing from a packed reply are re-sent on their own.
+    Args:
+        fetch_list (list): the series of values to process
+        temperature (float): the temperature to use for the chat api
+        engine (str): the engine to use for the chat api
+        on_result (callable): called with (index, result) as each item completes
+        pack_token_budget (int): the maximum number of chunk tokens per request
+        functions (list[dict]): the single-chunk function schemas, which are packed with `make_packed_functions`
+    """
+    fetch_list = list(fetch_list)
+    packed_functions = make_packed_functions(functions)
+    packs = pack_chunks(fetch_list, pack_token_budget, engine)
+    results = [None] * len(fetch_list)
+
+    async def process_pack(pack):
+        response, headers = await async_get_response_from_function_prompt(
+            make_packed_prompt([fetch_list[index] for index in pack]), packed_functions, temperature, engine)
+        return parse_output(response), headers
+
+    def on_pack(pack_index, output):
+        pack = packs[pack_index]
+        for chunk_id, result in unpack_output(output, len(pack), functions[0]).items():
+            results[pack[chunk_id]] = result
+            if on_result is not None:
+                on_result(pack[chunk_id], result)
+
+    async_engine.run_fetch_list(packs, process_pack, limiter=async_engine.get_limiter(engine), on_result=on_pack)
+
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        print(f"{len(missing)} chunks were missing or invalid in packed replies, sending them individually")
+
+        def on_retried(position, result):
+            if on_result is not None:
+                on_result(missing[position], result)
+
+        retried = parallel_fetch_list([fetch_list[index] for index in missing], temperature, engine,
+                                      on_result=on_retried, functions=functions)
+        for index, result in zip(missing, retried):
+            results[index] = result
+
+    return results
+
+
+def routing_problems(text: str, output: str, function: dict, min_parsed_ratio: float = 0.5) -> list[str]:
+    """
+    Returns the reasons a fast model's output should be re-sent to the stronger model: schema
+    problems, or a 'parsed' rewrite so much shorter than the input that text was probably dropped.
+    Args:
+        text (str): the chunk text sent
+        output (str): the function call arguments returned
+        function (dict): the function schema requested
+        min_parsed_ratio (float): the shortest acceptable 'parsed' length, as a fraction of the input
+    """
+    problems = output_validation.validate_output(output, function)
+    if not problems and 'parsed' in function['parameters']['properties']:
+        if len(json.loads(output)['parsed']) < min_parsed_ratio * len(text):
+            problems.append('parsed too short')
+    return problems
+
+
+def routed_fetch_list(fetch_list: list, temperature: float, engine: str, on_result=None,
+                      functions: list[dict] = metric_custom_functions, fetch_fn=parallel_fetch_list,
+                      fast_engine: str = DEFAULT_FAST_ENGINE, min_parsed_ratio: float = 0.5):
+    """
+    Returns a list with the output from the chat api for each item, in the same order as `fetch_list`.
+    Every item is first sent once to the cheaper `fast_engine`. Its outputs are only repaired locally,
+    never retried or emptied, and those which still fail `routing_problems` are re-sent to `engine`
+    with `fetch_fn`. A report of the chunks, latency, cost and the problems found in each tier's raw
+    outputs is printed, to help tune the thresholds.
+    Args:
+        fetch_list (list): the series of values to process
+        temperature (float): the temperature to use for the chat api
+        engine (str): the stronger engine, used for the outputs the fast engine gets wrong
+        on_result (callable): called with (index, result) once each item's final result is known
+        functions (list[dict]): the function schemas to request, the first of which is called
+        fetch_fn (callable): the fetch function used for `engine`, e.g. `parallel_fetch_list`
+        fast_engine (str): the engine tried first
+        min_parsed_ratio (float): see `routing_problems`
+    """
+    fetch_list = list(fetch_list)
+    results = [None] * len(fetch_list)
+    pending = list(range(len(fetch_list)))
+    report = []
+
+    # the fast tier only gets the model's raw output, so that its mistakes are escalated rather
+    # than hidden by the validated fetch's retry and fallback
+    async def process_fast_item(item):
+        response, headers = await async_get_response_from_function_prompt(item, functions, temperature,
+                                                                          fast_engine)
+        return parse_output(response), headers
+
+    def fetch_fast(items, temperature, engine, on_result, functions):
+        return async_engine.run_fetch_list(items, process_fast_item, limiter=async_engine.get_limiter(engine),
+                                           on_result=on_result)
+
+    for tier_engine, tier_fetch_fn in ((fast_engine, fetch_fast), (engine, fetch_fn)):
+        is_last_tier = tier_engine == engine
+        tier_items = pending
+        reasons = Counter()
+
+        def on_tier_result(position, output):
+            index = tier_items[position]
+            text = fetch_list[index]
+            problems = routing_problems(text, output, functions[0], min_parsed_ratio)
+            reasons.update(problems)
+            if problems and not is_last_tier:
+                repaired = output_validation.repair_output(output, functions[0])
+                if repaired is None or routing_problems(text, repaired, functions[0], min_parsed_ratio):
+                    return
+                output = repaired
+            results[index] = output
+            if on_result is not None:
+                on_result(index, output)
+
+        started = time.monotonic()
+        telemetry_mark = telemetry.get_telemetry().mark()
+        tier_fetch_fn([fetch_list[index] for index in tier_items], temperature=temperature, engine=tier_engine,
+                      on_result=on_tier_result, functions=functions)
+        pending = [index for index in tier_items if results[index] is None]
+        # the tiers run one after the other, so the calls since the mark are this tier's, priced by their usage
+        tier_cost = telemetry.get_telemetry().summary(since=telemetry_mark)['cost_usd']
+        report.append({'engine': tier_engine, 'chunks': len(tier_items),
+                       'accepted': len(tier_items) - len(pending), 'seconds': time.monotonic() - started,
+                       'cost_usd': tier_cost, 'problems': dict(reasons)})
+        if not pending or is_last_tier:
+            break
+
+    print(f"\n{'engine':24} {'chunks':>7} {'accepted':>9} {'seconds':>9} {'cost $':>12}  problems")
+    for tier in report:
+        print(f"{tier['engine']:24} {tier['chunks']:7d} {tier['accepted']:9d} {tier['seconds']:9.1f} "
+              f"{tier['cost_usd']:12.3f}  {tier['problems']}")
+    return results
+
+
+def fan_out_output(output: str, text: str) -> str:
+    """
+    Returns a near duplicate chunk's output from that of the chunk it was deduplicated to: the
+    metrics are shared, but 'parsed' is filled from the duplicate's own text.
+    Args:
+        output (str): the representative chunk's function call arguments
+        text (str): the duplicate chunk's text
+    """
+    fields = json.loads(output)
+    if 'parsed' in fields:
+        fields['parsed'] = text
+    return json.dumps(fields)
+
+
 def run_prompts_transcript(df: pd.DataFrame,
                            downsample: float = 1.0,
                            temperature: float = 0.2,
-                           engine: str = "gpt-4-turbo-preview"
+                           engine: str = "gpt-4-turbo-preview",
+                           checkpoint_path: str | None = None,
+                           backend: str = "realtime",
+                           pack_token_budget: int | None = None,
+                           dedup_threshold: float | None = None,
+                           dedup_embedding_threshold: float | None = None,
+                           topic_source: str = "llm",
+                           n_topic_clusters: int | None = None,
+                           fast_engine: str | None = None
                            ):
     """
     Returns a dataframe with the output from the autocomplete api added as columns.
@@ -142,7 +753,43 @@ def run_prompts_transcript(df: pd.DataFrame,
         This is useful for testing, and should be set to 1.0 for production.
         temperature (float): the temperature to use for the autocomplete api
         engine (str): the engine to use for the autocomplete api
+        checkpoint_path (str): a JSONL file to record each result in as it completes. If the file
+        already exists, rows it contains with an unchanged request are not sent again, so an interrupted
+        run can be resumed. It is removed once every row has completed.
+        backend (str): "realtime" to send requests interactively, or "batch" to submit them through the
+        Batch API and wait for the results (cheaper, but can take up to 24 hours).
+        pack_token_budget (int): if set, realtime requests carry as many chunks as fit in this many
+        tokens, rather than one chunk each. Not supported with the batch backend.
+        dedup_threshold (float): if set, chunks whose word shingles overlap at least this much
+        (estimated Jaccard similarity, e.g. 0.8) are sent once and the result is reused for the others.
+        dedup_embedding_threshold (float): if set as well, the chunks left are also merged when the cosine
+        similarity of their embeddings is at least this (e.g. 0.97), which catches paraphrases.
+        topic_source (str): "llm" to ask for a topic and tags with every chunk, or "clusters" to cluster
+        the chunks' embeddings and ask for one topic and set of tags per cluster (see `cluster_topics`).
+        n_topic_clusters (int): the number of clusters for topic_source="clusters", defaulting to sqrt(n / 2)
+        fast_engine (str): if set, chunks are sent to this cheaper engine first, and only those whose
+        outputs fail validation are re-sent to `engine` (see `routed_fetch_list`), e.g. "gpt-4o-mini".
     """
+    if topic_source == "llm":
+        functions = metric_custom_functions
+    elif topic_source == "clusters":
+        functions = metric_untopiced_functions
+    else:
+        raise ValueError("Topic source not recognised")
+
+    if backend == "realtime" and pack_token_budget is not None:
+        fetch_list = functools.partial(packed_fetch_list, pack_token_budget=pack_token_budget)
+    elif backend == "realtime":
+        fetch_list = parallel_fetch_list
+    elif backend == "batch" and pack_token_budget is not None:
+        raise ValueError("Packing is only supported with the realtime backend")
+    elif backend == "batch":
+        fetch_list = batch_fetch_list
+    else:
+        raise ValueError("Backend not recognised")
+
+    if fast_engine is not None:
+        fetch_list = functools.partial(routed_fetch_list, fetch_fn=fetch_list, fast_engine=fast_engine)
 
     # apply downsample to the dataframe if it's not 1.0
     if downsample != 1.0:
@@ -150,12 +797,88 @@ def run_prompts_transcript(df: pd.DataFrame,
 
 
     # run the prompts in parallel
-    df['output'] = parallel_fetch_list(df['text'].values, temperature=temperature, engine=engine)
+    telemetry_mark = telemetry.get_telemetry().mark()
+    log = None
+    if checkpoint_path is not None:
+        meta = {'engine': engine, 'temperature': temperature, 'functions': functions}
+        if topic_source != "llm":
+            # the outputs have different fields, so can't be resumed from an "llm" checkpoint
+            meta['topic_source'] = topic_source
+        if fast_engine is not None:
+            meta['fast_engine'] = fast_engine
+        log = checkpoint.CheckpointLog(checkpoint_path, meta=meta)
+    texts = list(df['text'].values)
+    representative = np.arange(len(texts))
+    if dedup_threshold is not None:
+        embed_fn = embeddings.embed_texts if dedup_embedding_threshold is not None else None
+        representative = dedup.find_near_duplicates(texts, threshold=dedup_threshold, embed_fn=embed_fn,
+                                                    embedding_threshold=dedup_embedding_threshold)
+        print(f"Deduplicated {len(texts)} chunks to {len(np.unique(representative))} requests")
+    unique = np.unique(representative)
+    # a checkpointed result is only reused while its row's request is unchanged
+    keys = [response_cache.request_cache_key(build_function_request(texts[i], functions, temperature, engine))
+            for i in unique] if log is not None else None
+    outputs = checkpoint.fetch_with_checkpoint(
+        list(df.index[unique]), [texts[i] for i in unique],
+        lambda items, on_result: fetch_list(items, temperature=temperature, engine=engine,
+                                            on_result=on_result, functions=functions),
+        log, keys=keys)
+    # fan each representative's metrics out to the chunks it stands for; the parsed text is a
+    # rewrite of the representative's own text, so each duplicate keeps its own text instead
+    outputs = [outputs[position] if row == unique[position] else fan_out_output(outputs[position], texts[row])
+               for row, position in enumerate(np.searchsorted(unique, representative))]
+
+    if topic_source == "clusters":
+        topics = cluster_topics(texts, temperature=temperature, engine=engine, n_clusters=n_topic_clusters)
+        outputs = [json.dumps({**json.loads(output), **topic}) for output, topic in zip(outputs, topics)]
+    df['output'] = outputs
+    telemetry.get_telemetry().print_summary(since=telemetry_mark)
+
+    return outputs_to_frame(df)
+
+
+def cluster_topics(texts: list[str], temperature: float = 0.2, engine: str = "gpt-4-turbo-preview",
+                   n_clusters: int | None = None, samples_per_cluster: int = 5) -> list[dict]:
+    """
+    Returns a topic and tags for each text by clustering the texts' embeddings and labelling
+    each cluster with one request over its most central texts, rather than one per text.
+    Args:
+        texts (list[str]): the chunk texts
+        temperature (float): the temperature to use for the chat api
+        engine (str): the engine to use for the chat api
+        n_clusters (int): the number of clusters, defaulting to sqrt(n / 2)
+        samples_per_cluster (int): the number of central chunks shown to the model per cluster
+    Returns:
+        list[dict]: per text, the 'topic' and 'tags' of its cluster, in the format of `parse_output`
+    """
+    matrix = embeddings.embed_texts(texts)
+    centroids, assignments = topic_clustering.cluster_embeddings(matrix, n_clusters)
+    samples = topic_clustering.representative_texts(texts, matrix, centroids, assignments, samples_per_cluster)
+    print(f"Labelling {len(texts)} chunks with {len(samples)} topic clusters")
+
+    labels = parallel_fetch_list([topic_clustering.make_cluster_prompt(sample) for sample in samples],
+                                 temperature, engine, functions=topic_clustering.cluster_topic_functions)
+    labels = [json.loads(label) for label in labels]
+    return [{'topic': labels[cluster].get('topic', ''), 'tags': labels[cluster].get('tags', '[]')}
+            for cluster in assignments]
+
+
+def outputs_to_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns a dataframe with one column per function argument, from a dataframe with the
+    function call arguments in its 'output' column and the chunk start in 'timestamp'.
+    Args:
+        df (pd.DataFrame): the dataframe with 'output' and 'timestamp' columns
+    """
+    if df.empty:
+        # e.g. a transcript with no chunks; json_normalize would return a frame with no columns at all
+        columns = list(metric_custom_functions[0]['parameters']['properties']) + ['timestamp']
+        return pd.DataFrame(columns=columns, index=df.index)
 
     # assuming df is your DataFrame and 'output' is the column with the dictionaries
-    df_output = pd.json_normalize([json.loads(x) for x in df['output'].values])
+    df_output = pd.json_normalize([output_validation.lenient_json_loads(x) for x in df['output'].values])
     
-    df_output.tags = [json.loads(tag) for tag in df_output.tags]
+    df_output.tags = [output_validation.parse_string_list(tag) for tag in df_output.tags]
 
     # assert that df_output has the same number of rows as df
     assert len(df) == len(df_output)
@@ -166,18 +889,99 @@ def run_prompts_transcript(df: pd.DataFrame,
     return df_output
 
 
+def run_prompts_stream(chunks, temperature: float = 0.2, engine: str = "gpt-4-turbo-preview",
+                       checkpoint_path: str | None = None, on_result=None, on_field=None):
+    """
+    Returns a dataframe with the output from the chat api for each chunk, sending each chunk
+    as soon as it is produced rather than waiting for the whole transcript to be parsed.
+    Args:
+        chunks (iterable): dicts with 'timestamp' and 'text', e.g. from preprocess.stream_transcript_chunks
+        temperature (float): the temperature to use for the chat api
+        engine (str): the engine to use for the chat api
+        checkpoint_path (str): a JSONL file to record each result in as it completes, keyed by the
+        chunk's position in the stream and the hash of its request. Chunks already in it are not sent
+        again, unless their text has changed. It is removed once the stream has been processed.
+        on_result (callable): called with (index, chunk, output) as each chunk completes
+        on_field (callable): if given, responses are streamed and this is called with
+        (index, name, value, seconds) as each field of a chunk's output completes, before the whole
+        output has. The parsed text is requested last so the metrics arrive first. A summary of the
+        median seconds to each field is printed at the end.
+    """
+    done = {}
+    field_seconds = {}
+    functions = metric_streaming_functions if on_field is not None else metric_custom_functions
+    telemetry_mark = telemetry.get_telemetry().mark()
+    log = None
+    if checkpoint_path is not None:
+        log = checkpoint.CheckpointLog(checkpoint_path, meta={'engine': engine, 'temperature': temperature,
+                                                              'functions': functions})
+        done = log.load()
+
+    def chunk_key(chunk):
+        return response_cache.request_cache_key(build_function_request(chunk['text'], functions, temperature, engine))
+
+    def is_done(index):
+        return str(index) in done and done[str(index)]['key'] == chunk_key(seen_chunks[index])
+
+    seen_chunks = []
+
+    def record(chunk_iterable):
+        for chunk in chunk_iterable:
+            seen_chunks.append(chunk)
+            yield len(seen_chunks) - 1, chunk
+
+    async def process_chunk(item):
+        index, chunk = item
+        if is_done(index):
+            return done[str(index)]['result'], None
+        def record_field(name, value, seconds):
+            field_seconds.setdefault(name, []).append(seconds)
+            on_field(index, name, value, seconds)
+
+        output, _, headers = await async_get_validated_output(
+            chunk['text'], functions, temperature, engine,
+            on_field=record_field if on_field is not None else None)
+        return output, headers
+
+    def on_output(index, output):
+        if log is not None and not is_done(index):
+            log.append(index, chunk_key(seen_chunks[index]), output)
+        if on_result is not None:
+            on_result(index, seen_chunks[index], output)
+
+    try:
+        outputs = async_engine.run_fetch_list(record(chunks), process_chunk,
+                                              limiter=async_engine.get_limiter(engine), on_result=on_output)
+    finally:
+        if log is not None:
+            log.close()
+    if log is not None:
+        log.complete()
+
+    telemetry.get_telemetry().print_summary(since=telemetry_mark)
+    if field_seconds:
+        print("Median seconds from request to each field:")
+        for name, seconds in field_seconds.items():
+            print(f"  {name:24} {np.median(seconds):6.2f}")
+
+    df = pd.DataFrame(seen_chunks, columns=['timestamp', 'text'])
+    df['output'] = outputs
+    return outputs_to_frame(df)
+
+
 # run the main function
 if __name__ == "__main__":
     """
     Main function to run NLP analysis on a text file. This assumes that the text
     file is in the data/intermediate folder, and creates a downsampled_output.json
-    and downsampled_output.xlsx file in the data/final folder. This is used
-    for testing and development purposes.
+    file in the data/final folder, and adds the results to the output store. This
+    is used for testing and development purposes.
     """
     # set the openai api key
     df = pd.read_json('data/intermediate/processed.json', orient='records', lines=True)
     df = run_prompts_transcript(df, downsample=0.02)
     df.to_json('data/final/downsampled_output.json',
                orient='records', lines=True)
-    df.to_excel('data/final/downsampled_output.xlsx',
-                sheet_name='Output', index=False)
+    analytics.save_dashboard_files(df, 'data/final/downsampled_output.json')
+    import output_store
+    output_store.get_output_store().replace(df, transcript='downsampled_output')
@@ -0,0 +1,229 @@
+"""
+A columnar store for pipeline outputs: Parquet files partitioned by transcript
+and date, in the hive layout that pyarrow, pandas, DuckDB and Spark all read,
+
+    data/final/store/transcript=<name>/date=<YYYY-MM-DD>/part-<n>.parquet
+
+Columns are typed rather than left as JSON: the ratings are int8, tags are
+list<string> and topics are dictionary encoded, so they load as a pandas
+categorical. Each append writes a new part file, so results are added as each
+transcript finishes without rewriting what is already stored.
+
+The store needs pyarrow, which streamlit already depends on; modules that
+write to it import it only where they do, so the rest of the pipeline still
+runs without pyarrow.
+
+Excel is no longer written on every run. To export on demand, streaming rows
+into the workbook rather than building it in memory:
+    python src/output_store.py data/final/output.xlsx --transcript "HMRC DALAS Transcript"
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import time
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from analytics import ANALYTICS_COLUMNS
+from output_validation import parse_string_list
+from utils.common import atomic_write
+
+DEFAULT_STORE_DIR = "data/final/store"
+PARTITIONING = ds.partitioning(pa.schema([('transcript', pa.string()), ('date', pa.string())]), flavor='hive')
+# the most rows an Excel sheet holds, less one for the header
+EXCEL_MAX_ROWS = 1_048_575
+
+
+def _tags_array(values: pd.Series) -> pa.Array:
+    """
+    Returns a tags column as list<string>, reading JSON list strings from older outputs.
+    """
+    tags = [None if value is None else [str(tag) for tag in value]
+            if isinstance(value, (list, tuple, np.ndarray)) else parse_string_list(value)
+            for value in values]
+    return pa.array(tags, type=pa.list_(pa.string()))
+
+
+def to_table(data_frame: pd.DataFrame) -> pa.Table:
+    """
+    Converts an output frame to an Arrow table with the store's column types. Ratings which are
+    missing, e.g. from `output_validation.fallback_output`, are stored as nulls.
+    Args:
+        data_frame (pd.DataFrame): the output, as returned by `outputs_to_frame`
+    Returns:
+        pa.Table: the typed table
+    """
+    arrays = {}
+    for name in data_frame.columns:
+        values = data_frame[name]
+        if name in ANALYTICS_COLUMNS:
+            arrays[name] = pa.array(pd.to_numeric(values, errors='coerce').round().astype('Int8'), from_pandas=True)
+        elif name == 'tags':
+            arrays[name] = _tags_array(values)
+        elif name == 'topic':
+            arrays[name] = pa.array(values.astype('string'), type=pa.string(), from_pandas=True).dictionary_encode()
+        elif name == 'timestamp':
+            arrays[name] = pa.array(values, type=pa.int32(), from_pandas=True)
+        else:
+            arrays[name] = pa.array(values, from_pandas=True)
+    return pa.table(arrays)
+
+
+class OutputStore:
+    """
+    Appends and reads pipeline outputs in a directory of partitioned Parquet files.
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIR):
+        """
+        Args:
+            directory (str): the root of the store
+        """
+        self.directory = directory
+
+    def transcript_dir(self, transcript: str) -> str:
+        """
+        Returns the directory holding a transcript's outputs for every date.
+        """
+        return os.path.join(self.directory, f"transcript={quote(transcript, safe='')}")
+
+    def partition_dir(self, transcript: str, date: str) -> str:
+        """
+        Returns the directory holding a transcript's outputs for one date.
+        """
+        return os.path.join(self.transcript_dir(transcript), f"date={quote(date, safe='')}")
+
+    def append(self, data_frame: pd.DataFrame, transcript: str, date: str | None = None) -> str:
+        """
+        Adds outputs to the store as a new part file, leaving those already stored alone.
+        Args:
+            data_frame (pd.DataFrame): the outputs to add
+            transcript (str): the transcript they came from, e.g. its file name without extension
+            date (str): the partition date as YYYY-MM-DD, defaulting to today
+        Returns:
+            str: the path of the part file written
+        """
+        date = date or datetime.date.today().isoformat()
+        directory = self.partition_dir(transcript, date)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'part-{time.time_ns()}.parquet')
+        with atomic_write(path) as f:
+            pq.write_table(to_table(data_frame.reset_index(drop=True)), f)
+        return path
+
+    def replace(self, data_frame: pd.DataFrame, transcript: str, date: str | None = None) -> str:
+        """
+        Stores the complete outputs of a transcript, removing any stored before for the same
+        transcript on any date, so that re-running a transcript, even on another day, doesn't
+        duplicate its rows. Arguments as for `append`.
+        """
+        directory = self.transcript_dir(transcript)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        return self.append(data_frame, transcript, date)
+
+    def dataset(self) -> ds.Dataset:
+        """
+        Returns the store as a pyarrow dataset, with 'transcript' and 'date' as partition columns.
+        Part files written by different runs may have different columns, so their schemas are unified.
+        """
+        files = sorted(glob.glob(os.path.join(self.directory, '**', '*.parquet'), recursive=True))
+        if not files:
+            raise FileNotFoundError(f"No outputs stored in {self.directory}")
+        schema = pa.unify_schemas([pq.read_schema(path) for path in files] + [PARTITIONING.schema])
+        return ds.dataset(files, schema=schema, format='parquet', partitioning=PARTITIONING,
+                          partition_base_dir=self.directory)
+
+    @staticmethod
+    def _filter(transcript: str | None = None, date: str | None = None) -> ds.Expression | None:
+        """
+        Returns the dataset filter selecting a transcript and/or date, or None to select everything.
+        """
+        expression = None
+        for name, value in (('transcript', transcript), ('date', date)):
+            if value is not None:
+                condition = ds.field(name) == value
+                expression = condition if expression is None else expression & condition
+        return expression
+
+    def read(self, transcript: str | None = None, date: str | None = None,
+             columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Reads stored outputs, only opening the partitions and columns asked for.
+        Args:
+            transcript (str): only read this transcript's outputs
+            date (str): only read outputs for this date, as YYYY-MM-DD
+            columns (list[str]): the columns to read, defaulting to all of them
+        Returns:
+            pd.DataFrame: the outputs, with topics as a categorical
+        """
+        table = self.dataset().to_table(columns=columns, filter=self._filter(transcript, date))
+        return table.to_pandas()
+
+    def export_excel(self, path: str, transcript: str | None = None, date: str | None = None,
+                     sheet_name: str = 'Output') -> int:
+        """
+        Exports stored outputs to an Excel workbook, a batch of rows at a time, so memory use doesn't
+        grow with the corpus. Rows beyond a sheet's limit continue on further sheets.
+        Args:
+            path (str): the .xlsx file to write
+            transcript (str): only export this transcript's outputs
+            date (str): only export outputs for this date, as YYYY-MM-DD
+            sheet_name (str): the name of the first sheet
+        Returns:
+            int: the number of rows exported
+        """
+        # openpyxl is only needed for this export, as it was for pandas' to_excel
+        from openpyxl import Workbook
+
+        dataset = self.dataset()
+        header = dataset.schema.names
+        workbook = Workbook(write_only=True)
+        sheet, sheet_rows, rows = None, EXCEL_MAX_ROWS, 0
+        for batch in dataset.to_batches(filter=self._filter(transcript, date)):
+            for row in batch.to_pylist():
+                if sheet_rows == EXCEL_MAX_ROWS:
+                    name = sheet_name if sheet is None else f'{sheet_name} {len(workbook.worksheets) + 1}'
+                    sheet = workbook.create_sheet(name)
+                    sheet.append(header)
+                    sheet_rows = 0
+                sheet.append([json.dumps(row[name]) if isinstance(row[name], list) else row[name] for name in header])
+                sheet_rows += 1
+                rows += 1
+        if sheet is None:
+            workbook.create_sheet(sheet_name).append(header)
+        workbook.save(path)
+        return rows
+
+
+def get_output_store() -> OutputStore:
+    """
+    Returns the output store configured by OUTPUT_STORE_DIR, defaulting to data/final/store.
+    """
+    return OutputStore(os.getenv("OUTPUT_STORE_DIR", DEFAULT_STORE_DIR))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export stored outputs to an Excel workbook.")
+    parser.add_argument('path', help="the .xlsx file to write")
+    parser.add_argument('--transcript', help="only export this transcript")
+    parser.add_argument('--date', help="only export this date, as YYYY-MM-DD")
+    parser.add_argument('--store', default=None, help="the store directory, defaulting to OUTPUT_STORE_DIR or "
+                                                      f"{DEFAULT_STORE_DIR}")
+    args = parser.parse_args()
+    store = OutputStore(args.store) if args.store else get_output_store()
+    rows = store.export_excel(args.path, transcript=args.transcript, date=args.date)
+    print(f"Exported {rows} rows to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
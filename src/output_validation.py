@@ -0,0 +1,218 @@
+"""
+Local checks on the function call arguments returned by the chat api, against
+the function's JSON schema, so that bad outputs can be caught before they reach
+`outputs_to_frame` rather than crashing it. Most bad outputs are near misses
+(a code fence, a trailing comma, "7" instead of 7, tags as "a, b"), which
+`repair_output` fixes locally without another request.
+"""
+
+import json
+import re
+
+# the integer and number fields in the metric schemas are all ratings on at most this scale
+RATING_RANGE = (0, 10)
+# string fields which hold a JSON list of strings, e.g. '["tag1", "tag2"]'
+LIST_STRING_FIELDS = ('tags',)
+
+CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+
+
+def validate_output(output: str, function: dict) -> list[str]:
+    """
+    Returns the problems with a function call's arguments, or an empty list if they are valid.
+    Args:
+        output (str): the function call arguments, a JSON object
+        function (dict): the function schema the arguments should follow
+    Returns:
+        list[str]: a short description of each problem
+    """
+    try:
+        data = json.loads(output)
+    except (json.decoder.JSONDecodeError, TypeError):
+        return ['invalid JSON']
+    if not isinstance(data, dict):
+        return ['not a JSON object']
+
+    problems = []
+    for name, schema in function['parameters']['properties'].items():
+        if name not in data:
+            problems.append(f'missing {name}')
+            continue
+        value = data[name]
+        if schema['type'] == 'integer':
+            if not isinstance(value, int) or isinstance(value, bool):
+                problems.append(f'{name} is not an integer')
+            elif not RATING_RANGE[0] <= value <= RATING_RANGE[1]:
+                problems.append(f'{name} out of range')
+        elif schema['type'] == 'number':
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                problems.append(f'{name} is not a number')
+            elif not RATING_RANGE[0] <= value <= RATING_RANGE[1]:
+                problems.append(f'{name} out of range')
+        elif schema['type'] == 'string':
+            if not isinstance(value, str):
+                problems.append(f'{name} is not a string')
+            elif name in LIST_STRING_FIELDS and not is_string_list(value):
+                problems.append(f'{name} is not a list')
+    return problems
+
+
+def is_string_list(value: str) -> bool:
+    """
+    Returns True if `value` is a JSON list of strings.
+    """
+    try:
+        items = json.loads(value)
+    except json.decoder.JSONDecodeError:
+        return False
+    return isinstance(items, list) and all(isinstance(item, str) for item in items)
+
+
+def strip_code_fences(text: str) -> str:
+    """
+    Returns the text inside a markdown code fence, e.g. ```json ... ```, or the text unchanged.
+    """
+    match = CODE_FENCE.search(text)
+    return match.group(1) if match else text
+
+
+def lenient_json_loads(text: str):
+    """
+    Parses JSON which may be wrapped in a code fence or surrounding prose, or have trailing commas.
+    Args:
+        text (str): the text to parse
+    Returns:
+        the parsed value
+    Raises:
+        json.decoder.JSONDecodeError: if the text can't be recovered
+    """
+    try:
+        return json.loads(text)
+    except json.decoder.JSONDecodeError as error:
+        first_error = error
+    text = strip_code_fences(text).strip()
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    text = TRAILING_COMMA.sub(r'\1', text)
+    try:
+        # strict=False allows raw newlines inside strings, which models sometimes return
+        return json.loads(text, strict=False)
+    except json.decoder.JSONDecodeError:
+        raise first_error
+
+
+def _coerce_number(value):
+    """
+    Returns a rating as a number, from an int, float or text like "0.7" or "7/10", or None if there
+    is no number. Ratings out of range are left for validation to reject, as they aren't a formatting slip.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str) and NUMBER.search(value):
+        return float(NUMBER.search(value).group())
+    return None
+
+
+def _coerce_integer(value):
+    """
+    Returns a rating as an int, as `_coerce_number` reads it, or None if there is no number.
+    """
+    number = _coerce_number(value)
+    return None if number is None else int(round(number))
+
+
+def _coerce_string_list(value) -> str | None:
+    """
+    Returns a JSON list of strings from a list, a JSON list string, or text like "a, b" or "[a, b]",
+    or None if the value can't be read as a list.
+    """
+    if isinstance(value, str):
+        if is_string_list(value):
+            return value
+        try:
+            value = json.loads(value)
+        except json.decoder.JSONDecodeError:
+            value = [item.strip().strip('"\'') for item in value.strip().strip('[]').split(',')]
+    if not isinstance(value, list):
+        return None
+    return json.dumps([str(item) for item in value if str(item).strip()])
+
+
+def parse_string_list(value) -> list[str]:
+    """
+    Returns a list field such as tags as a Python list, reading it as leniently as `repair_output`
+    does, or an empty list if it can't be read.
+    """
+    coerced = _coerce_string_list(value)
+    return json.loads(coerced) if coerced is not None else []
+
+
+def repair_output(output: str, function: dict) -> str | None:
+    """
+    Tries to fix function call arguments locally: lenient JSON parsing, then coercing each field
+    to the type the schema asks for. Fields the schema doesn't ask for are kept as they are.
+    Args:
+        output (str): the function call arguments
+        function (dict): the function schema the arguments should follow
+    Returns:
+        str: the repaired arguments, or None if they can't be repaired
+    """
+    try:
+        data = lenient_json_loads(output)
+    except (json.decoder.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    for name, schema in function['parameters']['properties'].items():
+        if name not in data:
+            continue
+        if schema['type'] == 'integer':
+            coerced = _coerce_integer(data[name])
+        elif schema['type'] == 'number':
+            coerced = _coerce_number(data[name])
+        elif name in LIST_STRING_FIELDS:
+            coerced = _coerce_string_list(data[name])
+        elif schema['type'] == 'string':
+            coerced = data[name] if isinstance(data[name], str) else json.dumps(data[name])
+        else:
+            coerced = data[name]
+        if coerced is not None:
+            data[name] = coerced
+
+    repaired = json.dumps(data)
+    return repaired if not validate_output(repaired, function) else None
+
+
+def fallback_output(output: str, function: dict) -> str:
+    """
+    Returns the arguments with every missing or invalid field replaced by an empty value, for
+    outputs that couldn't be repaired or retried. Ratings are null, tags an empty list.
+    """
+    try:
+        data = lenient_json_loads(output)
+    except (json.decoder.JSONDecodeError, TypeError):
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    for name, schema in function['parameters']['properties'].items():
+        if validate_output(json.dumps({name: data.get(name)}), _single_field(function, name)):
+            if schema['type'] in ('integer', 'number'):
+                data[name] = None
+            elif name in LIST_STRING_FIELDS:
+                data[name] = '[]'
+            else:
+                data[name] = ''
+    return json.dumps(data)
+
+
+def _single_field(function: dict, name: str) -> dict:
+    """
+    Returns a copy of the schema that only asks for one field.
+    """
+    return {'parameters': {'properties': {name: function['parameters']['properties'][name]}}}
@@ -2,10 +2,129 @@
 return a dataframe with timestamp and text
 """
 
+import numpy as np
 import pandas as pd
 import textract as tx
 import regex as re
 
+from chunking import chunk_by_tokens, speaker_text
+from vtt_parser import iter_cues
+
+# words which people say when they are thinking like 'oh' and 'um' and 'ah'.
+THINKING_WORDS = ['oh', 'um', 'ah', 'uh', 'er', 'mm',
+                  'hm', 'hmm', 'hmmm', 'huh', 'uhh',
+                  'uhm', 'uhmm', 'uhhmm']
+# matches a whole whitespace-separated thinking word, plus the whitespace before it
+THINKING_WORDS_PATTERN = r'(?:^|\s+)(?:' + '|'.join(THINKING_WORDS) + r')(?=\s|$)'
+THINKING_WORDS_REGEX = re.compile(THINKING_WORDS_PATTERN)
+
+
+def iter_yt_captions(file_path):
+    """
+    Yields (timestamp, text) pairs from a YouTube transcript, reading one line at a
+    time so that nothing waits for the whole file. See `VideoTranscript._read_file_yt`
+    for the format.
+    Args:
+        file_path (str): path to the text file
+    """
+    with open(file_path, 'r', encoding='UTF-8') as f:
+        for timestamp in f:
+            text = f.readline()
+            if not text:
+                return
+            yield timestamp.strip(), text.strip()
+
+
+def remove_thinking_words(text: str) -> str:
+    """
+    Removes thinking words from a single caption, as `VideoTranscript._remove_thinking_words` does for a column.
+    """
+    return ' '.join(THINKING_WORDS_REGEX.sub('', text).split())
+
+
+def timestamp_to_seconds(timestamp) -> int:
+    """
+    Converts a MM:SS or HH:MM:SS timestamp to seconds. Numbers are assumed to be seconds already.
+    """
+    if not isinstance(timestamp, str):
+        return int(timestamp)
+    seconds = 0
+    for part in timestamp.split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def iter_rolled_up_chunks(captions, chunksize=10, with_speakers=False):
+    """
+    Lazily rolls up (timestamp, text) captions into chunks of `chunksize`, the streaming
+    equivalent of `VideoTranscript.roll_up_df`. Each chunk is yielded as soon as its
+    last caption has been read.
+    Args:
+        captions (iterable): (timestamp, text) pairs, e.g. from `iter_yt_captions`, or
+        (timestamp, speaker, text) triples if `with_speakers` is set
+        chunksize (int): the number of captions to roll up into one chunk
+        with_speakers (bool): whether the captions have speakers, which label each caption's text
+        and are listed in each chunk
+    Yields:
+        dict: the chunk's first timestamp in seconds and its concatenated text
+    """
+    if chunksize < 1:
+        raise ValueError('chunksize must be greater than 0')
+
+    def make_chunk(timestamp, texts, speakers):
+        chunk = {'timestamp': timestamp, 'text': ' '.join(texts)}
+        if with_speakers:
+            chunk['speakers'] = list(dict.fromkeys(speaker for speaker in speakers if speaker is not None))
+        return chunk
+
+    timestamp, texts, speakers = None, [], []
+    for caption in captions:
+        if with_speakers:
+            caption_timestamp, speaker, text = caption
+        else:
+            (caption_timestamp, text), speaker = caption, None
+        if not texts:
+            timestamp = timestamp_to_seconds(caption_timestamp)
+        texts.append(speaker_text(remove_thinking_words(text), speaker))
+        speakers.append(speaker)
+        if len(texts) == chunksize:
+            yield make_chunk(timestamp, texts, speakers)
+            texts, speakers = [], []
+    if texts:
+        yield make_chunk(timestamp, texts, speakers)
+
+
+def stream_transcript_chunks(file_path, chunksize=10, source="YT", chunk_tokens=None,
+                             chunk_overlap_tokens=0, chunk_boundary=None):
+    """
+    Returns a generator of rolled-up chunks read lazily from a transcript file, so that
+    prompts can be sent while the rest of the file is still being parsed.
+    Args:
+        file_path (str): path to the text file
+        chunksize (int): number of rows to roll up into one row
+        source (str): the tool used to transcribe the recording
+        chunk_tokens (int): if set, chunk to this many tokens instead of `chunksize` rows
+        chunk_overlap_tokens (int): tokens of context repeated from the previous chunk
+        chunk_boundary (str): None, "sentence" or "speaker"; see chunking.chunk_by_tokens
+    """
+    if source == "YT":
+        captions = iter_yt_captions(file_path)
+        if chunk_tokens is None:
+            return iter_rolled_up_chunks(captions, chunksize=chunksize)
+        rows = ({'timestamp': timestamp_to_seconds(timestamp), 'text': remove_thinking_words(text)}
+                for timestamp, text in captions)
+    elif source == "TEAMS":
+        captions = iter_cues(file_path)
+        if chunk_tokens is None:
+            return iter_rolled_up_chunks(captions, chunksize=chunksize, with_speakers=True)
+        rows = ({'timestamp': timestamp_to_seconds(timestamp), 'speaker': speaker, 'text': remove_thinking_words(text)}
+                for timestamp, speaker, text in captions)
+    else:
+        raise ValueError("Source type not recognised")
+
+    return chunk_by_tokens(rows, max_tokens=chunk_tokens, overlap_tokens=chunk_overlap_tokens,
+                           boundary=chunk_boundary)
+
 
 class VideoTranscript():
     """
@@ -14,11 +133,17 @@ class VideoTranscript():
     used to transcribe it (YouTube, Teams, etc.)
     """
 
-    def __init__(self, file_path, chunksize=10, source="YT"):
+    def __init__(self, file_path, chunksize=10, source="YT", chunk_tokens=None,
+                 chunk_overlap_tokens=0, chunk_boundary=None):
         """
         Args:
             file_path (str): path to the text file
             chunksize (int): number of rows to roll up into one row
+            source (str): the tool used to transcribe the recording, "YT" or "TEAMS"
+            chunk_tokens (int): if set, roll rows up into chunks of about this many tokens
+            instead of a fixed number of rows, so that every request is a similar size
+            chunk_overlap_tokens (int): tokens of context repeated from the previous chunk
+            chunk_boundary (str): None, "sentence" or "speaker"; see chunking.chunk_by_tokens
         """
 
         self.file_path = file_path
@@ -29,7 +154,11 @@ class VideoTranscript():
         else:
             raise ValueError("Source type not recognised")
         self._remove_thinking_words()
-        self.roll_up_df(chunksize=chunksize)
+        if chunk_tokens is None:
+            self.roll_up_df(chunksize=chunksize)
+        else:
+            self.roll_up_df_by_tokens(chunk_tokens, overlap_tokens=chunk_overlap_tokens,
+                                      boundary=chunk_boundary)
 
     def _read_file_yt(self):
         """
@@ -52,33 +181,45 @@ class VideoTranscript():
             ```
         """
         with open(self.file_path, 'r', encoding='UTF-8') as f:
-            lines = f.readlines()
+            lines = f.read().splitlines()
         # remove the last line if it is empty
-        if lines[-1] == '':
+        if lines and lines[-1] == '':
             lines = lines[:-1]
-        # create a list of tuples with timestamp and text
-        data = []
-        for i in range(0, len(lines), 2):
-            data.append((lines[i].strip(), lines[i+1].strip()))
-        # create a dataframe
-        data_frame = pd.DataFrame(data, columns=['timestamp', 'text'])
+        # timestamps are on even lines and text on odd lines
+        pairs = len(lines) // 2
+        data_frame = pd.DataFrame({'timestamp': lines[0:2 * pairs:2], 'text': lines[1:2 * pairs:2]})
+        data_frame['timestamp'] = data_frame['timestamp'].str.strip()
+        data_frame['text'] = data_frame['text'].str.strip()
         return data_frame
 
 
+    def _read_file_teams(self):
+        """
+        Read a WebVTT (or SRT) caption file, as exported by Teams, and return a dataframe
+        with timestamp, speaker and text. Timestamps are cue start times in whole seconds.
+
+        Text file has the following format:
+            ```
+            WEBVTT
+
+            0f3c2a1e-8c1d-4b61-9a3f-3b3b1f1c2d4e/12-0
+            00:00:03.120 --> 00:00:07.480
+            <v Jane Smith>So I think we are fine to get started and
+            the first thing on the agenda</v>
+            ```
+        """
+        data_frame = pd.DataFrame(iter_cues(self.file_path), columns=['timestamp', 'speaker', 'text'])
+        data_frame['timestamp'] = data_frame['timestamp'].astype(int)
+        return data_frame
+
     def _remove_thinking_words(self):
         """
         Remove simple stopwords from the text column.
         """
-        # create a list of words which people say when they are thinking like
-        # 'oh' and 'um' and 'ah'.
-        thinking_words = ['oh', 'um', 'ah', 'uh', 'er', 'mm',
-                          'hm', 'hmm', 'hmmm', 'huh', 'uhh',
-                          'uhm', 'uhmm', 'uhhmm']
-
-        # remove the thinking words
-        self.data_frame['text'] = self.data_frame['text'].apply(
-            lambda x: ' '.join([word for word in x.split() if word not in
-                                thinking_words]))
+        # remove the thinking words in one regex pass, then normalise the whitespace
+        # the same way that splitting and re-joining on spaces would
+        text = self.data_frame['text'].str.replace(THINKING_WORDS_PATTERN, '', regex=True)
+        self.data_frame['text'] = text.str.replace(r'\s+', ' ', regex=True).str.strip()
 
     def _timestamp_helper(self, timestamp: str):
         """
@@ -99,30 +240,51 @@ class VideoTranscript():
         time = self._timestamp_helper(timestamp)
         return time.hour * 3600 + time.minute * 60 + time.second
 
+    def _timestamps_to_seconds(self, timestamps: pd.Series) -> pd.Series:
+        """
+        Vectorised version of `_timestamp_to_seconds` for a whole column. Timestamps
+        can be a mix of MM:SS and HH:MM:SS, or already be numbers of seconds.
+        """
+        if pd.api.types.is_numeric_dtype(timestamps):
+            return timestamps.astype(int)
+        parts = timestamps.str.split(':', expand=True)
+        if parts.shape[1] == 2:
+            parts[2] = None
+        fields = parts.notna().sum(axis=1).to_numpy()
+        values = parts.astype(float).fillna(0).to_numpy()
+        seconds = np.where(fields == 3,
+                           values[:, 0] * 3600 + values[:, 1] * 60 + values[:, 2],
+                           values[:, 0] * 60 + values[:, 1])
+        return pd.Series(seconds.astype(int), index=timestamps.index)
+
     def rollup_df(self, df, n):
         """
         Roll up the dataframe into chunks of the given size, concatenating
         the text from all consituent rows and using the first timestamp.
         """
 
-        # Create an empty dictionary to hold the new rolled-up data
-        rolled_up_data = {"timestamp": [], "text": []}
-
-        # Iterate through the DataFrame in chunks of size n
-        for i in range(0, len(df), n):
-            # Get the first value of the first column in the chunk
-            col1_value = df.iloc[i]["timestamp"]
-
-            # Get all the values of the second column in the chunk and
-            # concatenate them
-            col2_value = " ".join(df.iloc[i:i+n]["text"].values)
-
-            # Append the rolled-up data to the dictionary
-            rolled_up_data["timestamp"].append(col1_value)
-            rolled_up_data["text"].append(col2_value)
-
-        # Convert the rolled-up data into a new DataFrame and return it
-        return pd.DataFrame(rolled_up_data)
+        # group consecutive rows by their position divided by the chunk size
+        chunk_ids = np.arange(len(df)) // n
+        text = df["text"]
+        if "speaker" in df.columns:
+            # label each caption with its speaker, as chunking.speaker_text does, so the model knows who said what
+            text = text.where(df["speaker"].isna(), df["speaker"] + ": " + text)
+        grouped = text.groupby(chunk_ids, sort=False)
+        rolled_up = pd.DataFrame({
+            "timestamp": df["timestamp"].groupby(chunk_ids, sort=False).first(),
+            "text": grouped.agg(" ".join),
+        })
+        if "speaker" in df.columns:
+            # the distinct speakers in each chunk, in order of first appearance
+            speakers = pd.DataFrame({"chunk": chunk_ids, "speaker": df["speaker"].to_numpy()})
+            speakers = speakers.dropna().drop_duplicates()
+            # rows are still in chunk order, so each chunk's speakers are a contiguous run
+            chunks = speakers["chunk"].to_numpy()
+            starts = np.flatnonzero(np.diff(chunks)) + 1
+            speaker_lists = dict(zip(chunks[np.r_[0, starts]] if len(chunks) else [],
+                                     (list(run) for run in np.split(speakers["speaker"].to_numpy(), starts))))
+            rolled_up["speakers"] = [speaker_lists.get(chunk, []) for chunk in rolled_up.index]
+        return rolled_up.reset_index(drop=True)
 
     def roll_up_df(self, chunksize=10):
         """
@@ -138,11 +300,24 @@ class VideoTranscript():
             return self.data_frame
 
         else:
-            self.data_frame['timestamp'] = self.data_frame['timestamp'].apply(
-                lambda x: self._timestamp_to_seconds(x))
+            self.data_frame['timestamp'] = self._timestamps_to_seconds(self.data_frame['timestamp'])
 
             self.data_frame = self.rollup_df(self.data_frame, chunksize)
 
+    def roll_up_df_by_tokens(self, max_tokens, overlap_tokens=0, boundary=None):
+        """
+        Roll up the dataframe into chunks of at most `max_tokens` tokens, concatenating
+        the text from all consituent rows and using the first timestamp.
+        Args:
+            max_tokens: the token budget per chunk.
+            overlap_tokens: tokens of trailing rows repeated at the start of the next chunk.
+            boundary: None, "sentence" or "speaker"; see chunking.chunk_by_tokens.
+        """
+        self.data_frame['timestamp'] = self._timestamps_to_seconds(self.data_frame['timestamp'])
+        chunks = chunk_by_tokens(self.data_frame.to_dict('records'), max_tokens=max_tokens,
+                                 overlap_tokens=overlap_tokens, boundary=boundary)
+        self.data_frame = pd.DataFrame(list(chunks))
+
     def get_data_frame(self):
         """
         Return the dataframe.
@@ -0,0 +1,210 @@
+"""
+Token-bucket rate limiting against OpenAI's requests-per-minute (RPM) and
+tokens-per-minute (TPM) quotas. Both prompt engines share one limiter, so
+that running them side by side can't exceed the organisation's budget.
+
+Budgets are set per model in DEFAULT_RATE_LIMITS, and can be overridden with
+the OPENAI_RATE_LIMITS environment variable, e.g.
+    OPENAI_RATE_LIMITS='{"gpt-4-turbo-preview": {"rpm": 500, "tpm": 150000}}'
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+from utils.tokens import estimate_prompt_tokens
+
+# conservative defaults; set OPENAI_RATE_LIMITS to match your organisation's tier
+DEFAULT_RATE_LIMITS = {
+    "gpt-4-turbo-preview": {"rpm": 500, "tpm": 300_000},
+    "gpt-4o": {"rpm": 500, "tpm": 300_000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200_000},
+    "gpt-3.5-turbo": {"rpm": 3_500, "tpm": 200_000},
+    "text-embedding-ada-002": {"rpm": 3_000, "tpm": 1_000_000},
+    "default": {"rpm": 500, "tpm": 200_000},
+}
+
+# tokens reserved for the reply when a request doesn't set max_tokens
+DEFAULT_COMPLETION_TOKENS = 400
+
+
+def estimate_request_tokens(request: dict) -> int:
+    """
+    Estimates the tokens a chat request will count against the TPM budget: the
+    prompt, plus `max_tokens` (or a default allowance) for the reply.
+    Args:
+        request (dict): the keyword arguments for `chat.completions.create`
+    Returns:
+        int: the estimated total tokens
+    """
+    prompt_tokens = estimate_prompt_tokens(request["messages"], request.get("functions"), request["model"])
+    return prompt_tokens + (request.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    """
+    A token bucket holding up to `capacity` tokens and refilling at `rate`
+    tokens per second. Callers reserve tokens up front and are told how long
+    to wait; the balance may go negative, which makes later callers wait in
+    turn rather than all waking at once.
+    """
+
+    def __init__(self, capacity: float, rate: float, clock=time.monotonic):
+        """
+        Args:
+            capacity (float): the maximum number of tokens in the bucket
+            rate (float): tokens added per second
+            clock (callable): returns the current time in seconds
+        """
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes `amount` tokens from the bucket.
+        Args:
+            amount (float): the number of tokens to take
+        Returns:
+            float: seconds to wait before the reservation is covered
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount: float):
+        """
+        Returns tokens to the bucket, e.g. when a reservation overestimated usage.
+        A negative amount charges the bucket instead.
+        Args:
+            amount (float): the number of tokens to return
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """
+    Paces requests against per-model RPM and TPM budgets.
+    """
+
+    def __init__(self, limits: dict | None = None, clock=time.monotonic):
+        """
+        Args:
+            limits (dict): model name -> {"rpm": int, "tpm": int}. The "default" entry
+            is used for models that aren't listed.
+            clock (callable): returns the current time in seconds
+        """
+        self.limits = dict(DEFAULT_RATE_LIMITS if limits is None else limits)
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def configure(self, model: str, rpm: int, tpm: int):
+        """
+        Sets the budget for a model, replacing any existing buckets.
+        Args:
+            model (str): the model name
+            rpm (int): requests per minute
+            tpm (int): tokens per minute
+        """
+        with self._lock:
+            self.limits[model] = {"rpm": rpm, "tpm": tpm}
+            self._buckets.pop(model, None)
+
+    def _get_buckets(self, model: str) -> tuple[TokenBucket, TokenBucket]:
+        with self._lock:
+            if model not in self._buckets:
+                limit = self.limits.get(model, self.limits["default"])
+                self._buckets[model] = (
+                    TokenBucket(limit["rpm"], limit["rpm"] / 60, self.clock),
+                    TokenBucket(limit["tpm"], limit["tpm"] / 60, self.clock),
+                )
+            return self._buckets[model]
+
+    def reserve(self, model: str, tokens: int) -> float:
+        """
+        Reserves one request and `tokens` tokens for a model.
+        Args:
+            model (str): the model name
+            tokens (int): the estimated prompt plus completion tokens
+        Returns:
+            float: seconds to wait before sending the request
+        """
+        requests_bucket, tokens_bucket = self._get_buckets(model)
+        return max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+
+    def acquire(self, model: str, tokens: int):
+        """
+        Blocks until a request of `tokens` tokens fits in the model's budget.
+        """
+        wait = self.reserve(model, tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, model: str, tokens: int):
+        """
+        Waits, without blocking the event loop, until a request of `tokens` tokens fits in the model's budget.
+        """
+        wait = self.reserve(model, tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def reconcile(self, model: str, reserved: int, used: int):
+        """
+        Corrects the token budget once the actual usage of a request is known.
+        Args:
+            model (str): the model name
+            reserved (int): the tokens reserved before sending
+            used (int): the total tokens reported in `response.usage`
+        """
+        _, tokens_bucket = self._get_buckets(model)
+        tokens_bucket.refund(reserved - used)
+
+    def release(self, model: str, reserved: int):
+        """
+        Returns a whole token reservation to the budget, for a request which failed and so used
+        no tokens. Without this, each retry during a run of 429s would reserve its tokens again
+        on top of the ones never used.
+        Args:
+            model (str): the model name
+            reserved (int): the tokens reserved before sending
+        """
+        self.reconcile(model, reserved, 0)
+
+
+def load_rate_limits() -> dict:
+    """
+    Returns the default rate limits updated with any set in OPENAI_RATE_LIMITS.
+    """
+    limits = {model: dict(limit) for model, limit in DEFAULT_RATE_LIMITS.items()}
+    overrides = os.getenv("OPENAI_RATE_LIMITS")
+    if overrides:
+        for model, limit in json.loads(overrides).items():
+            limits.setdefault(model, dict(limits["default"])).update(limit)
+    return limits
+
+
+_shared_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Returns the process-wide rate limiter shared by the prompt engines.
+    """
+    global _shared_limiter
+    if _shared_limiter is None:
+        _shared_limiter = RateLimiter(load_rate_limits())
+    return _shared_limiter
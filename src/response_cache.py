@@ -0,0 +1,165 @@
+"""
+A persistent, content-addressed cache for chat completion responses. Each
+response is stored in SQLite under a hash of the full request (model,
+temperature, messages, function schema and other parameters), so re-running
+the pipeline only pays for chunks whose prompt actually changed.
+
+The cache is configured with environment variables:
+    OPENAI_CACHE_MODE: "readwrite" (default), "readonly" or "off"
+    OPENAI_CACHE_PATH: the SQLite file, default data/cache/responses.sqlite
+    OPENAI_CACHE_MAX_MB: the size above which least recently used entries are evicted
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "data/cache/responses.sqlite"
+DEFAULT_CACHE_MAX_MB = 512
+CACHE_MODES = ("readwrite", "readonly", "off")
+
+
+def request_cache_key(request: dict) -> str:
+    """
+    Returns the cache key for a request: a SHA-256 of its canonical JSON.
+    Args:
+        request (dict): the keyword arguments for `chat.completions.create`
+    Returns:
+        str: the hex digest
+    """
+    canonical = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with least-recently-used eviction once the stored
+    responses exceed `max_bytes`. In read-only mode the database is opened read-only,
+    lookups don't update access times and `put` does nothing, so a shared cache can
+    be used without being modified.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024,
+                 read_only: bool = False):
+        """
+        Args:
+            path (str): the SQLite file to use
+            max_bytes (int): the total response size above which entries are evicted
+            read_only (bool): whether to only read from the cache
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = self._connect()
+
+    def _connect(self):
+        """
+        Opens the database, creating it if needed. Returns None if the cache is
+        read-only and doesn't exist yet, in which case every lookup misses.
+        """
+        if self.read_only:
+            if not os.path.exists(self.path):
+                return None
+            return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        connection.commit()
+        return connection
+
+    def get(self, key: str) -> dict | None:
+        """
+        Returns the cached response for a key, or None.
+        Args:
+            key (str): the request key from `request_cache_key`
+        """
+        if self._connection is None:
+            self.misses += 1
+            return None
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                self._connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict, model: str | None = None):
+        """
+        Stores a response, then evicts the least recently used entries if the cache is over size.
+        Args:
+            key (str): the request key from `request_cache_key`
+            response (dict): the JSON-serialisable response
+            model (str): the model name, kept for inspecting the cache
+        """
+        if self.read_only:
+            return
+        blob = json.dumps(response)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (key, model, blob, len(blob), now, now))
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """
+        Deletes least recently used entries until the total size is within `max_bytes`.
+        """
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+_shared_cache = None
+
+
+def get_response_cache() -> ResponseCache | None:
+    """
+    Returns the process-wide response cache configured from the environment,
+    or None if caching is turned off.
+    """
+    global _shared_cache
+    mode = os.getenv("OPENAI_CACHE_MODE", "readwrite").lower()
+    if mode not in CACHE_MODES:
+        raise ValueError(f"OPENAI_CACHE_MODE must be one of {CACHE_MODES}, not {mode!r}")
+    if mode == "off":
+        return None
+    if _shared_cache is None:
+        _shared_cache = ResponseCache(
+            path=os.getenv("OPENAI_CACHE_PATH", DEFAULT_CACHE_PATH),
+            max_bytes=int(float(os.getenv("OPENAI_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)) * 1024 * 1024),
+            read_only=mode == "readonly")
+    return _shared_cache
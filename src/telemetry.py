@@ -0,0 +1,250 @@
+"""
+Per-request telemetry for the OpenAI calls made by the engines. Every call
+records its queue wait (rate limiter and concurrency slot), API latency, token
+usage, retry attempt, HTTP status and estimated cost. Records are kept in memory
+for the end-of-run summary and appended to a JSONL log, and running totals can
+be written in the Prometheus text format, e.g. for node_exporter's textfile
+collector.
+
+The output directory is set with OPENAI_TELEMETRY_DIR (default data/telemetry),
+or "off" to keep records in memory only.
+"""
+
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.common import atomic_write
+from utils.tokens import estimate_cost
+
+DEFAULT_TELEMETRY_DIR = "data/telemetry"
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, math.inf)
+
+# set by async_engine.request_with_retries for the request running in the current task
+attempt_var = contextvars.ContextVar('attempt', default=0)
+slot_wait_var = contextvars.ContextVar('slot_wait', default=0.0)
+# if set to a list, the records of every call made in the current task are also added to it,
+# e.g. to total the usage of one item's calls including any retries
+task_records_var = contextvars.ContextVar('task_records', default=None)
+
+
+def _usage_tokens(usage) -> tuple[int, int]:
+    """
+    Returns (prompt_tokens, completion_tokens) from a usage object or dict, or zeros if there is none.
+    """
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    return usage.prompt_tokens, getattr(usage, 'completion_tokens', 0) or 0
+
+
+class Telemetry:
+    """
+    Collects one record per API call and summarises them.
+    """
+
+    def __init__(self, directory: str | None = None):
+        """
+        Args:
+            directory (str): where to write requests.jsonl and metrics.prom, or None to only keep records in memory
+        """
+        self.records = []
+        self.log_path = None
+        self.metrics_path = None
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.log_path = os.path.join(directory, 'requests.jsonl')
+            self.metrics_path = os.path.join(directory, 'metrics.prom')
+
+    def record(self, model: str, endpoint: str, latency_seconds: float = 0.0, queue_seconds: float = 0.0,
+               status: int | str | None = 200, usage=None, cached: bool = False, **extra) -> dict:
+        """
+        Records one API call, or one response served from the cache.
+        Args:
+            model (str): the model called
+            endpoint (str): e.g. "chat" or "embeddings", or "batch" for a Batch API response, which
+            is priced at the batch rate and has no latency of its own
+            latency_seconds (float): the time from sending the request to having the whole response
+            queue_seconds (float): the time spent waiting for the rate limiter before sending. The wait
+            for a concurrency slot in async_engine is added to this.
+            status (int): the HTTP status, or "error" for failures without one
+            usage: the response's usage, as an object or dict
+            cached (bool): True if the response came from the response cache, so cost nothing
+            extra: any other fields to record
+        Returns:
+            dict: the record
+        """
+        prompt_tokens, completion_tokens = _usage_tokens(usage)
+        record = {
+            'time': time.time(),
+            'model': model,
+            'endpoint': endpoint,
+            'status': status,
+            'cached': cached,
+            'attempt': attempt_var.get(),
+            'queue_seconds': queue_seconds + slot_wait_var.get(),
+            'latency_seconds': latency_seconds,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost_usd': 0.0 if cached else estimate_cost(model, prompt_tokens, completion_tokens,
+                                                         batch=endpoint == "batch"),
+            **extra,
+        }
+        task_records = task_records_var.get()
+        if task_records is not None:
+            task_records.append(record)
+        with self._lock:
+            self.records.append(record)
+            if self.log_path is not None:
+                with open(self.log_path, 'a', encoding='UTF-8') as f:
+                    f.write(json.dumps(record) + '\n')
+        return record
+
+    @contextmanager
+    def track(self, model: str, endpoint: str, queue_seconds: float = 0.0):
+        """
+        Times an API call and records it when the block exits, including calls that raise.
+        The block can set 'status', 'usage' and any extra fields on the yielded dict.
+
+            with get_telemetry().track(engine, "chat", queue_seconds) as call:
+                response = client.chat.completions.create(**request)
+                call['usage'] = response.usage
+        """
+        call = {'status': 200, 'usage': None}
+        started = time.monotonic()
+        try:
+            yield call
+        except Exception as error:
+            call['status'] = getattr(error, 'status_code', None) or getattr(error, 'http_status', None) or 'error'
+            raise
+        finally:
+            self.record(model, endpoint, latency_seconds=time.monotonic() - started,
+                        queue_seconds=queue_seconds, **call)
+
+    def mark(self) -> int:
+        """
+        Returns a marker for the current position, to summarise only the records after it.
+        """
+        return len(self.records)
+
+    def summary(self, since: int = 0, transcripts: int = 1) -> dict:
+        """
+        Summarises the records since a `mark`.
+        Args:
+            since (int): the marker returned by `mark` at the start of the run
+            transcripts (int): the number of transcripts processed, for the cost per transcript
+        Returns:
+            dict: call counts, latency percentiles, token throughput and cost
+        """
+        records = self.records[since:]
+        sent = [record for record in records if not record['cached']]
+        latencies = [record['latency_seconds'] for record in sent
+                     if record['status'] == 200 and record['endpoint'] != "batch"]
+        tokens = sum(record['prompt_tokens'] + record['completion_tokens'] for record in records)
+        cost = sum(record['cost_usd'] for record in records)
+        if records:
+            # from the first request being sent to the last response arriving
+            elapsed = max(r['time'] for r in records) - min(r['time'] - r['latency_seconds'] for r in records)
+        else:
+            elapsed = 0.0
+        return {
+            'calls': len(sent),
+            'cached': len(records) - len(sent),
+            'errors': sum(1 for record in sent if record['status'] != 200),
+            'retries': sum(1 for record in sent if record['attempt'] > 0),
+            'latency_p50': float(np.percentile(latencies, 50)) if latencies else None,
+            'latency_p95': float(np.percentile(latencies, 95)) if latencies else None,
+            'latency_p99': float(np.percentile(latencies, 99)) if latencies else None,
+            'queue_p95': float(np.percentile([r['queue_seconds'] for r in sent], 95)) if sent else None,
+            'tokens': tokens,
+            'tokens_per_second': tokens / elapsed if elapsed > 0 else 0.0,
+            'cost_usd': cost,
+            'cost_usd_per_transcript': cost / transcripts if transcripts else 0.0,
+        }
+
+    def print_summary(self, since: int = 0, transcripts: int = 1):
+        """
+        Prints the `summary` of a run, and writes the Prometheus metrics if configured.
+        """
+        summary = self.summary(since, transcripts)
+        if summary['calls']:
+            print(f"{summary['calls']} API calls ({summary['cached']} cached, {summary['retries']} retries, "
+                  f"{summary['errors']} errors); latency p50 {summary['latency_p50'] or 0:.2f}s "
+                  f"p95 {summary['latency_p95'] or 0:.2f}s p99 {summary['latency_p99'] or 0:.2f}s, "
+                  f"queue p95 {summary['queue_p95']:.2f}s; {summary['tokens_per_second']:.0f} tokens/s; "
+                  f"${summary['cost_usd']:.3f} (${summary['cost_usd_per_transcript']:.3f}/transcript)")
+        elif summary['cached']:
+            print(f"All {summary['cached']} responses were served from the cache")
+        if self.metrics_path is not None:
+            self.write_prometheus(self.metrics_path)
+        return summary
+
+    def write_prometheus(self, path: str):
+        """
+        Writes running totals over every record in the Prometheus text exposition format.
+        """
+        requests, tokens, cost, queue = {}, {}, {}, {}
+        latency = {}
+        for record in self.records:
+            model = record['model']
+            key = (model, record['endpoint'], str(record['status']), str(record['cached']).lower())
+            requests[key] = requests.get(key, 0) + 1
+            for kind in ('prompt', 'completion'):
+                tokens[(model, kind)] = tokens.get((model, kind), 0) + record[f'{kind}_tokens']
+            cost[model] = cost.get(model, 0.0) + record['cost_usd']
+            if record['cached'] or record['endpoint'] == "batch":
+                continue
+            total, count = queue.get(model, (0.0, 0))
+            queue[model] = (total + record['queue_seconds'], count + 1)
+            buckets, total, count = latency.get(model, ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+            for position, bound in enumerate(LATENCY_BUCKETS):
+                if record['latency_seconds'] <= bound:
+                    buckets[position] += 1
+            latency[model] = (buckets, total + record['latency_seconds'], count + 1)
+
+        lines = ['# HELP openai_requests_total OpenAI API calls and cache hits.',
+                 '# TYPE openai_requests_total counter']
+        lines += [f'openai_requests_total{{model="{m}",endpoint="{e}",status="{s}",cached="{c}"}} {n}'
+                  for (m, e, s, c), n in sorted(requests.items())]
+        lines += ['# HELP openai_tokens_total Tokens used, by model and kind.', '# TYPE openai_tokens_total counter']
+        lines += [f'openai_tokens_total{{model="{m}",kind="{k}"}} {n}' for (m, k), n in sorted(tokens.items())]
+        lines += ['# HELP openai_cost_usd_total Estimated cost in USD.', '# TYPE openai_cost_usd_total counter']
+        lines += [f'openai_cost_usd_total{{model="{m}"}} {value:.6f}' for m, value in sorted(cost.items())]
+        lines += ['# HELP openai_queue_wait_seconds Time waiting for the rate limiter and a concurrency slot.',
+                  '# TYPE openai_queue_wait_seconds summary']
+        for m, (total, count) in sorted(queue.items()):
+            lines += [f'openai_queue_wait_seconds_sum{{model="{m}"}} {total:.6f}',
+                      f'openai_queue_wait_seconds_count{{model="{m}"}} {count}']
+        lines += ['# HELP openai_request_latency_seconds API latency of calls sent.',
+                  '# TYPE openai_request_latency_seconds histogram']
+        for m, (buckets, total, count) in sorted(latency.items()):
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                le = '+Inf' if math.isinf(bound) else bound
+                lines.append(f'openai_request_latency_seconds_bucket{{model="{m}",le="{le}"}} {bucket}')
+            lines += [f'openai_request_latency_seconds_sum{{model="{m}"}} {total:.6f}',
+                      f'openai_request_latency_seconds_count{{model="{m}"}} {count}']
+
+        with atomic_write(path, 'w', encoding='UTF-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+_shared_telemetry = None
+
+
+def get_telemetry() -> Telemetry:
+    """
+    Returns the process-wide telemetry configured from the environment.
+    """
+    global _shared_telemetry
+    if _shared_telemetry is None:
+        directory = os.getenv("OPENAI_TELEMETRY_DIR", DEFAULT_TELEMETRY_DIR)
+        _shared_telemetry = Telemetry(None if directory.lower() == "off" else directory)
+    return _shared_telemetry
@@ -0,0 +1,83 @@
+"""
+Topic assignment by clustering chunk embeddings, as a cheaper alternative to
+asking the LLM for a topic and tags on every chunk. Chunks are grouped with
+k-means on their embeddings, and each cluster is labelled by one LLM call over
+the few chunks nearest its centroid, so the generated topic tokens scale with
+the number of clusters rather than the number of chunks.
+
+See https://github.com/openai/openai-cookbook/blob/main/examples/Clustering.ipynb
+"""
+
+import numpy as np
+
+from vector_index import kmeans, normalise
+
+cluster_topic_functions = [
+    {
+        'name': 'getClusterTopic',
+        'description': 'Get the topic and tags shared by a group of excerpts from a transcript',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'topic': {
+                    'type': 'string',
+                    'description': 'A two or three word topic covering all of the excerpts'
+                },
+                'tags': {
+                    'type': 'string',
+                    'description': 'A comma separated list in square brackets of at most five important tags for the excerpts, each tag in quotes, e.g. ["tag1", "tag2", "tag3"]'
+                }
+            },
+            'required': ['topic', 'tags']
+        }
+    }
+]
+
+
+def default_cluster_count(num_chunks: int) -> int:
+    """
+    Returns a rule-of-thumb number of clusters, sqrt(n / 2), for n chunks.
+    """
+    return max(1, min(num_chunks, round(np.sqrt(num_chunks / 2))))
+
+
+def cluster_embeddings(matrix: np.ndarray, n_clusters: int | None = None, seed: int = 42):
+    """
+    Clusters chunk embeddings by cosine similarity. Clusters which k-means leaves empty are
+    dropped, so that no request is spent labelling a cluster without any chunks.
+    Args:
+        matrix (np.ndarray): the chunk embeddings, one per row
+        n_clusters (int): the number of clusters, defaulting to `default_cluster_count`
+        seed (int): the k-means seed
+    Returns:
+        tuple: the unit centroids of the non-empty clusters, at most `n_clusters`, and the cluster
+        of each chunk
+    """
+    vectors = normalise(matrix)
+    if n_clusters is None:
+        n_clusters = default_cluster_count(len(vectors))
+    centroids, assignments = kmeans(vectors, min(n_clusters, len(vectors)), seed=seed)
+    used, assignments = np.unique(assignments, return_inverse=True)
+    return centroids[used], assignments
+
+
+def representative_texts(texts: list[str], matrix: np.ndarray, centroids: np.ndarray, assignments: np.ndarray,
+                         per_cluster: int = 5) -> list[list[str]]:
+    """
+    Returns, for each cluster, the texts of up to `per_cluster` chunks nearest its centroid.
+    """
+    similarity = np.einsum('ij,ij->i', normalise(matrix), centroids[assignments])
+    samples = []
+    for cluster in range(len(centroids)):
+        members = np.flatnonzero(assignments == cluster)
+        nearest = members[np.argsort(-similarity[members])][:per_cluster]
+        samples.append([texts[i] for i in nearest])
+    return samples
+
+
+def make_cluster_prompt(samples: list[str]) -> str:
+    """
+    Returns the user message asking for the shared topic of a cluster's sample chunks.
+    """
+    excerpts = "\n\n".join(f"[excerpt {number}]\n{text}" for number, text in enumerate(samples, start=1))
+    return f"These excerpts from a transcript are all about the same subject.\n\n{excerpts}"
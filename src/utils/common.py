@@ -1,4 +1,7 @@
 # src/utils/common.py
+import os
+from contextlib import contextmanager
+
 import pandas as pd
 
 
@@ -55,3 +58,105 @@ def time_code_from_seconds(seconds: int) -> str:
     seconds = int(seconds - hours * 3600 - minutes * 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
+
+
+def time_codes_from_seconds(seconds: pd.Series) -> pd.Series:
+    """
+    Converts a column of seconds to HH:MM:SS, as `time_code_from_seconds` does for one value.
+    Args:
+        seconds (pd.Series): the number of seconds for each row
+    Returns:
+        pd.Series: the timecodes in HH:MM:SS format
+    """
+    seconds = seconds.astype('int64')
+    parts = [seconds // 3600, seconds % 3600 // 60, seconds % 60]
+    return parts[0].astype(str).str.zfill(2) + ':' + parts[1].astype(str).str.zfill(2) + ':' \
+        + parts[2].astype(str).str.zfill(2)
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'wb', encoding: str | None = None):
+    """
+    Opens a temporary file next to `path`, and swaps it in for `path` once the block completes, so
+    a reader such as a running dashboard never sees a half-written file, and a file that may be
+    memory-mapped is never overwritten in place. If the block raises, `path` is left as it was.
+    Args:
+        path (str): the file to write
+        mode (str): 'wb' to write bytes or 'w' to write text
+        encoding (str): the text encoding, for mode 'w'
+    Yields:
+        file: the open temporary file
+    """
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, mode, encoding=encoding) as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def columnar_path(json_path: str) -> str:
+    """
+    Returns the path of the Parquet copy of a JSON lines output file, e.g. output.parquet for output.json.
+    """
+    return os.path.splitext(json_path)[0] + '.parquet'
+
+
+def save_columnar(data_frame: pd.DataFrame, json_path: str) -> str | None:
+    """
+    Writes a Parquet copy of an output file next to it, with the timecode_text column added, so
+    the dashboard can load it without parsing JSON or formatting timecodes. Needs pyarrow, which
+    streamlit already depends on; without it the copy is skipped and the dashboard reads the JSON.
+    Args:
+        data_frame (pd.DataFrame): the output, as written to `json_path`
+        json_path (str): the JSON lines file the output was written to
+    Returns:
+        str: the path of the Parquet file, or None if it wasn't written
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("pyarrow is not installed, so no Parquet copy was written for the dashboard")
+        return None
+    data_frame = data_frame.reset_index(drop=True)
+    if 'timestamp' in data_frame.columns:
+        data_frame = data_frame.assign(timecode_text=time_codes_from_seconds(data_frame['timestamp']))
+    path = columnar_path(json_path)
+    with atomic_write(path) as f:
+        data_frame.to_parquet(f, index=False)
+    return path
+
+
+def load_output_frame(json_path: str) -> pd.DataFrame:
+    """
+    Loads an output file for the dashboard, from its Parquet copy if that is at least as new as
+    the JSON, otherwise from the JSON itself.
+    Args:
+        json_path (str): the JSON lines output file
+    Returns:
+        pd.DataFrame: the output, with a timecode_text column
+    """
+    path = columnar_path(json_path)
+    if os.path.exists(path) and (not os.path.exists(json_path)
+                                 or os.path.getmtime(path) >= os.path.getmtime(json_path)):
+        data_frame = pd.read_parquet(path)
+        # list columns such as tags come back as arrays, so turn them back into the lists the JSON holds
+        for column in data_frame.columns[data_frame.dtypes == object]:
+            if len(data_frame) and hasattr(data_frame[column].iloc[0], 'tolist'):
+                data_frame[column] = [value.tolist() for value in data_frame[column]]
+    else:
+        data_frame = pd.read_json(json_path, orient='records', lines=True)
+    if 'timecode_text' not in data_frame.columns:
+        data_frame['timecode_text'] = time_codes_from_seconds(data_frame['timestamp'])
+    return data_frame
+
+
+if __name__ == "__main__":
+    # writes the Parquet copy of an existing output file, e.g.
+    #   python src/utils/common.py data/final/v4output.json
+    import sys
+    for file_path in sys.argv[1:]:
+        print(save_columnar(pd.read_json(file_path, orient='records', lines=True), file_path))
@@ -0,0 +1,102 @@
+# src/utils/tokens.py
+import json
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a character-based estimate
+    tiktoken = None
+
+# the encoding used by gpt-3.5, gpt-4 and the text-embedding-ada-002/3 models
+DEFAULT_ENCODING = "cl100k_base"
+# rough characters-per-token ratio for English, used when tiktoken isn't installed
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """
+    Returns the tiktoken encoding for a model, or the default encoding for unknown models.
+    Args:
+        model (str): the model name
+    Returns:
+        tiktoken.Encoding: the encoding, or None if tiktoken isn't installed
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, model: str = "gpt-4-turbo-preview") -> int:
+    """
+    Counts the tokens in a piece of text.
+    Args:
+        text (str): the text to count
+        model (str): the model whose tokenizer to use
+    Returns:
+        int: the number of tokens
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def estimate_prompt_tokens(messages: list[dict], functions: list[dict] | None = None,
+                           model: str = "gpt-4-turbo-preview") -> int:
+    """
+    Estimates the prompt tokens for a chat request, following the OpenAI cookbook's
+    accounting of 3 tokens of overhead per message plus 3 to prime the reply. The
+    function schema is counted as its JSON text, which slightly overestimates it.
+    Args:
+        messages (list[dict]): the chat messages
+        functions (list[dict]): the function schemas sent with the request, if any
+        model (str): the model whose tokenizer to use
+    Returns:
+        int: the estimated number of prompt tokens
+    """
+    total = 3
+    for message in messages:
+        total += 3
+        for key, value in message.items():
+            if isinstance(value, str):
+                total += count_tokens(value, model)
+            if key == 'name':
+                total += 1
+    if functions:
+        total += count_tokens(json.dumps(functions), model)
+    return total
+
+
+# USD per million (prompt, completion) tokens; list prices at the time of writing, used for estimates only
+MODEL_PRICING = {
+    "gpt-4-turbo-preview": (10.00, 30.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+# the Batch API costs half the price of the interactive endpoints
+BATCH_PRICE_FACTOR = 0.5
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int = 0, batch: bool = False) -> float:
+    """
+    Estimates the cost of a request in USD from its token usage.
+    Args:
+        model (str): the model name
+        prompt_tokens (int): the prompt tokens used
+        completion_tokens (int): the completion tokens used
+        batch (bool): True if the request went through the Batch API, which is priced at a discount
+    Returns:
+        float: the estimated cost, or 0.0 for models without a listed price
+    """
+    prompt_price, completion_price = MODEL_PRICING.get(model, (0.0, 0.0))
+    cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if batch else cost
@@ -0,0 +1,204 @@
+"""
+A local vector index over chunk embeddings for semantic search across processed
+transcripts. Vectors are normalised on insert, so cosine similarity is a single
+matrix product. By default every query scans all vectors exactly; for large
+corpora an IVF (inverted file) mode clusters the vectors with k-means and only
+scans the lists whose centroids are nearest the query.
+
+An index is saved as a directory holding vectors.npy, metadata.jsonl (one JSON
+object per vector, e.g. its source file, timestamp and text) and, in IVF mode,
+centroids.npy and assignments.npy. Vectors are memory-mapped when loaded.
+
+Run from the project root to index a processed output file:
+    python src/vector_index.py data/final/v4output.json data/final/index
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import embeddings
+from utils.common import atomic_write
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+    """
+    Returns the vectors scaled to unit length as float32. Zero vectors stay zero.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 20, seed: int = 42) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Spherical k-means: clusters unit vectors by cosine similarity.
+    Args:
+        vectors (np.ndarray): the unit vectors to cluster
+        k (int): the number of clusters, at most the number of vectors
+        iterations (int): the maximum number of assignment/update rounds
+        seed (int): the seed for choosing the initial centroids
+    Returns:
+        tuple: the (k, dimensions) unit centroids and the cluster of each vector
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    assignments = np.full(len(vectors), -1)
+    for _ in range(iterations):
+        new_assignments = np.argmax(vectors @ centroids.T, axis=1)
+        if np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+        for cluster in range(k):
+            members = vectors[assignments == cluster]
+            # an empty cluster keeps its old centroid
+            if len(members):
+                centroids[cluster] = normalise(members.sum(axis=0))
+    return centroids, assignments
+
+
+class VectorIndex:
+    """
+    Cosine-similarity top-k search over unit vectors, each with a metadata dict.
+    """
+
+    def __init__(self, vectors: np.ndarray | None = None, metadata: list[dict] | None = None):
+        """
+        Args:
+            vectors (np.ndarray): initial vectors, which are normalised
+            metadata (list[dict]): a dict per vector, returned with search results
+        """
+        self.vectors = None
+        self.metadata = []
+        self.centroids = None
+        self.assignments = None
+        if vectors is not None:
+            self.add(vectors, metadata)
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def add(self, vectors: np.ndarray, metadata: list[dict] | None = None):
+        """
+        Adds vectors to the index. In IVF mode each is assigned to its nearest existing centroid;
+        call `train` again after adding many vectors to rebalance the lists.
+        Args:
+            vectors (np.ndarray): the vectors to add, one per row
+            metadata (list[dict]): a dict per vector, defaulting to {'id': position}
+        """
+        vectors = normalise(np.atleast_2d(vectors))
+        if metadata is None:
+            metadata = [{'id': len(self) + i} for i in range(len(vectors))]
+        if len(metadata) != len(vectors):
+            raise ValueError('metadata must have one entry per vector')
+        self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+        self.metadata.extend(metadata)
+        if self.centroids is not None:
+            new_assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+            self.assignments = np.concatenate([self.assignments, new_assignments])
+
+    def train(self, nlist: int, iterations: int = 20, seed: int = 42):
+        """
+        Switches the index to IVF mode, clustering the current vectors into `nlist` lists.
+        Args:
+            nlist (int): the number of lists, typically around the square root of the index size
+            iterations (int): the maximum number of k-means rounds
+            seed (int): the k-means seed
+        """
+        if not 0 < nlist <= len(self):
+            raise ValueError('nlist must be between 1 and the number of vectors')
+        self.centroids, self.assignments = kmeans(np.asarray(self.vectors), nlist, iterations, seed)
+
+    def search(self, query: np.ndarray, k: int = 10, nprobe: int = 8) -> list[tuple[float, dict]]:
+        """
+        Returns the k vectors most similar to the query.
+        Args:
+            query (np.ndarray): the query vector
+            k (int): the number of results
+            nprobe (int): in IVF mode, the number of nearest lists to scan. Ignored in exact mode.
+        Returns:
+            list[tuple[float, dict]]: (cosine similarity, metadata) pairs, most similar first
+        """
+        if not len(self):
+            return []
+        query = normalise(query).ravel()
+        if self.centroids is None:
+            candidates = np.arange(len(self))
+        else:
+            lists = np.argsort(self.centroids @ query)[::-1][:nprobe]
+            candidates = np.flatnonzero(np.isin(self.assignments, lists))
+        scores = self.vectors[candidates] @ query
+        k = min(k, len(candidates))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.metadata[candidates[i]]) for i in top]
+
+    def save(self, directory: str):
+        """
+        Saves the index to a directory, replacing any index already there.
+        """
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'vectors': self.vectors, 'centroids': self.centroids, 'assignments': self.assignments}
+        for name, array in arrays.items():
+            path = os.path.join(directory, f'{name}.npy')
+            if array is not None:
+                with atomic_write(path) as f:
+                    np.save(f, array)
+            elif os.path.exists(path):
+                os.remove(path)
+        path = os.path.join(directory, 'metadata.jsonl')
+        with atomic_write(path, 'w', encoding='UTF-8') as f:
+            f.writelines(json.dumps(item) + '\n' for item in self.metadata)
+
+    @classmethod
+    def load(cls, directory: str) -> 'VectorIndex':
+        """
+        Loads an index saved with `save`. The vectors are memory-mapped until more are added.
+        """
+        index = cls()
+        index.vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'metadata.jsonl'), 'r', encoding='UTF-8') as f:
+            index.metadata = [json.loads(line) for line in f if line.strip()]
+        if os.path.exists(os.path.join(directory, 'centroids.npy')):
+            index.centroids = np.load(os.path.join(directory, 'centroids.npy'))
+            index.assignments = np.load(os.path.join(directory, 'assignments.npy'))
+        return index
+
+
+def index_output_file(file_path: str, index_dir: str, text_column: str | None = None, ivf_threshold: int = 50_000):
+    """
+    Embeds the chunks of a processed output file and adds them to the index in `index_dir`,
+    creating it if needed. Chunks of the file already in the index are replaced. The index
+    switches to IVF mode once it holds more than `ivf_threshold` vectors.
+    Args:
+        file_path (str): a JSON lines file written by the pipeline, with 'timestamp' and `text_column`
+        index_dir (str): the index directory
+        text_column (str): the column to embed, defaulting to 'parsed', or 'text' for older outputs
+        ivf_threshold (int): the index size above which IVF lists are trained
+    """
+    df = pd.read_json(file_path, orient='records', lines=True)
+    index = VectorIndex.load(index_dir) if os.path.exists(os.path.join(index_dir, 'vectors.npy')) else VectorIndex()
+
+    source = os.path.basename(file_path)
+    keep = [i for i, item in enumerate(index.metadata) if item.get('source') != source]
+    if len(keep) != len(index):
+        index = VectorIndex(np.asarray(index.vectors)[keep], [index.metadata[i] for i in keep])
+
+    if text_column is None:
+        text_column = 'parsed' if 'parsed' in df.columns else 'text'
+    texts = list(df[text_column].astype(str))
+    metadata = [{'source': source, 'row': row, 'timestamp': int(timestamp), 'text': text}
+                for row, (timestamp, text) in enumerate(zip(df['timestamp'], texts))]
+    index.add(embeddings.embed_texts(texts), metadata)
+    if len(index) > ivf_threshold:
+        index.train(int(np.sqrt(len(index))))
+    index.save(index_dir)
+    print(f"Indexed {len(texts)} chunks from {source}; the index holds {len(index)} vectors")
+
+
+if __name__ == "__main__":
+    index_output_file(sys.argv[1], sys.argv[2])
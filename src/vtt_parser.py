@@ -0,0 +1,87 @@
+"""
+Single-pass streaming parser for WebVTT and SRT caption files, as exported by
+Microsoft Teams and most other meeting tools. The file is read one line at a
+time and cues are yielded as soon as they end, so large recordings are never
+held in memory.
+
+Teams marks speakers with voice spans:
+    00:00:01.000 --> 00:00:04.500
+    <v Jane Smith>So I think we are fine to get started</v>
+"""
+
+import re
+
+TIMING_SEPARATOR = '-->'
+# voice spans, e.g. <v Jane Smith> or <v.loud Jane Smith>
+VOICE_TAG = re.compile(r'<v(?:\.[^\s>]+)*\s+([^>]*)>')
+# any other markup: class/bold/italic spans, closing tags and inline timestamps
+OTHER_TAGS = re.compile(r'</?[^>]*>')
+
+
+def parse_cue_time(value: str) -> float:
+    """
+    Converts a cue time (HH:MM:SS.mmm, MM:SS.mmm or the SRT form HH:MM:SS,mmm) to seconds.
+    Args:
+        value (str): the cue time
+    Returns:
+        float: the number of seconds
+    """
+    seconds = 0.0
+    for part in value.replace(',', '.').split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _make_cue(start: float, text_lines: list[str]):
+    """
+    Returns (start, speaker, text) for a cue's text lines, or None if it has no text.
+    """
+    raw = ' '.join(text_lines)
+    speaker = None
+    voice = VOICE_TAG.search(raw)
+    if voice:
+        speaker = voice.group(1).strip() or None
+    text = ' '.join(OTHER_TAGS.sub(' ', VOICE_TAG.sub(' ', raw)).split())
+    if not text:
+        return None
+    return start, speaker, text
+
+
+def iter_cues(file_path):
+    """
+    Yields one (start_seconds, speaker, text) tuple per cue in a WebVTT or SRT file.
+    Multi-line cue text is joined with spaces and markup is removed. The speaker is
+    None if the cue has no voice span. The WEBVTT header, NOTE, STYLE and REGION blocks
+    and cue identifiers/SRT sequence numbers are skipped.
+    Args:
+        file_path (str): path to the caption file
+    """
+    start = None
+    text_lines = []
+    skipping_block = False
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                # a blank line ends the current cue or block
+                if start is not None:
+                    cue = _make_cue(start, text_lines)
+                    if cue is not None:
+                        yield cue
+                start, text_lines, skipping_block = None, [], False
+                continue
+            if skipping_block:
+                continue
+            if start is None:
+                if TIMING_SEPARATOR in line:
+                    start = parse_cue_time(line.split(TIMING_SEPARATOR, 1)[0].strip())
+                elif line.startswith(('WEBVTT', 'NOTE', 'STYLE', 'REGION')):
+                    skipping_block = True
+                # otherwise this is a cue identifier or SRT sequence number
+                continue
+            text_lines.append(line)
+
+    if start is not None:
+        cue = _make_cue(start, text_lines)
+        if cue is not None:
+            yield cue
@@ -0,0 +1,152 @@
+"""
+Checks the retry, backoff and AIMD behaviour of async_engine against a stub of
+the OpenAI async client, which returns 429s with rate-limit headers the way the
+API does, so no network or API key is needed.
+
+Run from the project root:
+    python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import sys
+import time
+import types
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import async_engine  # noqa: E402
+
+
+class RateLimitError(Exception):
+    """
+    Stands in for openai.RateLimitError: a 429 with the response headers attached.
+    """
+
+    def __init__(self, headers: dict):
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        self.response = types.SimpleNamespace(headers=headers)
+
+
+class StubAsyncOpenAI:
+    """
+    A stub of openai.AsyncOpenAI's chat.completions.with_raw_response.create. It allows `capacity`
+    requests in flight and answers any more with a 429 asking to retry after `retry_after` seconds,
+    and can rate limit the first `fail_first` requests regardless.
+    """
+
+    def __init__(self, capacity: int = 1000, fail_first: int = 0, retry_after: float = 0.05,
+                 latency: float = 0.01, headers: dict | None = None):
+        self.capacity = capacity
+        self.fail_first = fail_first
+        self.retry_after = retry_after
+        self.latency = latency
+        self.headers = headers or {}
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(
+            with_raw_response=types.SimpleNamespace(create=self.create)))
+
+    async def create(self, **request):
+        self.calls += 1
+        if self.calls <= self.fail_first or self.in_flight >= self.capacity:
+            self.rate_limited += 1
+            raise RateLimitError({'retry-after': str(self.retry_after)})
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return types.SimpleNamespace(headers=self.headers, parse=lambda: request['messages'][-1]['content'])
+
+
+def make_request_fn(client: StubAsyncOpenAI):
+    """
+    Returns a request_fn for async_engine that sends an item through the stub client.
+    """
+    async def request_fn(item):
+        raw_response = await client.chat.completions.with_raw_response.create(
+            model='stub', messages=[{'role': 'user', 'content': item}])
+        return raw_response.parse(), raw_response.headers
+    return request_fn
+
+
+class TestRetries(unittest.IsolatedAsyncioTestCase):
+
+    async def test_429_is_retried_after_the_requested_backoff(self):
+        client = StubAsyncOpenAI(fail_first=1, retry_after=0.2)
+        limiter = async_engine.AdaptiveConcurrencyLimiter(initial_limit=8)
+        started = time.monotonic()
+        result = await async_engine.request_with_retries('a', make_request_fn(client), limiter)
+        self.assertEqual(result, 'a')
+        self.assertEqual(client.calls, 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(limiter.rate_limited_count, 1)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_gives_up_after_max_retries(self):
+        client = StubAsyncOpenAI(fail_first=10, retry_after=0.0)
+        limiter = async_engine.AdaptiveConcurrencyLimiter()
+        with self.assertRaises(RateLimitError):
+            await async_engine.request_with_retries('a', make_request_fn(client), limiter, max_retries=2)
+        self.assertEqual(client.calls, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_other_errors_are_not_retried(self):
+        limiter = async_engine.AdaptiveConcurrencyLimiter()
+
+        async def request_fn(item):
+            raise ValueError(item)
+        with self.assertRaises(ValueError):
+            await async_engine.request_with_retries('a', request_fn, limiter)
+        self.assertEqual(limiter.rate_limited_count, 0)
+
+
+class TestAdaptiveConcurrency(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limit_grows_while_requests_succeed(self):
+        client = StubAsyncOpenAI()
+        limiter = async_engine.AdaptiveConcurrencyLimiter(initial_limit=2)
+        results = await async_engine.fetch_all([str(i) for i in range(200)], make_request_fn(client), limiter)
+        self.assertEqual(results, [str(i) for i in range(200)])
+        self.assertGreater(limiter.limit, 2)
+        self.assertEqual(client.rate_limited, 0)
+
+    async def test_limit_shrinks_on_429_and_every_item_completes(self):
+        client = StubAsyncOpenAI(capacity=4, retry_after=0.02)
+        limiter = async_engine.AdaptiveConcurrencyLimiter(initial_limit=32)
+        results = await async_engine.fetch_all([str(i) for i in range(100)], make_request_fn(client), limiter)
+        self.assertEqual(results, [str(i) for i in range(100)])
+        self.assertGreater(client.rate_limited, 0)
+        self.assertLess(limiter.limit, 32)
+        self.assertGreaterEqual(limiter.limit, limiter.min_limit)
+
+    async def test_limit_shrinks_to_the_remaining_requests_header(self):
+        client = StubAsyncOpenAI(headers={'x-ratelimit-remaining-requests': '3'})
+        limiter = async_engine.AdaptiveConcurrencyLimiter(initial_limit=16)
+        await async_engine.request_with_retries('a', make_request_fn(client), limiter)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_rate_limits_at_once_only_cut_the_limit_once(self):
+        limiter = async_engine.AdaptiveConcurrencyLimiter(initial_limit=16)
+        for _ in range(5):
+            limiter.on_rate_limit(retry_after=1.0)
+        self.assertEqual(limiter.limit, 8)
+        self.assertEqual(limiter.rate_limited_count, 5)
+
+
+class TestParseResetDuration(unittest.TestCase):
+
+    def test_formats(self):
+        self.assertEqual(async_engine.parse_reset_duration('20ms'), 0.02)
+        self.assertEqual(async_engine.parse_reset_duration('6m0s'), 360.0)
+        self.assertEqual(async_engine.parse_reset_duration('1h2m3.5s'), 3723.5)
+        self.assertEqual(async_engine.parse_reset_duration('2'), 2.0)
+        self.assertIsNone(async_engine.parse_reset_duration('soon'))
+
+
+if __name__ == '__main__':
+    unittest.main()